@@ -75,6 +75,13 @@ class ConnectomeConfigUI(ConnectomeConfig):
             label="Connectivity matrix",
             show_border=True,
         ),
+        Group(
+            Item("streaming"),
+            Item("chunk_size", enabled_when="streaming"),
+            Item("n_jobs", label="Number of jobs"),
+            label="Tractogram loading",
+            show_border=True,
+        ),
     )
 
 
@@ -146,7 +153,7 @@ class ConnectomeStageUI(ConnectomeStage):
         ),
         scrollable=True,
         resizable=True,
-        height=270,
+        height=390,
         width=670,
         kind="livemodal",
         title="Edit stage configuration",
@@ -46,6 +46,12 @@ class ConnectomeConfigUI(ConnectomeConfig):
                 visible_when="apply_scrubbing==True",
             ),
         ),
+        VGroup(
+            Item("fisher_z", label="Fisher z-transform"),
+            Item("partial_correlation", label="Partial correlation (Ledoit-Wolf)"),
+            Item("covariance"),
+            label="Additional connectivity measures",
+        ),
         Item("output_types", style="custom"),
     )
 
@@ -119,7 +125,7 @@ class ConnectomeStageUI(ConnectomeStage):
         ),
         scrollable=True,
         resizable=True,
-        height=200,
+        height=300,
         width=408,
         kind="livemodal",
         title="Edit stage configuration",
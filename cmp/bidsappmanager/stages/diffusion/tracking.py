@@ -29,7 +29,8 @@ class Dipy_tracking_configUI(DipyTrackingConfig):
     traits_view = View(
         VGroup(
             Group(
-                Item("seed_density", label="Seed density"),
+                Item("seeding", label="Seeding"),
+                Item("seed_density", label="Seed density", visible_when='seeding=="density"'),
                 Item("step_size", label="Step size"),
                 Item("max_angle", label="Max angle (degree)"),
                 Item(
@@ -43,6 +44,11 @@ class Dipy_tracking_configUI(DipyTrackingConfig):
             Group(
                 Item("use_act", label="Use PFT"),
                 Item("seed_from_gmwmi", visible_when="use_act"),
+                Item(
+                    "weight_seeds_by_gmwmi",
+                    label="Weight seeds by GMWMI",
+                    visible_when="seed_from_gmwmi",
+                ),
                 # Item('fast_number_of_classes', label='Number of tissue classes (FAST)')
                 label="Particle Filtering Tractography (PFT)",
                 visible_when='tracking_mode=="Probabilistic"',
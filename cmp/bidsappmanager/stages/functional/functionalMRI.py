@@ -52,6 +52,12 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
             label="Bandpass filtering",
             show_border=True,
         ),
+        HGroup(
+            Item("fused_denoising", label="Single-pass denoising"),
+            Item("bandpass_filter_type", label="Bandpass filter", visible_when="fused_denoising"),
+            label="Denoising engine",
+            show_border=True,
+        ),
     )
 
 
@@ -40,6 +40,7 @@ def create_docker_cmd(args):
                 ('number_of_threads': 1,)
                 ('number_of_participants_processed_in_parallel': 1,)
                 ('mrtrix_random_seed': 1234,)
+                ('dipy_random_seed': 1234,)
                 ('ants_random_seed': 1234,)
                 ('ants_number_of_threads': 2,)
                 ('fs_license': "/path/to/license.txt",)
@@ -90,7 +91,7 @@ def create_docker_cmd(args):
     cmd += f'--fs_license /bids_dir/code/license.txt '
     optional_single_args = (
         "number_of_threads", "number_of_participants_processed_in_parallel",
-        "mrtrix_random_seed", "ants_random_seed", "ants_number_of_threads",
+        "mrtrix_random_seed", "dipy_random_seed", "ants_random_seed", "ants_number_of_threads",
     )
     for arg_name in optional_single_args:
         argument_value = getattr(args, arg_name)
@@ -105,6 +105,13 @@ def get() -> argparse.ArgumentParser:
         help="Fix MRtrix3 random number generator seed to the specified value",
     )
 
+    p.add_argument(
+        "--dipy_random_seed",
+        default=None,
+        type=int,
+        help="Fix Dipy tractography random number generator seed to the specified value",
+    )
+
     p.add_argument(
         "--ants_random_seed",
         default=None,
@@ -1050,6 +1050,7 @@ class DiffusionPipeline(Pipeline):
         # fmt:on
 
         if self.stages["Preprocessing"].enabled:
+            self.stages["Preprocessing"].config.number_of_threads = self.number_of_cores
             preproc_flow = self.create_stage_flow("Preprocessing")
             # fmt:off
             diffusion_flow.connect(
@@ -1061,6 +1062,7 @@ class DiffusionPipeline(Pipeline):
                                                          ("brain_mask", "inputnode.brain_mask"),
                                                          ("wm_mask_file", "inputnode.wm_mask_file"),
                                                          ("roi_volumes", "inputnode.roi_volumes"),
+                                                         ("roi_graphMLs", "inputnode.roi_graphMLs"),
                                                          ("bvecs", "inputnode.bvecs"),
                                                          ("bvals", "inputnode.bvals"),
                                                          ("T1", "inputnode.T1")]),
@@ -1069,6 +1071,7 @@ class DiffusionPipeline(Pipeline):
             # fmt:on
 
         if self.stages["Registration"].enabled:
+            self.stages["Registration"].config.number_of_threads = self.number_of_cores
             reg_flow = self.create_stage_flow("Registration")
             # fmt:off
             diffusion_flow.connect(
@@ -1104,6 +1107,8 @@ class DiffusionPipeline(Pipeline):
 
 
         if self.stages["Diffusion"].enabled:
+            self.stages["Diffusion"].config.dipy_recon_config.n_jobs = self.number_of_cores
+            self.stages["Diffusion"].config.dipy_tracking_config.n_jobs = self.number_of_cores
             diff_flow = self.create_stage_flow("Diffusion")
             # fmt:off
             diffusion_flow.connect(
@@ -1138,6 +1143,12 @@ class DiffusionPipeline(Pipeline):
         if self.stages["Connectome"].enabled:
             self.stages["Connectome"].config.probtrackx = False
             self.stages["Connectome"].config.subject = self.global_conf.subject
+            if self.stages["Connectome"].config.n_jobs > self.number_of_cores:
+                print(
+                    f"  .. WARNING: Limit the number of connectome jobs to {self.number_of_cores} "
+                    f"(Number of cores of the pipeline)"
+                )
+                self.stages["Connectome"].config.n_jobs = self.number_of_cores
             con_flow = self.create_stage_flow("Connectome")
             # fmt:off
             diffusion_flow.connect(
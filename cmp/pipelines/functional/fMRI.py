@@ -604,6 +604,7 @@ class fMRIPipeline(Pipeline):
             ("FD.npy", self.subject + "_desc-scrubbing_FD.npy"),
             ("DVARS.npy", self.subject + "_desc-scrubbing_DVARS.npy"),
             ("fMRI_bandpass.nii.gz", self.subject + "_task-rest_desc-bandpass_bold.nii.gz"),
+            ("fMRI_denoised.nii.gz", self.subject + "_task-rest_desc-denoised_bold.nii.gz"),
             ("fMRI_discard_mean.nii.gz",  self.subject + "_meanBOLD.nii.gz")
         ]
         # fmt:on
@@ -805,6 +806,7 @@ class fMRIPipeline(Pipeline):
             # fmt:on
 
         if self.stages["Registration"].enabled:
+            self.stages["Registration"].config.number_of_threads = self.number_of_cores
             reg_flow = self.create_stage_flow("Registration")
             # fmt:off
             fMRI_flow.connect(
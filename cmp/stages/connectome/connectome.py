@@ -31,6 +31,17 @@ class ConnectomeConfig(HasTraits):
     compute_curvature : traits.Bool
         Compute fiber curvature (Default: False)
 
+    streaming : traits.Bool
+        Stream the tractogram by chunks of fibers instead of loading
+        it all in memory (Default: False)
+
+    chunk_size : traits.Int
+        Number of fibers per chunk in streaming mode (Default: 100000)
+
+    n_jobs : traits.Int
+        Number of processes used to build the connectomes. It is limited
+        to the number of cores of the pipeline (Default: 1)
+
     output_types : ['gpickle', 'mat', 'graphml']
         Output connectome format
 
@@ -56,6 +67,9 @@ class ConnectomeConfig(HasTraits):
 
     # modality = List(['Deterministic','Probabilistic'])
     compute_curvature = Bool(False)
+    streaming = Bool(False)
+    chunk_size = Int(100000)
+    n_jobs = Int(1)
     output_types = List(["gpickle", "mat", "graphml"])
     connectivity_metrics = List(
         [
@@ -139,6 +153,11 @@ class ConnectomeStage(Stage):
         )
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.streaming = self.config.streaming
+        cmtk_cmat.inputs.chunk_size = self.config.chunk_size
+        cmtk_cmat.inputs.n_jobs = self.config.n_jobs
+        # Reserve the cores used by the node in the MultiProc scheduler
+        cmtk_cmat.n_procs = self.config.n_jobs
 
         # Additional maps
         map_merge = pe.Node(interface=util.Merge(9), name="merge_additional_maps")
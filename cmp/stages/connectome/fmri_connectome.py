@@ -46,6 +46,17 @@ class ConnectomeConfig(HasTraits):
         DVARS (RMS of variance over voxels) threshold
         (Default: 4.0)
 
+    fisher_z : traits.Bool
+        Add the Fisher z-transform of the correlation to the connectome
+        (Default: False)
+
+    partial_correlation : traits.Bool
+        Add the partial correlation, computed from the Ledoit-Wolf estimate
+        of the precision matrix, to the connectome (Default: False)
+
+    covariance : traits.Bool
+        Add the covariance to the connectome (Default: False)
+
     output_types : ['gpickle', 'mat', 'cff', 'graphml']
         Output connectome format
 
@@ -69,6 +80,9 @@ class ConnectomeConfig(HasTraits):
     apply_scrubbing = Bool(False)
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
+    fisher_z = Bool(False)
+    partial_correlation = Bool(False)
+    covariance = Bool(False)
     output_types = List(["gpickle", "mat", "cff", "graphml"])
     log_visualization = Bool(True)
     circular_layout = Bool(False)
@@ -129,6 +143,9 @@ class ConnectomeStage(Stage):
         cmtk_cmat.inputs.apply_scrubbing = self.config.apply_scrubbing
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
+        cmtk_cmat.inputs.fisher_z = self.config.fisher_z
+        cmtk_cmat.inputs.partial_correlation = self.config.partial_correlation
+        cmtk_cmat.inputs.covariance = self.config.covariance
 
         if not isdefined(inputnode.inputs.FD) or not isdefined(inputnode.inputs.DVARS):
             cmtk_cmat.inputs.apply_scrubbing = False
@@ -127,6 +127,11 @@ class DipyReconConfig(HasTraits):
     shore_positive_constraint : traits.Bool
         Constrain the SHORE propagator to be positive
         (Default: False)
+
+    n_jobs : traits.Int
+        Number of processes used to fit the reconstruction models.
+        It is set to the number of cores of the pipeline
+        (Default: 1)
     """
 
     imaging_model = Str
@@ -196,6 +201,8 @@ class DipyReconConfig(HasTraits):
         False, usedefault=True, desc="Constrain the propagator to be positive."
     )
 
+    n_jobs = Int(1)
+
     def _imaging_model_changed(self, new):
         """Update ``local_model_editor`` and ``self.local_model`` when ``imaging_model`` is updated.
 
@@ -400,6 +407,8 @@ def create_dipy_recon_flow(config):
         dipy_tensor.inputs.auto = True
         dipy_tensor.inputs.roi_radius = 10
         dipy_tensor.inputs.fa_thresh = config.single_fib_thr
+        # Peaks used by the tensor-informed EuDX tractography
+        dipy_tensor.inputs.extract_peaks = not config.local_model
         # fmt:off
         flow.connect(
             [
@@ -421,6 +430,7 @@ def create_dipy_recon_flow(config):
             flow.connect(
                 [
                     (inputnode, outputnode, [("diffusion_resampled", "DWI")]),
+                    (inputnode, dipy_tensor, [("wm_mask_resampled", "peaks_mask")]),
                     (dipy_tensor, outputnode, [("dti_model", "model")]),
                 ]
             )
@@ -469,7 +479,9 @@ def create_dipy_recon_flow(config):
                 # fmt:on
     else:
         # Perform SHORE reconstruction (DSI)
-        dipy_SHORE = pe.Node(interface=SHORE(), name="dipy_SHORE")
+        dipy_SHORE = pe.Node(
+            interface=SHORE(n_jobs=config.n_jobs), name="dipy_SHORE", n_procs=config.n_jobs
+        )
 
         if config.tracking_processing_tool == "MRtrix":
             dipy_SHORE.inputs.tracking_processing_tool = "mrtrix"
@@ -503,7 +515,9 @@ def create_dipy_recon_flow(config):
         # fmt:on
 
     if config.mapmri:
-        dipy_MAPMRI = pe.Node(interface=MAPMRI(), name="dipy_mapmri")
+        dipy_MAPMRI = pe.Node(
+            interface=MAPMRI(n_jobs=config.n_jobs), name="dipy_mapmri", n_procs=config.n_jobs
+        )
 
         dipy_MAPMRI.inputs.laplacian_regularization = config.laplacian_regularization
         dipy_MAPMRI.inputs.laplacian_weighting = config.laplacian_weighting
@@ -520,6 +534,7 @@ def create_dipy_recon_flow(config):
                 (inputnode, dipy_MAPMRI, [("diffusion_resampled", "in_file")]),
                 (inputnode, dipy_MAPMRI, [("bvals", "in_bval")]),
                 (flip_bvecs, dipy_MAPMRI, [("bvecs_flipped", "in_bvec")]),
+                (inputnode, dipy_MAPMRI, [("brain_mask_resampled", "in_mask")]),
                 (dipy_MAPMRI, mapmri_maps_merge, [("rtop_file", "in1"),
                                                   ("rtap_file", "in2"),
                                                   ("rtpp_file", "in3"),
@@ -52,6 +52,12 @@ class DipyTrackingConfig(HasTraits):
         and will result in a total of 8 seeds per voxel
         (Default: 1.0)
 
+    seeding : traits.Enum
+        Seeding strategy: "density" to place ``seed_density`` seeds per voxel on a regular grid,
+        "stratified" to place exactly ``number_of_seeds`` seeds split between the voxels of the
+        seed mask, or "uniform" to place them in voxels drawn independently
+        (Default: "density")
+
     fa_thresh : traits.Float
         Fractional Anisotropy (FA) threshold
         (Default: 0.2)
@@ -76,6 +82,16 @@ class DipyTrackingConfig(HasTraits):
         Seed from Grey Matter / White Matter interface
         (requires Anatomically-Constrained Tractography (ACT))
         (Default: False)
+
+    weight_seeds_by_gmwmi : traits.Bool
+        Weight the density of seeds by the values of the Grey Matter / White Matter interface
+        (requires ``seed_from_gmwmi``)
+        (Default: False)
+
+    n_jobs : traits.Int
+        Number of processes in which the seeds are tracked.
+        It is set to the number of cores of the pipeline
+        (Default: 1)
     """
 
     imaging_model = Str
@@ -87,6 +103,12 @@ class DipyTrackingConfig(HasTraits):
         desc="Number of seeds to place along each direction. "
         "A density of 2 is the same as [2, 2, 2] and will result in a total of 8 seeds per voxel.",
     )
+    seeding = Enum(
+        "density",
+        ["density", "stratified", "uniform"],
+        desc="Place seed_density seeds per voxel on a regular grid (density), or exactly number_of_seeds seeds "
+        "split between the voxels of the seed mask (stratified) or in voxels drawn independently (uniform)",
+    )
     fa_thresh = Float(0.2)
     step_size = traits.Float(0.5)
     max_angle = Float(25.0)
@@ -100,6 +122,12 @@ class DipyTrackingConfig(HasTraits):
         False,
         desc="Seed from Grey Matter / White Matter interface (requires Anatomically-Constrained Tractography (ACT))",
     )
+    weight_seeds_by_gmwmi = traits.Bool(
+        False,
+        desc="Weight the density of seeds by the values of the Grey Matter / White Matter interface",
+    )
+
+    n_jobs = Int(1)
 
     # fast_number_of_classes = Int(3)
 
@@ -339,9 +367,12 @@ def create_dipy_tracking_flow(config):
 
     if not config.SD and config.imaging_model != "DSI":  # If tensor fitting was used
         dipy_tracking = pe.Node(
-            interface=TensorInformedEudXTractography(), name="dipy_dtieudx_tracking"
+            interface=TensorInformedEudXTractography(n_jobs=config.n_jobs),
+            name="dipy_dtieudx_tracking",
+            n_procs=config.n_jobs,
         )
         dipy_tracking.inputs.num_seeds = config.number_of_seeds
+        dipy_tracking.inputs.seeding = config.seeding
         dipy_tracking.inputs.fa_thresh = config.fa_thresh
         dipy_tracking.inputs.max_angle = config.max_angle
         dipy_tracking.inputs.step_size = config.step_size
@@ -363,8 +394,9 @@ def create_dipy_tracking_flow(config):
         if config.tracking_mode == "Deterministic":
 
             dipy_tracking = pe.Node(
-                interface=DirectionGetterTractography(),
+                interface=DirectionGetterTractography(n_jobs=config.n_jobs),
                 name="dipy_deterministic_tracking",
+                n_procs=config.n_jobs,
             )
             dipy_tracking.inputs.algo = "deterministic"
             dipy_tracking.inputs.num_seeds = config.number_of_seeds
@@ -373,7 +405,9 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.step_size = config.step_size
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.use_act = config.seed_from_gmwmi
+            dipy_tracking.inputs.seeding = config.seeding
             dipy_tracking.inputs.seed_density = config.seed_density
+            dipy_tracking.inputs.weight_seeds_by_gmwmi = config.weight_seeds_by_gmwmi
             # dipy_tracking.inputs.fast_number_of_classes = config.fast_number_of_classes
 
             if config.imaging_model == "DSI":
@@ -408,8 +442,9 @@ def create_dipy_tracking_flow(config):
         elif config.tracking_mode == "Probabilistic":
 
             dipy_tracking = pe.Node(
-                interface=DirectionGetterTractography(),
+                interface=DirectionGetterTractography(n_jobs=config.n_jobs),
                 name="dipy_probabilistic_tracking",
+                n_procs=config.n_jobs,
             )
             dipy_tracking.inputs.algo = "probabilistic"
             dipy_tracking.inputs.num_seeds = config.number_of_seeds
@@ -418,7 +453,9 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.step_size = config.step_size
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.seed_from_gmwmi = config.seed_from_gmwmi
+            dipy_tracking.inputs.seeding = config.seeding
             dipy_tracking.inputs.seed_density = config.seed_density
+            dipy_tracking.inputs.weight_seeds_by_gmwmi = config.weight_seeds_by_gmwmi
             # dipy_tracking.inputs.fast_number_of_classes = config.fast_number_of_classes
 
             if config.imaging_model == "DSI":
@@ -20,7 +20,7 @@ from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, NuisanceRegression
+from cmtklib.functionalMRI import Scrubbing, Detrending, NuisanceRegression, DenoiseBOLD
 from cmtklib.interfaces.afni import Bandpass
 
 class FunctionalMRIConfig(HasTraits):
@@ -68,6 +68,15 @@ class FunctionalMRIConfig(HasTraits):
         Perform scrubbing
         (Default: True)
 
+    fused_denoising = Bool
+        Perform detrending, nuisance regression and bandpass filtering
+        in a single pass with the `DenoiseBOLD` interface
+        (Default: False)
+
+    bandpass_filter_type = Enum("fft", "butterworth")
+        Type of bandpass filter used by the fused denoising
+        (Default: "fft")
+
     See Also
     --------
     cmp.stages.functional.functionalMRI.FunctionalMRIStage
@@ -90,6 +99,9 @@ class FunctionalMRIConfig(HasTraits):
 
     scrubbing = Bool(True)
 
+    fused_denoising = Bool(False)
+    bandpass_filter_type = Enum("fft", "butterworth")
+
 
 class FunctionalMRIStage(Stage):
     """Class that represents the post-registration preprocessing stage of the `fMRIPipeline`.
@@ -137,6 +149,10 @@ class FunctionalMRIStage(Stage):
         outputnode : nipype.interfaces.utility.IdentityInterface
             Identity interface describing the outputs of the stage
         """
+        if self.config.fused_denoising:
+            self.create_fused_workflow(flow, inputnode, outputnode)
+            return
+
         if self.config.scrubbing and isdefined(inputnode.inputs.motion_par_file):
             scrubbing = pe.Node(interface=Scrubbing(), name="scrubbing")
             # fmt:off
@@ -261,11 +277,82 @@ class FunctionalMRIStage(Stage):
         flow.connect([(filter_output, outputnode, [("filter_output", "func_file")])])
         # fmt:on
 
+    def create_fused_workflow(self, flow, inputnode, outputnode):
+        """Create the stage workflow with the single-pass `DenoiseBOLD` interface.
+
+        Parameters
+        ----------
+        flow : nipype.pipeline.engine.Workflow
+            The nipype.pipeline.engine.Workflow instance of the fMRI pipeline
+
+        inputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the inputs of the stage
+
+        outputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the outputs of the stage
+        """
+        scrubbing = self.config.scrubbing and isdefined(inputnode.inputs.motion_par_file)
+
+        denoising = pe.Node(interface=DenoiseBOLD(), name="denoising")
+        denoising.inputs.detrending = self.config.detrending
+        denoising.inputs.detrending_mode = self.config.detrending_mode
+        denoising.inputs.global_nuisance = self.config.global_nuisance
+        denoising.inputs.csf_nuisance = self.config.csf
+        denoising.inputs.wm_nuisance = self.config.wm
+        denoising.inputs.motion_nuisance = self.config.motion
+        denoising.inputs.bandpass_filtering = self.config.bandpass_filtering
+        # Same swap of the low and high frequencies as for 3dBandpass
+        denoising.inputs.highpass = self.config.lowpass_filter
+        denoising.inputs.lowpass = self.config.highpass_filter
+        denoising.inputs.filter_type = self.config.bandpass_filter_type
+        denoising.inputs.scrubbing = scrubbing
+        # fmt:off
+        flow.connect(
+            [
+                (inputnode, denoising, [("preproc_file", "in_file"),
+                                        ("registered_roi_volumes", "gm_file"),
+                                        ("eroded_brain", "brainfile"),
+                                        ("eroded_csf", "csf_file"),
+                                        ("registered_wm", "wm_file")]),
+                (denoising, outputnode, [("out_file", "func_file")]),
+            ]
+        )
+        # fmt:on
+        if self.config.motion or scrubbing:
+            # fmt:off
+            flow.connect([(inputnode, denoising, [("motion_par_file", "motion_file")])])
+            # fmt:on
+        if scrubbing:
+            # fmt:off
+            flow.connect(
+                [
+                    (denoising, outputnode, [("fd_npy", "FD"),
+                                             ("dvars_npy", "DVARS")]),
+                ]
+            )
+            # fmt:on
+
     def define_inspect_outputs(self):  # pragma: no cover
         """Update the `inspect_outputs` class attribute.
 
         It contains a dictionary of stage outputs with corresponding commands for visual inspection.
         """
+        if self.config.fused_denoising:
+            res_dir = os.path.join(self.stage_dir, "denoising")
+            denoised = os.path.join(res_dir, "fMRI_denoised.nii.gz")
+            if os.path.exists(denoised):
+                self.inspect_outputs_dict["Denoising output"] = [
+                    "fsleyes",
+                    "-sdefault",
+                    denoised,
+                    "-cm",
+                    "brain_colours_blackbdy_iso",
+                ]
+            self.inspect_outputs = sorted(
+                [key for key in list(self.inspect_outputs_dict.keys())], key=str.lower
+            )
+            return
+
         if (
             self.config.wm
             or self.config.global_nuisance
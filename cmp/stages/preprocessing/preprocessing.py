@@ -115,6 +115,10 @@ class PreprocessingConfig(HasTraits):
         gray-matter / white-matter interface
         (Default: False)
 
+    number_of_threads : traits.Int
+        Number of parcellation scales converted in parallel
+        (Default: 1)
+
     See Also
     --------
     cmp.stages.preprocessing.preprocessing.PreprocessingStage
@@ -145,6 +149,8 @@ class PreprocessingConfig(HasTraits):
     act_tracking = Bool(False)
     gmwmi_seeding = Bool(False)
 
+    number_of_threads = Int(1)
+
 
 class PreprocessingStage(Stage):
     """Class that represents the pre-registration preprocessing stage of a :class:`~cmp.pipelines.diffusion.diffusion.DiffusionPipeline` instance.
@@ -179,6 +185,7 @@ class PreprocessingStage(Stage):
             "brain_mask",
             "wm_mask_file",
             "roi_volumes",
+            "roi_graphMLs",
         ]
         self.outputs = [
             "diffusion_preproc",
@@ -230,6 +237,7 @@ class PreprocessingStage(Stage):
                     "brain_mask",
                     "wm_mask_file",
                     "roi_volumes",
+                    "roi_graphMLs",
                 ]
             ),
             name="processing_input",
@@ -247,7 +255,8 @@ class PreprocessingStage(Stage):
                                                ("brain", "brain"),
                                                ("brain_mask", "brain_mask"),
                                                ("wm_mask_file", "wm_mask_file"),
-                                               ("roi_volumes", "roi_volumes")]),
+                                               ("roi_volumes", "roi_volumes"),
+                                               ("roi_graphMLs", "roi_graphMLs")]),
                 (processing_input, outputnode, [("bvals", "bvals")]),
             ]
         )
@@ -298,9 +307,13 @@ class PreprocessingStage(Stage):
         )
         mr_convert_roi_volumes = pe.Node(
             interface=ApplymultipleMRConvert(
-                stride=[1, 2, 3], output_datatype="float32", extension="nii"
+                stride=[1, 2, 3],
+                output_datatype="float32",
+                extension="nii",
+                n_procs=self.config.number_of_threads,
             ),
             name="mr_convert_roi_volumes",
+            n_procs=self.config.number_of_threads,
         )
         mr_convert_wm_mask_file = pe.Node(
             interface=MRConvert(
@@ -1053,7 +1066,8 @@ class PreprocessingStage(Stage):
                 [
                     (mrtrix_5tt, mrtrix_gmwmi, [("out_file", "in_file")]),
                     (mrtrix_gmwmi, update_gmwmi, [("out_file", "in_gmwmi_file")]),
-                    (processing_input, update_gmwmi, [("roi_volumes", "in_roi_volumes")]),
+                    (processing_input, update_gmwmi, [("roi_volumes", "in_roi_volumes"),
+                                                      ("roi_graphMLs", "in_roi_graphmls")]),
                     (update_gmwmi, fs_mriconvert_gmwmi, [("out_gmwmi_file", "in_file")]),
                     (fs_mriconvert_gmwmi, outputnode, [("out_file", "gmwmi")]),
                 ]
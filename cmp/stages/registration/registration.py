@@ -171,6 +171,11 @@ class RegistrationConfig(HasTraits):
         Apply estimated transform to eroded brain mask
         (Default: False)
 
+    number_of_threads : traits.Int
+        Number of images (parcellation scales, partial volume maps)
+        to which the estimated transform is applied in parallel
+        (Default: 1)
+
     tracking_tool : Enum(['Dipy', 'MRtrix'])
         Tool used for tractography
 
@@ -253,6 +258,7 @@ class RegistrationConfig(HasTraits):
     apply_to_eroded_wm = Bool(True)
     apply_to_eroded_csf = Bool(True)
     apply_to_eroded_brain = Bool(False)
+    number_of_threads = Int(1)
 
     # ACT tracking / GMWM interface seeding
     tracking_tool = Enum(['Dipy', 'MRtrix'])
@@ -687,8 +693,10 @@ class RegistrationStage(Stage):
                         interpolation="NearestNeighbor",
                         default_value=0,
                         out_postfix="_warped",
+                        n_procs=self.config.number_of_threads,
                 ),
                 name="apply_warp_roivs",
+                n_procs=self.config.number_of_threads,
         )
 
         if self.config.act_tracking:
@@ -705,9 +713,11 @@ class RegistrationStage(Stage):
             if self.config.tracking_tool == "Dipy":
                 ants_applywarp_pves = pe.Node(
                         interface=MultipleANTsApplyTransforms(
-                                interpolation="Gaussian", default_value=0, out_postfix="_warped"
+                                interpolation="Gaussian", default_value=0, out_postfix="_warped",
+                                n_procs=self.config.number_of_threads,
                         ),
                         name="apply_warp_pves",
+                        n_procs=self.config.number_of_threads,
                 )
 
             if self.config.gmwmi_seeding:
@@ -985,8 +995,9 @@ class RegistrationStage(Stage):
             name="apply_registration_wm",
         )
         fsl_applyxfm_rois = pe.Node(
-            interface=ApplymultipleXfm(interp='nearestneighbour'),
-            name="apply_registration_roivs"
+            interface=ApplymultipleXfm(interp='nearestneighbour', n_procs=self.config.number_of_threads),
+            name="apply_registration_roivs",
+            n_procs=self.config.number_of_threads,
         )
 
         # TODO apply xfm to gmwmi / 5tt and pves
@@ -1184,7 +1195,9 @@ class RegistrationStage(Stage):
             name="apply_registration_wm",
         )
         fsl_applyxfm_rois = pe.Node(
-            interface=ApplymultipleXfm(), name="apply_registration_roivs"
+            interface=ApplymultipleXfm(n_procs=self.config.number_of_threads),
+            name="apply_registration_roivs",
+            n_procs=self.config.number_of_threads,
         )
 
         # fmt:off
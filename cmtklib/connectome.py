@@ -7,18 +7,23 @@
 """Module that defines CMTK functions and Nipype interfaces for connectome mapping."""
 
 from os import path as op
-import csv
+import collections
 import glob
+import itertools
 import os
-import copy
+from concurrent.futures import ProcessPoolExecutor
 
 from traits.api import *
 
 import nibabel as nib
+from nibabel.affines import apply_affine
+from nibabel.streamlines import LazyTractogram
+from nibabel.streamlines.trk import get_affine_rasmm_to_trackvis
 import numpy as np
 import networkx as nx
 
 import scipy.io as sio
+import scipy.sparse as sparse
 
 from nipype.interfaces.base import (
     traits,
@@ -32,8 +37,20 @@ from nipype.interfaces.base import (
 )
 from nipype.utils.filemanip import split_filename
 
-from .util import mean_curvature, length
+from .util import mean_curvature, roi_stats
 from .parcellation import get_parcellation
+from .graph import ConnectomeData
+from .functionalMRI import BoldData
+
+# Node attributes saved in the connectome GraphML files
+GRAPHML_NODE_ATTRIBUTES = [
+    "dn_multiscaleID",
+    "dn_fsname",
+    "dn_hemisphere",
+    "dn_name",
+    "dn_position",
+    "dn_region",
+]
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -85,58 +102,774 @@ def create_endpoints_array(fib, voxelSize, print_info):
 
     # Init
     n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
     endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
 
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
+    if n > 0:
+        # Gather the first and last point of all fibers at once
+        endpointsmm[:, 0, :] = np.array([fi[0][0, :] for fi in fib])
+        endpointsmm[:, 1, :] = np.array([fi[0][-1, :] for fi in fib])
 
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
+    endpoints = endpoints_mm_to_index(endpointsmm, voxelSize)
 
-        f = fi[0]
+    if print_info:
+        print("  ... INFO - Endpoints extracted for %i fibers" % n)
 
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
+    # Return the matrices
+    return endpoints, endpointsmm
 
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
 
-        # print 'endpoints (mm) : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+def endpoints_mm_to_index(endpointsmm, voxelSize):
+    """Translate fiber endpoints from milimeter coordinates to voxel indices.
 
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    Parameters
+    ----------
+    endpointsmm : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing the first and last point
+        of each fiber in milimeter coordinates
 
-        # print 'endpoints : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+    voxelSize : 3-tuple
+        It contains the voxel size of the ROI image
 
-    # Return the matrices
-    return endpoints, endpointsmm
+    Returns
+    -------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing the voxel indices
+        (truncated towards zero as ``int()``)
+    """
+    endpoints = np.zeros(endpointsmm.shape)
+    endpoints[:] = (endpointsmm / np.asarray(voxelSize[:3], dtype=np.float64)).astype(np.int64)
+    return endpoints
 
 
-def save_fibers(oldhdr, oldfib, fname, indices):
-    """Stores a new trackvis file fname using only given indices.
+def load_fiber_chunks(intrk, chunk_size=None):
+    """Read the fibers of a TrackVis tractogram by chunks.
+
+    The tractogram is lazily loaded with ``nib.streamlines`` such that only
+    one chunk of fibers is held in memory at a time. Points are brought back
+    to the TrackVis ``voxmm`` space of the file (as returned by the former
+    ``nib.trackvis.read``).
+
+    Parameters
+    ----------
+    intrk : TRK file
+        Input tractogram
+
+    chunk_size : int
+        Number of fibers per chunk. If None, all the fibers are returned
+        in a single chunk.
+
+    Yields
+    ------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all the fibers
+        of the chunk in ``voxmm`` space
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] such that the points of the i-th fiber
+        of the chunk are ``points[offsets[i]:offsets[i + 1]]``
+    """
+    trk = nib.streamlines.load(intrk, lazy_load=True)
+    rasmm_to_voxmm = get_affine_rasmm_to_trackvis(trk.header)
+
+    streamlines = iter(trk.tractogram.streamlines)
+    while True:
+        chunk = list(itertools.islice(streamlines, chunk_size))
+        if len(chunk) == 0:
+            break
+
+        offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in chunk])
+
+        # Streamlines are stored in float32 in the TRK file,
+        # so that the round-trip to RAS+ space is exact
+        points = apply_affine(rasmm_to_voxmm, np.concatenate(chunk)).astype(np.float32)
+        del chunk
+
+        yield points, offsets
+
+
+def fiber_lengths(points, offsets):
+    """Compute the euclidean length of a set of fibers.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of the fibers
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] delimiting the points of each fiber
+
+    Returns
+    -------
+    lengths : numpy.ndarray
+        Length of each fiber, in float64
+    """
+    n = len(offsets) - 1
+    steps = np.sqrt((np.diff(points.astype(np.float64), axis=0) ** 2).sum(axis=1))
+    fiber_ids = np.repeat(np.arange(n), np.diff(offsets))
+    # Discard the steps between the last point of a fiber and the first point of the next one
+    within = fiber_ids[1:] == fiber_ids[:-1]
+    lengths = np.bincount(fiber_ids[1:][within], weights=steps[within], minlength=n)
+    return lengths
+
+
+def fiber_point_voxels(points, offsets, zooms, shape):
+    """Convert the points of a set of fibers to voxel indices in a scalar map.
+
+    Fibers with a point outside the map are discarded.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of the fibers in ``voxmm`` space
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] delimiting the points of each fiber
+
+    zooms : 3-tuple
+        Voxel size of the scalar map
+
+    shape : 3-tuple
+        Dimensions of the scalar map
+
+    Returns
+    -------
+    valid : numpy.ndarray
+        Boolean array of size [#points] which is True for the points of
+        the fibers fully contained in the map
+
+    vox : numpy.ndarray
+        Matrix of size [#valid points, 3] containing the voxel indices of the valid points
+    """
+    n = len(offsets) - 1
+    fiber_ids = np.repeat(np.arange(n), np.diff(offsets))
+
+    # Indices are truncated towards zero as with ``astype(np.uint32)``
+    pos = points / np.asarray(zooms[:3], dtype=points.dtype)
+    inside = np.all((pos > -1) & (pos < np.asarray(shape[:3])), axis=1)
+
+    valid_fibers = np.bincount(fiber_ids[~inside], minlength=n) == 0
+    valid = valid_fibers[fiber_ids]
+
+    return valid, pos[valid].astype(np.int64)
+
+
+def process_fiber_chunk(points, offsets, voxelSize, label_volumes, maps, compute_curvature=False):
+    """Compute the fiber-wise measures of a chunk of fibers.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of the fibers in ``voxmm`` space
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] delimiting the points of each fiber
+
+    voxelSize : 3-tuple
+        It contains the voxel size of the ROI image
+
+    label_volumes : numpy.ndarray
+        Parcellation volumes stacked in an array of size [#scales, X, Y, Z]
+
+    maps : dict
+        Dictionary of ``(data, voxel size)`` tuples indexed by map name
+
+    compute_curvature : bool
+        If True, compute the mean curvature of each fiber
+
+    Returns
+    -------
+    chunk : dict
+        Dictionary with the ``endpointsmm``, ``labels``, ``inside``, ``length``,
+        ``curvature`` and ``point_offsets`` of the fibers of the chunk, the per-point ``samples`` and
+        per-fiber ``sample_means`` of each map and the number of fibers
+        discarded for each map (``n_discarded``)
+    """
+    n_chunk = len(offsets) - 1
+    fiber_ids = np.repeat(np.arange(n_chunk), np.diff(offsets))
+
+    endpointsmm = np.stack(
+        (points[offsets[:-1]], points[offsets[1:] - 1]), axis=1
+    ).astype(np.float64)
+    labels, inside = gather_endpoint_labels(
+        endpoints_mm_to_index(endpointsmm, voxelSize), label_volumes
+    )
+    chunk = {
+        "endpointsmm": endpointsmm,
+        "labels": labels.astype(np.int32),
+        "inside": inside,
+        "length": fiber_lengths(points, offsets),
+        "point_offsets": offsets[1:],
+        "samples": {},
+        "sample_means": {},
+        "n_discarded": {},
+    }
+
+    if compute_curvature:
+        chunk["curvature"] = np.array(
+            [mean_curvature(points[offsets[i]:offsets[i + 1]]) for i in range(n_chunk)]
+        )
+
+    # Voxel indices are computed once for all the maps sharing the same grid
+    voxels = {}
+    for k, (mdata, zooms) in maps.items():
+        grid = (tuple(zooms[:3]), mdata.shape[:3])
+        if grid not in voxels:
+            voxels[grid] = fiber_point_voxels(points, offsets, *grid)
+        valid, vox = voxels[grid]
+
+        val = np.full(len(points), np.nan, dtype=np.result_type(mdata.dtype, np.float32))
+        val[valid] = mdata[vox[:, 0], vox[:, 1], vox[:, 2]]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fiber_sum = np.bincount(fiber_ids[valid], weights=val[valid], minlength=n_chunk)
+            fiber_npts = np.bincount(fiber_ids[valid], minlength=n_chunk)
+            chunk["sample_means"][k] = fiber_sum / fiber_npts
+        chunk["n_discarded"][k] = np.count_nonzero((fiber_npts == 0) & (np.diff(offsets) > 0))
+        chunk["samples"][k] = val
+
+    return chunk
+
+
+def _share_array(array, fname):
+    """Return a reference to `array` that can be sent to a worker process without copying its data.
+
+    Arrays are stored in a ``.npy`` file unless they are already memory-mapped
+    from a raw file (see :func:`_open_shared_array`).
+    """
+    if isinstance(array, np.memmap) and array.offset == 0 and array.ndim == 1:
+        return array.filename, array.dtype.str
+    np.save(fname, array)
+    return op.abspath(fname)
+
+
+def _open_shared_array(ref):
+    """Open the memory-mapped array referenced by :func:`_share_array`."""
+    if isinstance(ref, tuple):
+        return np.memmap(ref[0], dtype=ref[1], mode="r")
+    return np.load(ref, mmap_mode="r")
+
+
+# Arguments shared by all the chunks processed in a worker process
+_chunk_worker_args = None
+
+
+def _init_chunk_worker(voxelSize, label_volumes_ref, map_refs, compute_curvature):
+    global _chunk_worker_args
+    maps = dict(
+        (k, (_open_shared_array(ref), zooms)) for k, (ref, zooms) in map_refs.items()
+    )
+    _chunk_worker_args = (
+        voxelSize, _open_shared_array(label_volumes_ref), maps, compute_curvature
+    )
+
+
+def _process_fiber_chunk_worker(points, offsets):
+    return process_fiber_chunk(points, offsets, *_chunk_worker_args)
+
+
+def scan_tractogram(
+    intrk,
+    voxelSize,
+    label_volumes=None,
+    maps=None,
+    compute_curvature=False,
+    chunk_size=None,
+    n_jobs=1,
+):
+    """Compute all the fiber-wise measures in a single pass over the tractogram.
+
+    Fibers are read by chunks (see :func:`load_fiber_chunks`) and each chunk
+    is released before reading the next one. The endpoints of the fibers are
+    labelled in all the parcellation volumes at once, such that all scales
+    share the same pass. Scalar maps are sampled at every point of the fibers.
+    Fibers with a point outside a map are discarded for this map and their
+    samples are set to NaN.
+
+    Parameters
+    ----------
+    intrk : TRK file
+        Input tractogram
+
+    voxelSize : 3-tuple
+        It contains the voxel size of the ROI image
+
+    label_volumes : numpy.ndarray
+        Parcellation volumes stacked in an array of size [#scales, X, Y, Z]
+
+    maps : dict
+        Dictionary of ``(data, voxel size)`` tuples indexed by map name
+
+    compute_curvature : bool
+        If True, compute the mean curvature of each fiber
+
+    chunk_size : int
+        Number of fibers per chunk. If None, the whole tractogram is loaded
+        in memory. Otherwise, samples of the scalar maps are stored in
+        memory-mapped scratch files (``fiber_samples_<map>.dat``) such that the
+        peak memory is bounded by the size of a chunk.
+
+    n_jobs : int
+        Number of worker processes in which the chunks are processed.
+        The ROI volumes and the maps are shared with the workers as
+        memory-mapped scratch files (``cmat_label_volumes.npy`` and
+        ``cmat_map_<map>.npy``). If `chunk_size` is None, the tractogram
+        is split into `n_jobs` chunks.
+
+    Returns
+    -------
+    fibers : dict
+        Dictionary with the fiber ``endpoints`` and ``endpointsmm``, the endpoint ``labels``
+        of size [#fibers, #scales, 2] and the ``inside`` mask (see :func:`gather_endpoint_labels`),
+        the fiber ``length``, the fiber ``curvature`` (if `compute_curvature`), the ``point_offsets``
+        delimiting the points of each fiber, the per-point ``samples`` of each map and the
+        per-fiber mean value ``sample_means`` of each map (NaN for discarded fibers)
+    """
+    if maps is None:
+        maps = {}
+    if label_volumes is None:
+        label_volumes = np.zeros((0, 1, 1, 1), dtype=np.int32)
+
+    endpointsmm = [np.zeros((0, 2, 3))]
+    labels = [np.zeros((0, label_volumes.shape[0], 2), dtype=np.int32)]
+    inside = [np.zeros(0, dtype=bool)]
+    lengths = [np.zeros(0, dtype=np.float64)]
+    curvatures = [np.zeros(0)]
+    point_offsets = [np.zeros(1, dtype=np.int64)]
+    samples = dict((k, []) for k in maps)
+    sample_means = dict((k, [np.zeros(0)]) for k in maps)
+    n_discarded = dict((k, 0) for k in maps)
+    sample_files = {}
+    if chunk_size is not None:
+        for k in maps:
+            sample_files[k] = open(op.abspath("fiber_samples_%s.dat" % k), "wb")
+
+    fiber_chunks = load_fiber_chunks(intrk, chunk_size)
+    scratch_files = []
+    if n_jobs > 1:
+        if chunk_size is None:
+            nb_streamlines = nib.streamlines.load(intrk, lazy_load=True).header["nb_streamlines"]
+            fiber_chunks = load_fiber_chunks(intrk, max(1, -(-nb_streamlines // n_jobs)))
+
+        label_volumes_ref = _share_array(label_volumes, "cmat_label_volumes.npy")
+        map_refs = dict(
+            (k, (_share_array(mdata, "cmat_map_%s.npy" % k), zooms))
+            for k, (mdata, zooms) in maps.items()
+        )
+        scratch_files = [label_volumes_ref] + [ref for ref, _ in map_refs.values()]
+
+        print("  ... INFO - Process fiber chunks with %i jobs" % n_jobs)
+        executor = ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_chunk_worker,
+            initargs=(voxelSize, label_volumes_ref, map_refs, compute_curvature),
+        )
+
+        def process_chunks():
+            # Bound the number of chunks in flight to bound the memory usage
+            pending = collections.deque()
+            for points, offsets in fiber_chunks:
+                pending.append(executor.submit(_process_fiber_chunk_worker, points, offsets))
+                del points, offsets
+                if len(pending) >= 2 * n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        chunks = process_chunks()
+    else:
+        chunks = (
+            process_fiber_chunk(points, offsets, voxelSize, label_volumes, maps, compute_curvature)
+            for points, offsets in fiber_chunks
+        )
+
+    n = 0
+    try:
+        for chunk in chunks:
+            endpointsmm.append(chunk["endpointsmm"])
+            labels.append(chunk["labels"])
+            inside.append(chunk["inside"])
+            lengths.append(chunk["length"])
+            if compute_curvature:
+                curvatures.append(chunk["curvature"])
+
+            n_chunk = len(chunk["length"])
+            for k in maps:
+                sample_means[k].append(chunk["sample_means"][k])
+                n_discarded[k] += chunk["n_discarded"][k]
+                if k in sample_files:
+                    sample_files[k].write(chunk["samples"][k].tobytes())
+                    samples[k] = chunk["samples"][k].dtype
+                else:
+                    samples[k].append(chunk["samples"][k])
+            point_offsets.append(chunk["point_offsets"] + point_offsets[-1][-1])
+
+            n += n_chunk
+            print("  ... INFO - %i fibers processed" % n)
+            del chunk
+    finally:
+        if n_jobs > 1:
+            executor.shutdown()
+            for scratch_fname in scratch_files:
+                if not isinstance(scratch_fname, tuple):
+                    os.remove(scratch_fname)
+
+    for k in maps:
+        if n_discarded[k] > 0:
+            print(
+                "  ... ERROR - Discard %i fibers with points outside the map when extracting "
+                "scalar values for measure %s" % (n_discarded[k], k)
+            )
+        if k in sample_files:
+            sample_files[k].close()
+            samples[k] = np.memmap(sample_files[k].name, dtype=samples[k], mode="r")
+        else:
+            samples[k] = np.concatenate(samples[k]) if len(samples[k]) > 0 else np.zeros(0)
+        sample_means[k] = np.concatenate(sample_means[k])
+
+    endpointsmm = np.concatenate(endpointsmm)
+    fibers = {
+        "endpoints": endpoints_mm_to_index(endpointsmm, voxelSize),
+        "endpointsmm": endpointsmm,
+        "labels": np.concatenate(labels),
+        "inside": np.concatenate(inside),
+        "length": np.concatenate(lengths),
+        "point_offsets": np.concatenate(point_offsets),
+        "samples": samples,
+        "sample_means": sample_means,
+    }
+    if compute_curvature:
+        fibers["curvature"] = np.concatenate(curvatures).reshape(-1, 1).astype(np.float64)
+    return fibers
+
+
+def gather_endpoint_labels(endpoints, label_volumes):
+    """Gather the labels of the fiber endpoints in a stack of parcellation volumes.
+
+    The labels of all fibers in all parcellation volumes are obtained
+    with a single fancy-index gather.
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        voxel index of its first and last point (see :func:`endpoints_mm_to_index`)
+
+    label_volumes : numpy.ndarray
+        Parcellation volumes stacked in an array of size [#scales, X, Y, Z]
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Matrix of size [#fibers, #scales, 2] containing the start and end ROI
+        labels of each fiber in each volume (0 for fibers outside the volume)
+
+    inside : numpy.ndarray
+        Boolean array of size [#fibers] which is False for the fibers
+        with an endpoint outside the volume
+    """
+    n = endpoints.shape[0]
+    vox = endpoints.astype(np.int64)
+    shape = np.array(label_volumes.shape[1:4], dtype=np.int64)
+
+    # Negative indices wrap around as with scalar indexing
+    inside = np.all((vox >= -shape) & (vox < shape), axis=(1, 2))
+    vox = vox[inside] % shape
+
+    labels = np.zeros((n, label_volumes.shape[0], 2), dtype=np.int64)
+    labels[inside] = np.moveaxis(
+        label_volumes[:, vox[:, :, 0], vox[:, :, 1], vox[:, :, 2]], 0, 1
+    ).astype(np.int64)
+
+    return labels, inside
+
+
+def filter_fiber_labels(labels, inside, nROIs):
+    """Filter the fibers given the labels of the ROIs in which they start and end.
+
+    Fibers are filtered with boolean masks:
+
+    * fibers with an endpoint outside the volume are discarded and keep
+      a ``[0, 0]`` label,
+    * fibers with an endpoint in an unlabeled voxel are orphans and get
+      a ``[-1, 0]`` label,
+    * fibers with an endpoint labeled higher than `nROIs` are discarded
+      and keep a ``[0, 0]`` label.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        Matrix of size [#fibers, 2] containing the start and end ROI labels
+        of each fiber (see :func:`gather_endpoint_labels`)
+
+    inside : numpy.ndarray
+        Boolean array of size [#fibers] which is False for the fibers
+        with an endpoint outside the volume
+
+    nROIs : int
+        Number of regions expected by the parcellation node information
+
+    Returns
+    -------
+    fiberlabels : numpy.ndarray
+        Matrix of size [#fibers, 2] containing the start and end ROI labels
+        of all fibers (with orphans)
+
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#valid fibers, 2] containing the start and end ROI labels
+        (start <= end) of the valid fibers
+
+    final_fibers_idx : numpy.ndarray
+        Indices of the valid fibers
+
+    n_orphans : int
+        Number of fibers that start or terminate in a voxel which is not labeled
+    """
+    n = labels.shape[0]
+    fiberlabels = np.zeros((n, 2))
+
+    orphans = inside & np.any(labels == 0, axis=1)
+    fiberlabels[orphans, 0] = -1
+
+    overlabeled = inside & ~orphans & np.any(labels > nROIs, axis=1)
+    valid = inside & ~orphans & ~overlabeled
+
+    n_outside = n - np.count_nonzero(inside)
+    if n_outside > 0:
+        print(" .. ERROR: Start or endpoint of %i fibers is outside the volume." % n_outside)
+        print("           Continue.")
+
+    n_overlabeled = np.count_nonzero(overlabeled)
+    if n_overlabeled > 0:
+        print(" .. ERROR: Start or endpoint of %i fibers terminate in a voxel which is labeled higher" % n_overlabeled)
+        print("           than is expected by the parcellation node information.")
+        print("           This needs bugfixing!")
+        print("           Continue.")
+
+    # Enforce startROI <= endROI
+    final_fiberlabels = np.sort(labels[valid], axis=1).astype(np.int32)
+    final_fibers_idx = np.flatnonzero(valid)
+    fiberlabels[final_fibers_idx] = final_fiberlabels
+
+    return fiberlabels, final_fiberlabels, final_fibers_idx, int(np.count_nonzero(orphans))
+
+
+def group_fibers_by_edge(final_fiberlabels):
+    """Group the valid fibers by the edge (pair of ROIs) they connect.
+
+    Fibers are grouped with a single sort over the packed ``(start, end)``
+    keys. Edges are ordered by first occurrence in the tractogram and the
+    fibers of each edge are stored contiguously in increasing order.
+
+    Parameters
+    ----------
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#valid fibers, 2] containing the start and end ROI labels
+        (start <= end) of the valid fibers
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the start and end ROI labels
+        of each edge
+
+    order : numpy.ndarray
+        Indices of the valid fibers sorted by edge
+
+    offsets : numpy.ndarray
+        Array of size [#edges + 1] such that the fibers of the k-th edge are
+        ``order[offsets[k]:offsets[k + 1]]``
+    """
+    labels = np.asarray(final_fiberlabels, dtype=np.int64).reshape(-1, 2)
+    keys = (labels[:, 0] << 32) | labels[:, 1]
+
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # Rank the edges by first occurrence
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    edge_ids = rank[inverse.reshape(-1)]
+
+    order = np.argsort(edge_ids, kind="stable")
+    offsets = np.zeros(len(first) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(edge_ids, minlength=len(first)))
+
+    return labels[np.sort(first)], order, offsets
+
+
+def _segment_nanstats(values, offsets):
+    """Compute the mean, median and standard deviation of contiguous segments of values.
+
+    NaN values are ignored, as with ``np.nanmean``, ``np.nanmedian`` and ``np.nanstd``.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        1D array of values where the k-th segment is ``values[offsets[k]:offsets[k + 1]]``
+
+    offsets : numpy.ndarray
+        Segment boundaries
+
+    Returns
+    -------
+    mean, median, std : numpy.ndarray
+        Statistics of each segment (NaN for segments without any valid value)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_seg = len(offsets) - 1
+    seg = np.repeat(np.arange(n_seg), np.diff(offsets))
+
+    valid = ~np.isnan(values)
+    counts = np.bincount(seg, weights=valid, minlength=n_seg)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(seg, weights=np.where(valid, values, 0.0), minlength=n_seg) / counts
+        dev = np.where(valid, values - mean[seg], 0.0)
+        std = np.sqrt(np.bincount(seg, weights=dev * dev, minlength=n_seg) / counts)
+
+    # Segmented median: sort values within each segment (NaN are sorted last)
+    sorted_values = values[np.lexsort((values, seg))]
+    k = counts.astype(np.int64)
+    last = max(len(values) - 1, 0)
+    lo = np.minimum(offsets[:-1] + np.maximum(k - 1, 0) // 2, last)
+    hi = np.minimum(offsets[:-1] + k // 2, last)
+    median = np.full(n_seg, np.nan)
+    has_values = k > 0
+    median[has_values] = (sorted_values[lo[has_values]] + sorted_values[hi[has_values]]) / 2.0
+
+    return mean, median, std
+
+
+def compute_edge_statistics(edges, offsets, fiberlength, roi_volumes, total_volume):
+    """Compute the connectivity measures of all edges in one vectorized pass.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the start and end ROI labels
+        of each edge (see :func:`group_fibers_by_edge`)
+
+    offsets : numpy.ndarray
+        Array of size [#edges + 1] delimiting the fibers of each edge
+        (see :func:`group_fibers_by_edge`)
+
+    fiberlength : numpy.ndarray
+        Length of the valid fibers, sorted by edge
+
+    roi_volumes : numpy.ndarray
+        Volume (number of voxels) of each ROI indexed by ROI label
+
+    total_volume : float
+        Total volume of the ROIs used for the normalized fiber density
+
+    Returns
+    -------
+    edge_stats : dict
+        Dictionary of arrays of size [#edges] indexed by measure name
+    """
+    counts = np.diff(offsets)
+    total_fibers = float(offsets[-1])
+
+    mean, median, std = _segment_nanstats(fiberlength, offsets)
+
+    edge_stats = {
+        "number_of_fibers": counts,
+        "fiber_length_mean": mean,
+        "fiber_length_median": median,
+        "fiber_length_std": std,
+        "fiber_proportion": 100.0 * (counts / total_fibers),
+    }
+
+    # Compute density
+    # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    roi_volumes = np.asarray(roi_volumes, dtype=np.float64)
+    edge_volume = roi_volumes[edges[:, 0]] + roi_volumes[edges[:, 1]]
+    has_length = mean > 0.0
+    fiber_density = np.zeros(len(counts))
+    normalized_fiber_density = np.zeros(len(counts))
+    fiber_density[has_length] = (counts[has_length] / mean[has_length]) * (
+        2.0 / edge_volume[has_length]
+    )
+    normalized_fiber_density[has_length] = (
+        (counts[has_length] / total_fibers) / mean[has_length]
+    ) * ((2.0 * float(total_volume)) / edge_volume[has_length])
+    edge_stats["fiber_density"] = fiber_density
+    edge_stats["normalized_fiber_density"] = normalized_fiber_density
+
+    return edge_stats
+
+
+def compute_edge_sample_statistics(samples, point_offsets, fibers_idx, offsets, batch_points=10000000):
+    """Compute the statistics of the scalar samples along the fibers of all edges.
+
+    The samples of the fibers of consecutive edges are gathered by batches of
+    at most `batch_points` points (and at least one edge) and reduced with
+    segmented reductions. NaN samples (fibers discarded for the map) are ignored.
 
     Parameters
     ----------
-    oldhdr : the tractogram header
-        Tractogram header to use as reference
+    samples : numpy.ndarray
+        Per-point samples of a scalar map (see :func:`scan_tractogram`).
+        It can be a ``numpy.memmap``.
+
+    point_offsets : numpy.ndarray
+        Array of size [#fibers + 1] delimiting the points of each fiber
+
+    fibers_idx : numpy.ndarray
+        Indices of the valid fibers sorted by edge
+
+    offsets : numpy.ndarray
+        Array of size [#edges + 1] delimiting the fibers of each edge in `fibers_idx`
+
+    batch_points : int
+        Maximal number of points gathered at once
+
+    Returns
+    -------
+    mean, median, std : numpy.ndarray
+        Statistics of the samples of each edge
+    """
+    n_edges = len(offsets) - 1
+    mean = np.full(n_edges, np.nan)
+    median = np.full(n_edges, np.nan)
+    std = np.full(n_edges, np.nan)
+
+    fiber_npts = point_offsets[fibers_idx + 1] - point_offsets[fibers_idx]
+    fiber_point_offsets = np.concatenate(([0], np.cumsum(fiber_npts)))
+    edge_point_offsets = fiber_point_offsets[offsets]
+
+    start = 0
+    while start < n_edges:
+        stop = np.searchsorted(
+            edge_point_offsets, edge_point_offsets[start] + batch_points, side="right"
+        ) - 1
+        stop = min(max(stop, start + 1), n_edges)
+
+        # Indices of the points of the fibers of the batch
+        batch = slice(offsets[start], offsets[stop])
+        npts = fiber_npts[batch]
+        shift = point_offsets[fibers_idx[batch]] - (fiber_point_offsets[batch] - fiber_point_offsets[offsets[start]])
+        idx = np.repeat(shift, npts) + np.arange(npts.sum())
+
+        (mean[start:stop], median[start:stop], std[start:stop]) = _segment_nanstats(
+            np.asarray(samples[idx]),
+            edge_point_offsets[start:stop + 1] - edge_point_offsets[start],
+        )
+        start = stop
+
+    return mean, median, std
+
 
-    oldfib : the fibers data
-        Input fibers
+def save_fibers(intrk, fname, indices):
+    """Stores a new trackvis file fname using only given indices.
+
+    The input tractogram is streamed such that fibers are written
+    one after the other without being loaded all in memory.
+
+    Parameters
+    ----------
+    intrk : TRK file
+        Input tractogram whose header is used as reference
 
     fname : string
         Output tractogram filename
@@ -144,18 +877,223 @@ def save_fibers(oldhdr, oldfib, fname, indices):
     indices : list
         Indices of fibers included
     """
+    trk = nib.streamlines.load(intrk, lazy_load=True)
 
-    hdrnew = oldhdr.copy()
+    keep = np.zeros(int(np.max(indices)) + 1 if len(indices) > 0 else 0, dtype=bool)
+    keep[np.asarray(indices, dtype=np.int64)] = True
 
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
+    def _selected_fibers():
+        for i, item in enumerate(trk.tractogram):
+            if i >= len(keep):
+                break
+            if keep[i]:
+                yield item
 
-    n_fib_out = len(outstreams)
-    hdrnew["n_count"] = n_fib_out
+    # Fibers of the lazily loaded tractogram are in RAS+ and mm space
+    tractogram = LazyTractogram.from_data_func(_selected_fibers)
+    tractogram.affine_to_rasmm = np.eye(4)
 
     print("Writing final no orphan fibers: %s" % fname)
-    nib.trackvis.write(fname, outstreams, hdrnew)
+    nib.streamlines.save(tractogram, fname, header=trk.header)
+
+
+def build_scale_connectome(
+    parkey,
+    parval,
+    roi_fname,
+    labels,
+    inside,
+    fiber_length,
+    point_offsets,
+    fiber_samples,
+    output_types,
+):
+    """Create and save the connection matrix of one resolution.
+
+    Parameters
+    ----------
+    parkey : str
+        Name of the resolution
+
+    parval : dict
+        Resolution description with the ``number_of_regions`` and
+        the ``node_information_graphml``
+
+    roi_fname : string
+        Parcellation volume of the resolution
+
+    labels : numpy.ndarray
+        Endpoint labels of the fibers at this resolution, of size [#fibers, 2]
+
+    inside : numpy.ndarray
+        Boolean array which is True for the fibers with both endpoints in the volume
+
+    fiber_length : numpy.ndarray
+        Length of each fiber
+
+    point_offsets : numpy.ndarray
+        Array of size [#fibers + 1] delimiting the points of each fiber
+
+    fiber_samples : dict
+        Per-point samples of each additional map (see :func:`scan_tractogram`)
+
+    output_types : ['gpickle','mat','graphml']
+
+    Returns
+    -------
+    final_fibers_idx : numpy.ndarray
+        Indices of the fibers kept in the connection matrix
+    """
+    n = len(inside)  # number of fibers
+
+    print("------------------------------------------------")
+    print("Resolution = " + parkey)
+    print("------------------------------------------------")
+
+    # Create the matrix
+    print(
+        "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
+    )
+
+    nROIs = parval["number_of_regions"]
+
+    # Add node information from parcellation
+    connectome = ConnectomeData.from_graphml(parval["node_information_graphml"])
+
+    # compute a position for the node based on the mean position of the
+    # ROI in voxel coordinates (segmentation volume )
+    node_stats = roi_stats(
+        roi_fname, labels=[int(roi_id) for roi_id in connectome.nodes["dn_multiscaleID"]]
+    )
+    roi_volume = node_stats["count"]
+    connectome.set_node_attribute("dn_position", node_stats["centroid"])
+    connectome.set_node_attribute("roi_volume", roi_volume)
+
+    print("  ************************")
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+    (fiberlabels, final_fiberlabels_array,
+     final_fibers_idx, dis) = filter_fiber_labels(
+        labels, inside, nROIs
+    )
+
+    # Discard the fibers with an endpoint in a labeled ROI that has no node
+    # in the parcellation node information, like the overlabeled ones
+    known = np.all(np.isin(final_fiberlabels_array, connectome.nodes["id"]), axis=1)
+    if not np.all(known):
+        missing = np.setdiff1d(final_fiberlabels_array[~known], connectome.nodes["id"])
+        print(" .. WARNING: Start or endpoint of %i fibers terminate in ROIs %s" % (np.count_nonzero(~known), missing.tolist()))
+        print("             that are not in the parcellation node information.")
+        print("             Continue.")
+        fiberlabels[final_fibers_idx[~known]] = 0
+        final_fiberlabels_array = final_fiberlabels_array[known]
+        final_fibers_idx = final_fibers_idx[known]
+
+    # Group fibers by edge in order of first occurrence
+    edges, order, offsets = group_fibers_by_edge(final_fiberlabels_array)
+    edge_fibers_idx = final_fibers_idx[order]
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / n, n) +
+        "that start or terminate in a voxel which is not labeled. (orphans)"
+    )
+    print(
+        "  ... INFO - Valid fibers: %i (%f percent)"
+        % (n - dis, 100 - dis * 100.0 / n)
+    )
+
+    # create a final fiber length array
+    final_fiberlength_array = fiber_length[final_fibers_idx]
+
+    # Edges go from the node that comes first in the graphml and are
+    # grouped by source node, in order of first occurrence
+    src = connectome.node_index(edges[:, 0])
+    dst = connectome.node_index(edges[:, 1])
+    src, dst = np.minimum(src, dst), np.maximum(src, dst)
+    edge_order = np.argsort(src, kind="stable")
+
+    # The total volume is the volume of the source nodes
+    total_volume = roi_volume[np.unique(src)].sum()
+
+    node_volumes = np.zeros(max(connectome.nodes["id"].max(), edges.max(initial=0)) + 1)
+    node_volumes[connectome.nodes["id"]] = roi_volume
+
+    # Compute the connectivity measures of all edges at once
+    edge_stats = compute_edge_statistics(
+        edges, offsets, final_fiberlength_array[order], node_volumes, total_volume
+    )
+
+    # Compute the statistics of the additional maps along the fibers of each edge
+    # This is indexed into the fibers that are valid in the sense of touching start
+    # and end roi and not going out of the volume
+    for k, samples in list(fiber_samples.items()):
+        mean, median, std = compute_edge_sample_statistics(
+            samples, point_offsets, edge_fibers_idx, offsets
+        )
+        edge_stats[k + "_mean"] = mean
+        edge_stats[k + "_std"] = std
+        edge_stats[k + "_median"] = median
+
+    # New connectivity measures can be added here
+    # FIXME treat case of self-connection that gives fiber_length_mean = 0.0
+    connectome.set_edges(
+        src[edge_order],
+        dst[edge_order],
+        dict((key, values[edge_order]) for key, values in edge_stats.items()),
+    )
+
+    print("  ************************************************")
+    print("  >> Save structural connectome maps as :")
+
+    # Storing network/graph in TSV format (by default to be BIDS compliant)
+    print("    - connectome_%s.tsv" % parkey)
+    connectome.write_tsv("connectome_%s.tsv" % parkey)
+
+    # Storing network/graph in other formats that might be prefered by the user
+    if "gpickle" in output_types:
+        print("    - connectome_%s.gpickle" % parkey)
+        nx.write_gpickle(connectome.to_networkx(), "connectome_%s.gpickle" % parkey)
+
+    if "mat" in output_types:
+        print("    - connectome_%s.mat" % parkey)
+        connectome.write_mat("connectome_%s.mat" % parkey, long_field_names=True)
+
+    if "graphml" in output_types:
+        print("    - connectome_%s.graphml" % parkey)
+        connectome.write_graphml(
+            "connectome_%s.graphml" % parkey, node_attributes=GRAPHML_NODE_ATTRIBUTES
+        )
+
+    # Storing final fiber length array
+    fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # Storing all fiber labels (with orphans)
+    fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
+    np.save(
+        fiberlabels_fname,
+        np.array(fiberlabels, dtype=np.int32),
+    )
+
+    # Storing final fiber labels (no orphans)
+    fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    return final_fibers_idx
+
+
+def _build_scale_connectome_worker(parkey, parval, i_scale, refs, output_types):
+    fiber_samples = dict((k, _open_shared_array(ref)) for k, ref in refs["samples"].items())
+    return build_scale_connectome(
+        parkey,
+        parval,
+        refs["roi_fnames"][i_scale],
+        _open_shared_array(refs["labels"])[:, i_scale],
+        _open_shared_array(refs["inside"]),
+        _open_shared_array(refs["length"]),
+        _open_shared_array(refs["point_offsets"]),
+        fiber_samples,
+        output_types,
+    )
 
 
 def cmat(
@@ -167,6 +1105,9 @@ def cmat(
     additional_maps=None,
     output_types=None,
     atlas_info=None,
+    streaming=False,
+    chunk_size=100000,
+    n_jobs=1,
 ):
     """Create the connection matrix for each resolution using fibers and ROIs.
 
@@ -194,6 +1135,17 @@ def cmat(
     atlas_info : dict
         Dictionary storing information such as path to files related to a
         parcellation atlas / scheme.
+
+    streaming : Boolean
+        If True, the tractogram is streamed by chunks of `chunk_size` fibers
+        instead of being loaded all in memory
+
+    chunk_size : int
+        Number of fibers per chunk in streaming mode
+
+    n_jobs : int
+        Number of worker processes used to process the fiber chunks and
+        to build the connection matrices of the different resolutions
     """
     if additional_maps is None:
         additional_maps = {}
@@ -213,32 +1165,30 @@ def cmat(
     en_fnamemm = "endpointsmm.npy"
     curv_fname = "meancurvature.npy"
 
-    fib, hdr = nib.trackvis.read(intrk, False)
-    n = len(fib)  # number of fibers
-
     if parcellation_scheme != "Custom":
-        if parcellation_scheme != "Lausanne2018":
-            resolutions = get_parcellation(parcellation_scheme)
-        else:
-            resolutions = get_parcellation(parcellation_scheme)
+        resolutions = get_parcellation(parcellation_scheme)
+        if parcellation_scheme == "Lausanne2018":
             for parkey, parval in list(resolutions.items()):
-                for vol, graphml in zip(roi_volumes, roi_graphmls):
-                    if parkey in vol:
-                        roi_fname = vol
+                for graphml in roi_graphmls:
                     if parkey in graphml:
                         roi_graphml_fname = graphml
 
-                roi = nib.load(roi_fname)
-                roiData = roi.get_data()
-                resolutions[parkey]["number_of_regions"] = roiData.max()
                 resolutions[parkey]["node_information_graphml"] = op.abspath(
                     roi_graphml_fname
                 )
-
-            del roi, roiData
     else:
         resolutions = atlas_info
 
+    # Open the ROI of each resolution:
+    # scale1 for lausanne2008/18
+    # first volume for nativefreesurfer
+    roi_fnames = []
+    for parkey in resolutions:
+        for vol in roi_volumes:
+            if (parkey in vol) or (len(roi_volumes) == 1):
+                roi_fname = vol
+        roi_fnames.append(roi_fname)
+
     # Previously, load_endpoints_from_trk() used the voxel size stored
     # in the track hdr to transform the endpoints to ROI voxel space.
     # This only works if the ROI voxel size is the same as the DSI/DTI
@@ -250,410 +1200,121 @@ def cmat(
     firstROI = nib.load(firstROIFile)
     roiVoxelSize = firstROI.get_header().get_zooms()
 
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+    # Stack the ROI volumes of all resolutions such that the fibers are
+    # labelled at all resolutions in a single pass over the tractogram
+    rois = [nib.load(roi_fname) for roi_fname in roi_fnames]
+    # Common dtype of all scales, such that the labels of a scale are not
+    # truncated to the range of the dtype of the first one
+    label_dtype = np.result_type(*[roi.get_data_dtype() for roi in rois])
+    label_volumes = np.zeros((len(rois),) + rois[0].shape[:3], dtype=label_dtype)
+    for i, (roi_fname, roi) in enumerate(zip(roi_fnames, rois)):
+        if roi.shape[:3] != label_volumes.shape[1:]:
+            raise ValueError(
+                "ROI volume %s does not have the same dimensions as %s" % (roi_fname, roi_fnames[0])
+            )
+        label_volumes[i] = roi.get_data()
+    del rois
+
+    if parcellation_scheme == "Lausanne2018":
+        for i, parkey in enumerate(resolutions):
+            resolutions[parkey]["number_of_regions"] = label_volumes[i].max()
+
+    mmap = additional_maps
+    mmapdata = {}
+    print("  >> Maps to be processed :")
+    for k, v in list(mmap.items()):
+        print("     - %s map" % k)
+        da = nib.load(v)
+        mdata = da.get_data()
+        print(mdata.max())
+        mdata = np.nan_to_num(mdata)
+        print(mdata.max())
+        mmapdata[k] = (mdata, da.get_header().get_zooms())
+
+    # Compute the endpoints, lengths, curvatures and scalar samples of all fibers
+    print("  ************************")
+    print("  >> Scan tractogram")
+    fibers = scan_tractogram(
+        intrk,
+        roiVoxelSize,
+        label_volumes=label_volumes,
+        maps=mmapdata,
+        compute_curvature=compute_curvature,
+        chunk_size=chunk_size if streaming else None,
+        n_jobs=n_jobs,
+    )
+    del mmapdata
+    endpoints = fibers["endpoints"]
+    point_offsets = fibers["point_offsets"]
+    fiber_samples = fibers["samples"]
+
     np.save(en_fname, endpoints)
-    np.save(en_fnamemm, endpointsmm)
+    np.save(en_fnamemm, fibers["endpointsmm"])
 
     # Only compute curvature if required
     if compute_curvature:
-        meancurv = compute_curvature_array(fib)
-        np.save(curv_fname, meancurv)
-
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        print("------------------------------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------------------------------")
-
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-
-        # Open the corresponding ROI:
-        # scale1 for lausanne2008/18
-        # first volume for nativefreesurfer
-        for vol in roi_volumes:
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-        roi = nib.load(roi_fname)
-        roiData = roi.get_data()
-
-        # Create the matrix
-        print(
-            "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
-        )
-
-        nROIs = parval["number_of_regions"]
-        G = nx.Graph()
-
-        # Add node information from parcellation
-        gp = nx.read_graphml(parval["node_information_graphml"])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            G.nodes[int(u)]["dn_position"] = tuple(
-                np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1)
-            )
-            G.nodes[int(u)]["roi_volume"] = np.sum(
-                roiData == int(d["dn_multiscaleID"])
-            )
-
-        dis = 0
-
-        # Prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-
-        mmap = additional_maps
-        mmapdata = {}
-        print("  >> Maps to be processed :")
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-
-        print("  ************************")
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-
-                # Endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(" .. ERROR: An index error occured for fiber %s. " % i)
-                print("           This means that the fiber start or endpoint is outside the volume. Continue.")
-                print("           Continue.")
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > nROIs or endROI > nROIs:
-                print(" .. ERROR: Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                print("           than is expected by the parcellation node information.")
-                print("           Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                print("           This needs bugfixing!")
-                print("           Continue.")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]["fiblist"].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
-
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / n, n) +
-            "that start or terminate in a voxel which is not labeled. (orphans)"
-        )
-        print(
-            "  ... INFO - Valid fibers: %i (%f percent)"
-            % (n - dis, 100 - dis * 100.0 / n)
-        )
-
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            finalfiberlength.append(length(fib[idx][0]))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d["fiblist"])
-            if u != u_old:
-                total_volume += G.nodes[int(u)]["roi_volume"]
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # Update edges
-        # New connectivity measures can be added here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            G_out.remove_edge(u, v)
-
-            if len(list(G[u][v].keys())) == 1:
-                di = {"number_of_fibers": len(G[u][v]["fiblist"])}
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(u))
-                        & (final_fiberlabels_array[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(v))
-                        & (final_fiberlabels_array[:, 1] == int(u))
-                    )[0]
-
-                di["fiber_length_mean"] = float(
-                    np.nanmean(final_fiberlength_array[idx])
+        np.save(curv_fname, fibers["curvature"])
+
+    # Storing the mean value of the additional maps along each fiber
+    for k, sample_mean in fibers["sample_means"].items():
+        np.save("fibers_mean_%s.npy" % k, sample_mean)
+
+    scale_jobs = min(n_jobs, len(resolutions))
+    if scale_jobs > 1:
+        # Connection matrices of all resolutions are built concurrently from
+        # memory-mapped copies of the fiber measures
+        print("  ... INFO - Build the connection matrices with %i jobs" % scale_jobs)
+        refs = {
+            "roi_fnames": roi_fnames,
+            "labels": _share_array(fibers["labels"], "cmat_fiber_labels.npy"),
+            "inside": _share_array(fibers["inside"], "cmat_fiber_inside.npy"),
+            "length": _share_array(fibers["length"], "cmat_fiber_length.npy"),
+            "point_offsets": _share_array(point_offsets, "cmat_point_offsets.npy"),
+            "samples": dict(
+                (k, _share_array(samples, "cmat_fiber_samples_%s.npy" % k))
+                for k, samples in fiber_samples.items()
+            ),
+        }
+        with ProcessPoolExecutor(max_workers=scale_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _build_scale_connectome_worker, parkey, parval, i_scale, refs, output_types
                 )
-                di["fiber_length_median"] = float(
-                    np.nanmedian(final_fiberlength_array[idx])
-                )
-                di["fiber_length_std"] = float(np.nanstd(final_fiberlength_array[idx]))
-
-                di["fiber_proportion"] = float(
-                    100.0 * (di["number_of_fibers"] / float(total_fibers))
-                )
-
-                # Compute density
-                # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-                if di["fiber_length_mean"] > 0.0:
-                    di["fiber_density"] = float(
-                        (float(di["number_of_fibers"]) / float(di["fiber_length_mean"]))
-                        * float(
-                            2.0
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
-                    )
-                    di["normalized_fiber_density"] = float(
-                        (
-                            (float(di["number_of_fibers"]) / float(total_fibers))
-                            / float(di["fiber_length_mean"])
-                        )
-                        * (
-                            (2.0 * float(total_volume))
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
-                    )
-                else:
-                    di["fiber_density"] = 0.0
-                    di["normalized_fiber_density"] = 0.0
-                # This is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(u)) & (fiberlabels[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(v)) & (fiberlabels[:, 1] == int(u))
-                    )[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure",
-                                k,
-                            )
-                            print(
-                                "  ... ERROR - Discard fiber with index ",
-                                i,
-                                "Exception: ",
-                                e,
-                            )
-
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-
-                        if k == "shore_rtop":
-                            di[k + "_mean"] = da.astype(np.float64).mean()
-                            di[k + "_std"] = da.astype(np.float64).std()
-                            di[k + "_median"] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + "_mean"] = da.mean().astype(np.float)
-                            di[k + "_std"] = da.std().astype(np.float)
-                            di[k + "_median"] = np.median(da).astype(np.float)
-
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-
-        del G
-
-        print("  ************************************************")
-        print("  >> Save structural connectome maps as :")
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            edge_keys = list(d.keys())
-            break
-
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print("    - connectome_%s.tsv" % parkey)
-        # Write header fields
-        with open("connectome_%s.tsv" % parkey, "w") as out_file:
-            tsv_writer = csv.writer(out_file, delimiter="\t")
-            header = ["source", "target"]
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-            nx.write_edgelist(
-                G_out,
-                out_file,
-                comments="#",
-                delimiter="\t",
-                data=edge_keys,
-                encoding="utf-8",
-            )
-
-        # Storing network/graph in other formats that might be prefered by the user
-        if "gpickle" in output_types:
-            print("    - connectome_%s.gpickle" % parkey)
-            nx.write_gpickle(G_out, "connectome_%s.gpickle" % parkey)
-
-        if "mat" in output_types:
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != "fiblist":
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = len(list(G_out.nodes(data=True)))
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
-
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == "dn_position":
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=np.object_)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    node_n += 1
-                node_struct[node_key] = node_arr
-            print("    - connectome_%s.mat" % parkey)
-            sio.savemat(
-                "connectome_%s.mat" % parkey,
-                long_field_names=True,
-                mdict={"sc": edge_struct, "nodes": node_struct},
+                for i_scale, (parkey, parval) in enumerate(list(resolutions.items()))
+            ]
+            for future in futures:
+                final_fibers_idx = future.result()
+        shared = [refs[key] for key in ["labels", "inside", "length", "point_offsets"]]
+        for ref in shared + list(refs["samples"].values()):
+            if not isinstance(ref, tuple):
+                os.remove(ref)
+    else:
+        for i_scale, (parkey, parval) in enumerate(list(resolutions.items())):
+            final_fibers_idx = build_scale_connectome(
+                parkey,
+                parval,
+                roi_fnames[i_scale],
+                fibers["labels"][:, i_scale],
+                fibers["inside"],
+                fibers["length"],
+                point_offsets,
+                fiber_samples,
+                output_types,
             )
 
-        if "graphml" in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-            print("    - connectome_%s.graphml" % parkey)
-            nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
-
-        # Storing final fiber length array
-        fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # Storing all fiber labels (with orphans)
-        fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
-        np.save(
-            fiberlabels_fname,
-            np.array(fiberlabels, dtype=np.int32),
-        )
-
-        # Storing final fiber labels (no orphans)
-        fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+    # The final tractogram keeps the valid fibers of the last resolution
+    if len(resolutions) > 0:
+        print("  > Filtering tractography - keeping only no orphan fibers")
+        finalfibers_fname = "streamline_final.trk"
+        save_fibers(intrk, finalfibers_fname, final_fibers_idx)
 
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = "streamline_final.trk"
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    # Clean up scratch files of streaming mode
+    scratch_files = [
+        samples.filename for samples in fiber_samples.values() if isinstance(samples, np.memmap)
+    ]
+    del fibers, fiber_samples
+    for scratch_fname in scratch_files:
+        os.remove(scratch_fname)
 
     print("Done.")
     print("========================")
@@ -691,6 +1352,22 @@ class DmriCmatInputSpec(BaseInterfaceInputSpec):
         desc="ProbtrackX connectivity matrices (# seed voxels x # target ROIs)",
     )
 
+    streaming = traits.Bool(
+        False,
+        desc="Stream the tractogram by chunks of fibers instead of loading it all in memory",
+        usedefault=True,
+    )
+
+    chunk_size = traits.Int(
+        100000, desc="Number of fibers per chunk in streaming mode", usedefault=True
+    )
+
+    n_jobs = traits.Int(
+        1,
+        desc="Number of processes used to process the fiber chunks and the resolutions",
+        usedefault=True,
+    )
+
 
 class DmriCmatOutputSpec(TraitedSpec):
     endpoints_file = File(desc="Numpy files storing the list of fiber endpoint")
@@ -713,6 +1390,10 @@ class DmriCmatOutputSpec(TraitedSpec):
         desc="Final tractogram of fibers considered in the creation of connectivity matrices"
     )
 
+    fibers_mean_files = OutputMultiPath(
+        File(), desc="List of mean value of the additional maps along each fiber"
+    )
+
     connectivity_matrices = OutputMultiPath(File(), desc="Connectivity matrices")
 
 
@@ -763,6 +1444,9 @@ class DmriCmat(BaseInterface):
             compute_curvature=self.inputs.compute_curvature,
             additional_maps=additional_maps,
             output_types=self.inputs.output_types,
+            streaming=self.inputs.streaming,
+            chunk_size=self.inputs.chunk_size,
+            n_jobs=self.inputs.n_jobs,
         )
 
         return runtime
@@ -781,11 +1465,154 @@ class DmriCmat(BaseInterface):
             os.path.abspath("final_fiberlabels*")
         )
         outputs["streamline_final_file"] = os.path.abspath("streamline_final.trk")
+        outputs["fibers_mean_files"] = glob.glob(os.path.abspath("fibers_mean_*"))
         outputs["connectivity_matrices"] = glob.glob(os.path.abspath("connectome*"))
 
         return outputs
 
 
+def roi_average_timeseries(bold, labels, n_rois):
+    """Compute the average time-series of all ROIs at once.
+
+    Voxels of the ROIs are read by blocks from the memory-mapped BOLD
+    data and summed with a sparse label-indicator matrix product.
+
+    Parameters
+    ----------
+    bold : cmtklib.functionalMRI.BoldData
+        4D fMRI data of size [X, Y, Z, #timepoints]
+
+    labels : numpy.ndarray
+        Parcellation volume of size [X, Y, Z]
+
+    n_rois : int
+        Number of ROIs (labels from 1 to `n_rois`)
+
+    Returns
+    -------
+    ts : numpy.ndarray
+        Matrix of size [#ROIs, #timepoints] with the average time-series
+        of each ROI (NaN for empty ROIs)
+    """
+    flat_labels = bold.flatten(labels).astype(np.int64)
+    voxels = np.flatnonzero((flat_labels >= 1) & (flat_labels <= n_rois))
+
+    ts = np.zeros((n_rois, bold.n_timepoints))
+    for idx, block in bold.iter_timeseries(voxels):
+        indicator = sparse.csr_matrix(
+            (np.ones(len(idx)), (flat_labels[idx] - 1, np.arange(len(idx)))),
+            shape=(n_rois, len(idx)),
+        )
+        ts += indicator @ block
+    counts = np.bincount(flat_labels[voxels] - 1, minlength=n_rois)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ts /= counts[:, np.newaxis]
+    return ts
+
+
+def ledoit_wolf_covariance(X):
+    """Estimate a covariance matrix with the Ledoit-Wolf shrinkage.
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        Matrix of size [#samples, #features]
+
+    Returns
+    -------
+    shrunk_cov : numpy.ndarray
+        Shrunk covariance matrix of size [#features, #features]
+
+    shrinkage : float
+        Coefficient of the convex combination between the empirical
+        covariance and the scaled identity matrix
+
+    References
+    ----------
+    O. Ledoit and M. Wolf, "A Well-Conditioned Estimator for Large-Dimensional
+    Covariance Matrices", Journal of Multivariate Analysis, 88(2):365-411, 2004.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    X = X - X.mean(axis=0)
+    n_samples, n_features = X.shape
+
+    emp_cov = X.T @ X / n_samples
+    mu = np.trace(emp_cov) / n_features
+
+    X2 = X ** 2
+    beta = (np.sum(X2.T @ X2) / n_samples - np.sum(emp_cov ** 2)) / (n_features * n_samples)
+    delta = np.sum((emp_cov - mu * np.eye(n_features)) ** 2) / n_features
+    beta = min(beta, delta)
+    shrinkage = 0.0 if beta == 0 else beta / delta
+
+    shrunk_cov = (1.0 - shrinkage) * emp_cov
+    shrunk_cov.flat[:: n_features + 1] += shrinkage * mu
+    return shrunk_cov, shrinkage
+
+
+def functional_connectivity(ts, fisher_z=False, partial_correlation=False, covariance=False):
+    """Compute the functional connectivity matrices of a set of ROI time-series.
+
+    All matrices are derived from the covariance matrix of the time-series,
+    computed once.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Matrix of size [#ROIs, #timepoints] of ROI time-series
+
+    fisher_z : bool
+        If True, add the Fisher z-transform of the correlation (``fisher_z``).
+        It is NaN on the diagonal.
+
+    partial_correlation : bool
+        If True, add the partial correlation (``partial_corr``) computed from
+        the precision matrix of the Ledoit-Wolf covariance estimate. ROIs with
+        a constant or undefined time-series are excluded (NaN).
+
+    covariance : bool
+        If True, add the covariance (``cov``)
+
+    Returns
+    -------
+    fc : dict
+        Dictionary of matrices of size [#ROIs, #ROIs] with the
+        Pearson's correlation (``corr``) and the optional measures
+    """
+    cov = np.cov(ts)
+    cov = np.atleast_2d(cov)
+    n_rois = cov.shape[0]
+    std = np.sqrt(np.diag(cov))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / std[:, np.newaxis] / std[np.newaxis, :]
+    # Clip to [-1, 1] as done by np.corrcoef
+    np.clip(corr, -1, 1, out=corr)
+    fc = {"corr": corr}
+
+    if fisher_z:
+        with np.errstate(divide="ignore"):
+            z = np.arctanh(corr)
+        z.flat[:: n_rois + 1] = np.nan
+        fc["fisher_z"] = z
+
+    if partial_correlation:
+        pcorr = np.full((n_rois, n_rois), np.nan)
+        valid = np.isfinite(std) & (std > 0)
+        if np.any(valid):
+            precision = np.linalg.inv(ledoit_wolf_covariance(ts[valid].T)[0])
+            d = np.sqrt(np.diag(precision))
+            pcorr_valid = -precision / d[:, np.newaxis] / d[np.newaxis, :]
+            pcorr_valid.flat[:: len(d) + 1] = 1.0
+            pcorr[np.ix_(valid, valid)] = pcorr_valid
+        fc["partial_corr"] = pcorr
+
+    if covariance:
+        fc["cov"] = cov
+
+    return fc
+
+
 class RsfmriCmatInputSpec(BaseInterfaceInputSpec):
     func_file = File(exists=True, mandatory=True, desc="fMRI volume")
 
@@ -817,6 +1644,18 @@ class RsfmriCmatInputSpec(BaseInterfaceInputSpec):
 
     DVARS_th = Float(desc="DVARS threshold")
 
+    fisher_z = Bool(
+        False, usedefault=True, desc="Add the Fisher z-transform of the correlation"
+    )
+
+    partial_correlation = Bool(
+        False,
+        usedefault=True,
+        desc="Add the partial correlation (Ledoit-Wolf estimate of the precision matrix)",
+    )
+
+    covariance = Bool(False, usedefault=True, desc="Add the covariance")
+
     output_types = traits.List(Str, desc="Output types of the connectivity matrices")
 
 
@@ -835,6 +1674,8 @@ class RsfmriCmat(BaseInterface):
 
     It applies scrubbing (if enabled), computes the average GM ROI time-series and computes
         the Pearson's correlation coefficient between each GM ROI time-series poir.
+        The Fisher z-transform of the correlation, the partial correlation and the
+        covariance can be added as extra edge metrics.
 
     Examples
     --------
@@ -869,8 +1710,7 @@ class RsfmriCmat(BaseInterface):
         print("   .. parcellation : %s" % self.inputs.parcellation_scheme)
         print("================================================")
 
-        fdata = nib.load(self.inputs.func_file).get_data()
-        tp = fdata.shape[3]
+        bold = BoldData(self.inputs.func_file)
 
         if self.inputs.parcellation_scheme != "Custom":
             if self.inputs.parcellation_scheme == "NativeFreesurfer":
@@ -912,11 +1752,7 @@ class RsfmriCmat(BaseInterface):
             nROIs = parval["number_of_regions"]  # number of ROIs for current resolution
 
             # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
-
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
+            ts = roi_average_timeseries(bold, mask, nROIs).astype(np.float32)
 
             # Save average roi time-series
             np.save(os.path.abspath("averageTimeseries_%s.npy" % parkey), ts)
@@ -925,19 +1761,13 @@ class RsfmriCmat(BaseInterface):
             # Create graph, add node information from parcellation and recover ROI indexes
             print("  ************************************************")
             print("  >> Load %s to initialize graph " % parval["node_information_graphml"])
-            G = nx.Graph()
-            gp = nx.read_graphml(parval["node_information_graphml"])
-            ROI_idx = []
-            for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
-                # Compute a position for the node based on the mean position of the
-                # ROI in voxel coordinates (segmentation volume )
-                G.nodes[int(u)]["dn_position"] = tuple(
-                    np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1)
-                )
-                ROI_idx.append(int(d["dn_multiscaleID"]))
+            connectome = ConnectomeData.from_graphml(parval["node_information_graphml"])
+            ROI_idx = np.array([int(roi_id) for roi_id in connectome.nodes["dn_multiscaleID"]], dtype=np.int64)
+            # Compute a position for the node based on the mean position of the
+            # ROI in voxel coordinates (segmentation volume )
+            connectome.set_node_attribute(
+                "dn_position", roi_stats(roi_fname, labels=ROI_idx)["centroid"]
+            )
 
             # Apply scrubbing (if enabled)
             if self.inputs.apply_scrubbing:
@@ -980,99 +1810,42 @@ class RsfmriCmat(BaseInterface):
             # Compute pairwise ROI time-series correlation
             print("  ************************************************")
             print("  >> Compute pairwise ROI time-series correlation")
-            nnodes = ts.shape[0]
-            i = -1
-            for i_signal in ts:
-                i += 1
-                for j in range(i, nnodes):
-                    j_signal = ts[j, :]
-                    value = np.corrcoef(i_signal, j_signal)[0, 1]
-                    G.add_edge(ROI_idx[i], ROI_idx[j])
-                    G[ROI_idx[i]][ROI_idx[j]]["corr"] = value
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                edge_keys = list(d.keys())
-                break
+            fc = functional_connectivity(
+                ts,
+                fisher_z=self.inputs.fisher_z,
+                partial_correlation=self.inputs.partial_correlation,
+                covariance=self.inputs.covariance,
+            )
+            src, dst = np.triu_indices(ts.shape[0])
+            connectome.set_edges(
+                connectome.node_index(ROI_idx[src]),
+                connectome.node_index(ROI_idx[dst]),
+                dict((key, mat[src, dst]) for key, mat in fc.items()),
+            )
 
             # Save the computed connectivity matrix
             print("  ************************************************")
             print("  >> Save functional connectome map as:")
 
             print("    - connectome_%s.tsv" % parkey)
-            with open("connectome_%s.tsv" % parkey, "w") as out_file:
-                tsv_writer = csv.writer(out_file, delimiter="\t")
-                header = ["source", "target"]
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-                nx.write_edgelist(
-                    G,
-                    out_file,
-                    comments="#",
-                    delimiter="\t",
-                    data=edge_keys,
-                    encoding="utf-8",
-                )
+            connectome.write_tsv("connectome_%s.tsv" % parkey)
 
             # storing network
             if "gpickle" in self.inputs.output_types:
                 print("    - connectome_%s.gpickle" % parkey)
-                nx.write_gpickle(G, "connectome_%s.gpickle" % parkey)
+                nx.write_gpickle(connectome.to_networkx(), "connectome_%s.gpickle" % parkey)
 
             if "mat" in self.inputs.output_types:
                 print("    - connectome_%s.mat" % parkey)
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
-
-                # Number of ROIs (nodes)
-                size_nodes = len(list(G.nodes()))
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == "dn_position":
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=np.object_)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat("connectome_%s.mat" % parkey, mdict={"sc": edge_struct, "nodes": node_struct})
+                connectome.write_mat("connectome_%s.mat" % parkey)
 
             if "graphml" in self.inputs.output_types:
                 print("    - connectome_%s.graphml" % parkey)
-                g2 = nx.Graph()
-                # Create graph nodes
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml)
-                    g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                    g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                    g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                    g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                    g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                    g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                    g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                    g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-                # Create graph edges
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml)
-                    g2[u_gml][v_gml]["corr"] = float(d_gml["corr"])
-                # Save the graph
-                nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
+                connectome.write_graphml(
+                    "connectome_%s.graphml" % parkey, node_attributes=GRAPHML_NODE_ATTRIBUTES
+                )
 
+        bold.close()
         print("[ DONE ]")
         return runtime
 
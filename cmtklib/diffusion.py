@@ -7,11 +7,12 @@
 """Module that defines CMTK utility functions for the diffusion pipeline."""
 
 import os
-import subprocess
 import pandas
 import nibabel as nib
+import networkx as nx
 import numpy as np
 import nibabel.trackvis as tv
+from scipy import ndimage
 
 from nipype.interfaces.base import (
     BaseInterface,
@@ -25,6 +26,7 @@ from nipype.interfaces.base import (
 from traits.trait_types import List, Str, Int, Enum
 
 from .util import length
+from .parcellation import label_set_mask
 
 
 def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
@@ -201,6 +203,106 @@ class FlipTable(BaseInterface):
         return outputs
 
 
+def spherical_kernel(radius, voxel_sizes):
+    """Return the footprint of the spherical kernel of ``fslmaths -kernel sphere``.
+
+    Parameters
+    ----------
+    radius : float
+        Radius of the sphere in mm
+
+    voxel_sizes : tuple
+        Voxel sizes in mm
+
+    Returns
+    -------
+    footprint : numpy.ndarray
+        Boolean footprint of the voxels within `radius` mm of the center
+    """
+    voxel_sizes = np.asarray(voxel_sizes[:3], dtype=np.float64)
+    half = np.floor(radius / voxel_sizes).astype(int)
+    grid = np.meshgrid(*[np.arange(-h, h + 1) * d for h, d in zip(half, voxel_sizes)], indexing="ij")
+    return np.sum([g * g for g in grid], axis=0) <= radius * radius
+
+
+def modal_dilation(data, footprint):
+    """Dilate an image like ``fslmaths -dilD``.
+
+    Each zero voxel with non-zero neighbours in the footprint takes the most
+    frequent of their values (the smallest one in case of ties). Non-zero voxels
+    are left unchanged.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    footprint : numpy.ndarray
+        Boolean footprint of the neighbourhood, centered
+
+    Returns
+    -------
+    dilated : numpy.ndarray
+        Dilated image
+    """
+    dilated = data.copy()
+    nonzero = data != 0
+    ind = np.nonzero(ndimage.binary_dilation(nonzero, structure=footprint) & ~nonzero)
+    if ind[0].size == 0:
+        return dilated
+
+    # Values of the neighbours, NaN for zero and out of image voxels
+    offsets = np.array(np.nonzero(footprint)) - (np.array(footprint.shape) // 2).reshape((-1, 1))
+    neighbours = np.full((ind[0].size, offsets.shape[1]), np.nan)
+    for k, offset in enumerate(offsets.T):
+        pos = [ind[a] + offset[a] for a in range(3)]
+        inside = np.all([(pos[a] >= 0) & (pos[a] < data.shape[a]) for a in range(3)], axis=0)
+        neighbours[inside, k] = data[tuple(p[inside] for p in pos)]
+    neighbours[neighbours == 0] = np.nan
+
+    # Most frequent value, the smallest one in case of ties (NaN sorted last never count)
+    neighbours.sort(axis=1)
+    counts = np.sum(neighbours[:, :, np.newaxis] == neighbours[:, np.newaxis, :], axis=2)
+    dilated[ind] = neighbours[np.arange(ind[0].size), np.argmax(counts, axis=1)]
+    return dilated
+
+
+def gaussian_mean_filter(data, sigma, voxel_sizes, cutoff=4.0):
+    """Smooth an image like ``fslmaths -kernel gauss <sigma> -fmean``.
+
+    The Gaussian kernel is truncated at `cutoff` standard deviations and
+    renormalized by its sum over the voxels inside the image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    sigma : float
+        Standard deviation of the Gaussian kernel in mm
+
+    voxel_sizes : tuple
+        Voxel sizes in mm
+
+    cutoff : float
+        Truncation of the kernel in number of standard deviations
+
+    Returns
+    -------
+    smoothed : numpy.ndarray
+        Smoothed image
+    """
+    smoothed = np.asarray(data, dtype=np.float64)
+    norm = np.ones(smoothed.shape)
+    for axis, voxel_size in enumerate(voxel_sizes[:3]):
+        half = int(np.ceil(sigma * cutoff / voxel_size))
+        x = np.arange(-half, half + 1) * voxel_size
+        weights = np.exp(-x * x / (2 * sigma * sigma))
+        smoothed = ndimage.correlate1d(smoothed, weights, axis=axis, mode="constant", cval=0.0)
+        norm = ndimage.correlate1d(norm, weights, axis=axis, mode="constant", cval=0.0)
+    return smoothed / norm
+
+
 class ExtractPVEsFrom5TTInputSpec(BaseInterfaceInputSpec):
     in_5tt = File(desc="Input 5TT (4D) image", exists=True, mandatory=True)
 
@@ -270,116 +372,48 @@ class ExtractPVEsFrom5TT(BaseInterface):
         #
         # Extract from https://mrtrix.readthedocs.io/en/latest/quantitative_structural_connectivity/act.html
 
-        # Create and save PVE for CSF
-        pve_csf = data_5tt[:, :, :, 3].squeeze()
-        pve_csf_img = nib.Nifti1Image(pve_csf.astype(np.float), affine)
-        nib.save(pve_csf_img, os.path.abspath(self.inputs.pve_csf_file))
-
-        # Create and save PVE for WM
-        pve_wm = data_5tt[:, :, :, 2].squeeze()
-        pve_wm_img = nib.Nifti1Image(pve_wm.astype(np.float), affine)
-        nib.save(pve_wm_img, os.path.abspath(self.inputs.pve_wm_file))
-
-        # Create and save PVE for GM
+        # PVEs for CSF, WM and GM
+        pve_csf = data_5tt[:, :, :, 3].squeeze().astype(np.float64)
+        pve_wm = data_5tt[:, :, :, 2].squeeze().astype(np.float64)
         pve_gm = data_5tt[:, :, :, 0].squeeze() + data_5tt[:, :, :, 1].squeeze()
-        pve_gm_img = nib.Nifti1Image(pve_gm.astype(np.float), affine)
-        nib.save(pve_gm_img, os.path.abspath(self.inputs.pve_gm_file))
 
         # Dilate PVEs and normalize to 1
+        # (in memory, as fslmaths -kernel sphere <radius> -dilD followed by -kernel gauss <sigma> -fmean)
         fwhm = 2.0
-        radius = np.float(0.5 * fwhm)
-        sigma = np.float(fwhm / 2.3548)
+        radius = 0.5 * fwhm
+        sigma = fwhm / 2.3548
 
         print("sigma : %s" % sigma)
 
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_csf_file),
-            radius,
-            os.path.abspath(self.inputs.pve_csf_file),
-        )
+        voxel_sizes = nib.affines.voxel_sizes(affine)
+        footprint = spherical_kernel(radius, voxel_sizes)
+
         print("Dilate CSF PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_wm_file),
-            radius,
-            os.path.abspath(self.inputs.pve_wm_file),
-        )
+        pve_csf = modal_dilation(pve_csf, footprint)
         print("Dilate WM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_gm_file),
-            radius,
-            os.path.abspath(self.inputs.pve_gm_file),
-        )
+        pve_wm = modal_dilation(pve_wm, footprint)
         print("Dilate GM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
+        pve_gm = modal_dilation(pve_gm, footprint)
 
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_csf_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_csf_file),
-        )
         print("Gaussian smoothing : CSF PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_wm_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_wm_file),
-        )
+        pve_csf = gaussian_mean_filter(pve_csf, sigma, voxel_sizes)
         print("Gaussian smoothing : WM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_gm_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_gm_file),
-        )
+        pve_wm = gaussian_mean_filter(pve_wm, sigma, voxel_sizes)
         print("Gaussian smoothing : GM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        pve_csf = nib.load(os.path.abspath(self.inputs.pve_csf_file)).get_data()
-        pve_wm = nib.load(os.path.abspath(self.inputs.pve_wm_file)).get_data()
-        pve_gm = nib.load(os.path.abspath(self.inputs.pve_gm_file)).get_data()
+        pve_gm = gaussian_mean_filter(pve_gm, sigma, voxel_sizes)
 
         pve_sum = pve_csf + pve_wm + pve_gm
         pve_csf = np.divide(pve_csf, pve_sum)
         pve_wm = np.divide(pve_wm, pve_sum)
         pve_gm = np.divide(pve_gm, pve_sum)
 
-        pve_csf_img = nib.Nifti1Image(pve_csf.astype(np.float), affine)
+        pve_csf_img = nib.Nifti1Image(pve_csf.astype(np.float32), affine)
         nib.save(pve_csf_img, os.path.abspath(self.inputs.pve_csf_file))
 
-        pve_wm_img = nib.Nifti1Image(pve_wm.astype(np.float), affine)
+        pve_wm_img = nib.Nifti1Image(pve_wm.astype(np.float32), affine)
         nib.save(pve_wm_img, os.path.abspath(self.inputs.pve_wm_file))
 
-        pve_gm_img = nib.Nifti1Image(pve_gm.astype(np.float), affine)
+        pve_gm_img = nib.Nifti1Image(pve_gm.astype(np.float32), affine)
         nib.save(pve_gm_img, os.path.abspath(self.inputs.pve_gm_file))
 
         return runtime
@@ -530,6 +564,37 @@ class FlipBvec(BaseInterface):
         return outputs
 
 
+GMWMI_SEEDING_STRUCTURES = ["thalamus", "hippocampus", "brainstem"]
+"""Structures (`dn_fsname` node attribute) added to the GM/WM interface for seeding."""
+
+
+def gmwmi_seeding_labels(roi_graphml, structures=None):
+    """Return the labels of the parcels to add to the GM/WM interface for seeding.
+
+    Parameters
+    ----------
+    roi_graphml : string
+        Path to the parcellation node description file in `graphml` format
+
+    structures : list of string
+        Structures (`dn_fsname` node attribute) of the parcels to select
+        (Default: :obj:`GMWMI_SEEDING_STRUCTURES`)
+
+    Returns
+    -------
+    labels : list of int
+        Labels of the selected parcels
+    """
+    if structures is None:
+        structures = GMWMI_SEEDING_STRUCTURES
+
+    labels = []
+    for node, d in nx.read_graphml(roi_graphml).nodes(data=True):
+        if d.get("dn_fsname") in structures:
+            labels.append(int(d.get("dn_multiscaleID", d.get("dn_correspondence_id", node))))
+    return labels
+
+
 class UpdateGMWMInterfaceSeedingInputSpec(BaseInterfaceInputSpec):
     in_gmwmi_file = File(
         exists=True,
@@ -545,6 +610,20 @@ class UpdateGMWMInterfaceSeedingInputSpec(BaseInterfaceInputSpec):
         File(exists=True), mandatory=True, desc="Input parcellation images"
     )
 
+    in_roi_graphmls = InputMultiPath(
+        File(exists=True),
+        mandatory=True,
+        desc="Input parcellation node description files in `graphml` format "
+             "(same order as `in_roi_volumes`)",
+    )
+
+    structures = List(
+        Str,
+        value=GMWMI_SEEDING_STRUCTURES,
+        usedefault=True,
+        desc="Structures (`dn_fsname` node attribute) of the parcels added to the interface",
+    )
+
 
 class UpdateGMWMInterfaceSeedingOutputSpec(TraitedSpec):
     out_gmwmi_file = File(
@@ -553,7 +632,12 @@ class UpdateGMWMInterfaceSeedingOutputSpec(TraitedSpec):
 
 
 class UpdateGMWMInterfaceSeeding(BaseInterface):
-    """Add extra Lausanne2018 structures to the Gray-matter/White-matter interface for tractography seeding.
+    """Add extra structures to the Gray-matter/White-matter interface for tractography seeding.
+
+    The parcels to add are the ones of the first scale whose structure
+    (`dn_fsname` node attribute of the `graphml` file) is listed in `structures`,
+    i.e. the thalamic nuclei, the hippocampal subfields and the brainstem
+    of Lausanne2018 by default. All parcels are set in a single pass over the volume.
 
     Examples
     --------
@@ -566,6 +650,11 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
     >>>                                       'sub-01_space-DWI_atlas-L2018_desc-scale3_dseg.nii.gz',
     >>>                                       'sub-01_space-DWI_atlas-L2018_desc-scale4_dseg.nii.gz',
     >>>                                       'sub-01_space-DWI_atlas-L2018_desc-scale5_dseg.nii.gz']
+    >>> update_gmwmi.inputs.in_roi_graphmls = ['sub-01_atlas-L2018_desc-scale1_dseg.graphml',
+    >>>                                        'sub-01_atlas-L2018_desc-scale2_dseg.graphml',
+    >>>                                        'sub-01_atlas-L2018_desc-scale3_dseg.graphml',
+    >>>                                        'sub-01_atlas-L2018_desc-scale4_dseg.graphml',
+    >>>                                        'sub-01_atlas-L2018_desc-scale5_dseg.graphml']
     >>> update_gmwmi.run()  # doctest: +SKIP
 
     """
@@ -579,64 +668,20 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
         gmwmi_data = gmwmi_img.get_data()
         maxv = gmwmi_data.max()
 
-        for fname in self.inputs.in_roi_volumes:
+        for i, fname in enumerate(self.inputs.in_roi_volumes):
             if ("scale1" in fname) or (len(self.inputs.in_roi_volumes) == 1):
                 roi_fname = fname
+                roi_graphml = self.inputs.in_roi_graphmls[i]
                 print("roi_fname: %s" % roi_fname)
 
+        labels = gmwmi_seeding_labels(roi_graphml, self.inputs.structures)
+        print("  > Add %i parcels to the GM/WM interface (%s)" % (len(labels), ", ".join(self.inputs.structures)))
+
         roi_img = nib.load(roi_fname)
         roi_data = roi_img.get_data()
 
         new_gmwmi_data = gmwmi_data.copy()
-
-        if roi_data.max() > 83:
-            # Thalamic nuclei
-            new_gmwmi_data[roi_data == 35] = maxv
-            new_gmwmi_data[roi_data == 36] = maxv
-            new_gmwmi_data[roi_data == 37] = maxv
-            new_gmwmi_data[roi_data == 38] = maxv
-            new_gmwmi_data[roi_data == 39] = maxv
-            new_gmwmi_data[roi_data == 40] = maxv
-            new_gmwmi_data[roi_data == 41] = maxv
-            new_gmwmi_data[roi_data == 96] = maxv
-            new_gmwmi_data[roi_data == 97] = maxv
-            new_gmwmi_data[roi_data == 98] = maxv
-            new_gmwmi_data[roi_data == 99] = maxv
-            new_gmwmi_data[roi_data == 100] = maxv
-            new_gmwmi_data[roi_data == 101] = maxv
-            new_gmwmi_data[roi_data == 102] = maxv
-
-            # Hippocampal subfields
-            new_gmwmi_data[roi_data == 48] = maxv
-            new_gmwmi_data[roi_data == 49] = maxv
-            new_gmwmi_data[roi_data == 50] = maxv
-            new_gmwmi_data[roi_data == 51] = maxv
-            new_gmwmi_data[roi_data == 52] = maxv
-            new_gmwmi_data[roi_data == 53] = maxv
-            new_gmwmi_data[roi_data == 54] = maxv
-            new_gmwmi_data[roi_data == 55] = maxv
-            new_gmwmi_data[roi_data == 56] = maxv
-            new_gmwmi_data[roi_data == 57] = maxv
-            new_gmwmi_data[roi_data == 58] = maxv
-            new_gmwmi_data[roi_data == 59] = maxv
-            new_gmwmi_data[roi_data == 109] = maxv
-            new_gmwmi_data[roi_data == 110] = maxv
-            new_gmwmi_data[roi_data == 111] = maxv
-            new_gmwmi_data[roi_data == 112] = maxv
-            new_gmwmi_data[roi_data == 113] = maxv
-            new_gmwmi_data[roi_data == 114] = maxv
-            new_gmwmi_data[roi_data == 115] = maxv
-            new_gmwmi_data[roi_data == 116] = maxv
-            new_gmwmi_data[roi_data == 117] = maxv
-            new_gmwmi_data[roi_data == 118] = maxv
-            new_gmwmi_data[roi_data == 119] = maxv
-            new_gmwmi_data[roi_data == 120] = maxv
-
-            # Brain stem
-            new_gmwmi_data[roi_data == 123] = maxv
-            new_gmwmi_data[roi_data == 124] = maxv
-            new_gmwmi_data[roi_data == 125] = maxv
-            new_gmwmi_data[roi_data == 126] = maxv
+        new_gmwmi_data[label_set_mask(roi_data, labels)] = maxv
 
         new_gmwmi_img = nib.Nifti1Pair(new_gmwmi_data, gmwmi_img.affine)
         nib.save(new_gmwmi_img, self.inputs.out_gmwmi_file)
@@ -647,3 +692,121 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
         outputs = self._outputs().get()
         outputs["out_gmwmi_file"] = os.path.abspath(self.inputs.out_gmwmi_file)
         return outputs
+
+
+SEEDING_STRATEGIES = ["stratified", "uniform"]
+"""Strategies of :func:`generate_seeds` to place the tractography seeds in the seed mask."""
+
+
+def seed_voxel_counts(weights, num_seeds, rng):
+    """Split a number of seeds between voxels proportionally to their weights.
+
+    Each voxel receives the integer part of its expected number of seeds and
+    the remaining seeds go to distinct voxels drawn with a probability
+    proportional to the fractional part of their expected number of seeds.
+
+    Parameters
+    ----------
+    weights : numpy.ndarray
+        Non-negative weights of the voxels
+
+    num_seeds : int
+        Total number of seeds
+
+    rng : numpy.random.Generator
+        Random number generator
+
+    Returns
+    -------
+    counts : numpy.ndarray
+        Number of seeds of each voxel, which sum to `num_seeds`
+    """
+    expected = num_seeds * weights / weights.sum()
+    counts = np.floor(expected).astype(np.int64)
+    remainder = num_seeds - int(counts.sum())
+    if remainder > 0:
+        fractions = expected - counts
+        candidates = np.flatnonzero(fractions > 0)
+        extra = rng.choice(candidates, size=remainder, replace=False,
+                           p=fractions[candidates] / fractions[candidates].sum())
+        counts[extra] += 1
+    return counts
+
+
+def generate_seeds(seed_mask, affine, num_seeds, strategy="stratified",
+                   weights=None, random_seed=None, batch_size=100000):
+    """Generate a given number of tractography seeds in a mask, in batches.
+
+    The seeds are placed at a uniformly random position in their voxel,
+    which spans +/- 0.5 voxel around the voxel center.
+
+    Parameters
+    ----------
+    seed_mask : numpy.ndarray
+        3D image in which voxels with a non-zero value are seeded
+
+    affine : numpy.ndarray
+        Voxel to RAS+mm affine of the seed mask
+
+    num_seeds : int
+        Exact number of seeds to generate
+
+    strategy : {"stratified", "uniform"}
+        With "stratified", the seeds are split between the voxels of the mask
+        in proportion to their weights and ordered by voxel. With "uniform",
+        each seed is placed in a voxel drawn independently with a probability
+        proportional to its weight
+
+    weights : numpy.ndarray
+        3D image such as a GM/WM interface or a probability map used to weight
+        the density of seeds in the voxels of the mask (Default: same weight
+        for all the voxels of the mask)
+
+    random_seed : int
+        Seed of the random number generator (Default: None)
+
+    batch_size : int
+        Maximal number of seeds per batch
+
+    Yields
+    ------
+    seeds : numpy.ndarray
+        Seed coordinates in RAS+mm space in an array of size [#seeds in the batch, 3]
+    """
+    if strategy not in SEEDING_STRATEGIES:
+        raise ValueError(f"Unknown seeding strategy {strategy} (Valid: {SEEDING_STRATEGIES})")
+
+    seed_mask = np.asarray(seed_mask) != 0
+    if weights is None:
+        weights = seed_mask.astype(np.float64)
+    else:
+        weights = np.where(seed_mask, np.clip(np.asarray(weights, dtype=np.float64), 0, None), 0)
+
+    # Voxels with a positive weight and their weights, in the order of the image
+    voxels = np.array(np.nonzero(weights > 0), dtype=np.float64).T
+    weights = weights[weights > 0]
+    if voxels.shape[0] == 0:
+        raise ValueError("No voxel of the seed mask has a positive weight")
+
+    # The voxels and the positions in the voxels are drawn from two independent
+    # generators, such that the seeds do not depend on `batch_size`
+    voxel_rng, jitter_rng = [
+        np.random.default_rng(s) for s in np.random.SeedSequence(random_seed).spawn(2)
+    ]
+    affine = np.asarray(affine, dtype=np.float64)
+    batch_size = max(1, batch_size)
+
+    if strategy == "stratified":
+        # Seed i is in voxel j such that cumsum(counts)[j - 1] <= i < cumsum(counts)[j]
+        ends = np.cumsum(seed_voxel_counts(weights, num_seeds, voxel_rng))
+    else:
+        probabilities = weights / weights.sum()
+
+    for start in range(0, num_seeds, batch_size):
+        n = min(batch_size, num_seeds - start)
+        if strategy == "stratified":
+            ind = np.searchsorted(ends, np.arange(start, start + n), side="right")
+        else:
+            ind = voxel_rng.choice(voxels.shape[0], size=n, p=probabilities)
+        coords = voxels[ind] + jitter_rng.uniform(-0.5, 0.5, size=(n, 3))
+        yield coords @ affine[:3, :3].T + affine[:3, 3]
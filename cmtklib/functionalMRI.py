@@ -8,7 +8,9 @@
 
 # General imports
 from traits.api import *
+import gzip
 import os
+import shutil
 import numpy as np
 import nibabel as nib
 import scipy.io as sio
@@ -20,6 +22,539 @@ from nipype.interfaces.base import (
 )
 
 
+# Approximate size in bytes of the blocks of voxel time-series loaded at once
+BOLD_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def _split_nifti_ext(fname):
+    """Return the path of `fname` without its ``.nii`` or ``.nii.gz`` extension."""
+    for ext in (".nii.gz", ".nii"):
+        if fname.endswith(ext):
+            return fname[: -len(ext)]
+    return os.path.splitext(fname)[0]
+
+
+def decompress_nifti(in_file, out_file=None):
+    """Decompress a ``.nii.gz`` image to an uncompressed scratch file.
+
+    The decompression is streamed and is skipped when an up-to-date
+    scratch file already exists.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the NIfTI image
+
+    out_file : str
+        Path of the uncompressed image. Defaults to the basename of
+        `in_file` with the ``_mmap.nii`` suffix in the current working directory
+
+    Returns
+    -------
+    out_file : str
+        Path to the uncompressed image (`in_file` if it is not compressed)
+    """
+    if not in_file.endswith(".gz"):
+        return in_file
+    if out_file is None:
+        out_file = os.path.abspath(
+            os.path.basename(_split_nifti_ext(in_file)) + "_mmap.nii"
+        )
+    if not (
+        os.path.exists(out_file)
+        and os.path.getmtime(out_file) >= os.path.getmtime(in_file)
+    ):
+        tmp_file = out_file + ".tmp"
+        with gzip.open(in_file, "rb") as f_in, open(tmp_file, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, length=16 * 1024 ** 2)
+        os.replace(tmp_file, out_file)
+    return out_file
+
+
+class BoldData(object):
+    """Memory-mapped access to the voxel time-series of a 4D BOLD image.
+
+    The image data is never loaded as a whole: voxel time-series are read
+    from a memory map of the uncompressed image in blocks of bounded size,
+    converted to float32 and scaled on the fly.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the 4D BOLD image. A compressed image (``.nii.gz``)
+        is decompressed once to a scratch file in the current working
+        directory, which is removed by :meth:`close`
+
+    chunk_bytes : int
+        Approximate size in bytes of the blocks of voxel time-series
+        loaded in memory at once (Default: `BOLD_CHUNK_BYTES`)
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import BoldData
+    >>> with BoldData('/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz') as bold:
+    >>>     voxels = bold.flat_index(mask)
+    >>>     for idx, ts in bold.iter_timeseries(voxels):
+    >>>         print(ts.shape)  # doctest: +SKIP
+
+    """
+
+    def __init__(self, in_file, chunk_bytes=BOLD_CHUNK_BYTES):
+        self.in_file = in_file
+        self.nii_file = decompress_nifti(in_file)
+        img = nib.load(self.nii_file, mmap=True)
+        self.affine = img.affine
+        self.header = img.header
+        self.shape = img.shape
+        self.n_timepoints = self.shape[3]
+        self.n_voxels = int(np.prod(self.shape[:3]))
+        self.chunk_voxels = max(1, int(chunk_bytes // (4 * self.n_timepoints)))
+        self._slope = img.dataobj.slope
+        self._inter = img.dataobj.inter
+        self._data = img.dataobj.get_unscaled()
+        # NIfTI data are stored in Fortran order: (voxels, T) is a view
+        self._voxels = self._data.reshape((self.n_voxels, self.n_timepoints), order="F")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the memory map and remove the decompressed scratch file."""
+        self._data = None
+        self._voxels = None
+        if self.nii_file != self.in_file and os.path.exists(self.nii_file):
+            os.remove(self.nii_file)
+
+    def _scale(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        if self._slope != 1.0:
+            data *= np.float32(self._slope)
+        if self._inter != 0.0:
+            data += np.float32(self._inter)
+        return data
+
+    def flat_index(self, mask):
+        """Return the flat indices of the voxels of a 3D mask.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Boolean (or non-zero) volume of size [X, Y, Z]
+
+        Returns
+        -------
+        voxels : numpy.ndarray
+            Flat indices of the voxels in the memory order of the BOLD data
+        """
+        return np.flatnonzero(np.asarray(mask).ravel(order="F"))
+
+    def flatten(self, volume):
+        """Flatten a 3D volume in the memory order of the BOLD data."""
+        return np.asarray(volume).ravel(order="F")
+
+    def timeseries(self, voxels):
+        """Return the time-series of a set of voxels.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat voxel indices (see :meth:`flat_index`)
+
+        Returns
+        -------
+        ts : numpy.ndarray
+            float32 matrix of size [#voxels, #timepoints]
+        """
+        return self._scale(self._voxels[voxels])
+
+    def iter_timeseries(self, voxels):
+        """Iterate over the time-series of a set of voxels in blocks of bounded size.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat voxel indices (see :meth:`flat_index`)
+
+        Yields
+        ------
+        idx : numpy.ndarray
+            Flat indices of the voxels of the block
+
+        ts : numpy.ndarray
+            float32 matrix of size [#idx, #timepoints]
+        """
+        for start in range(0, len(voxels), self.chunk_voxels):
+            idx = voxels[start: start + self.chunk_voxels]
+            yield idx, self.timeseries(idx)
+
+    def volume(self, t):
+        """Return the float32 volume of size [X, Y, Z] at time point `t`."""
+        return self._scale(self._data[..., t])
+
+    def mean_timeseries(self, voxels):
+        """Return the average time-series of a set of voxels.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat voxel indices (see :meth:`flat_index`)
+
+        Returns
+        -------
+        mean : numpy.ndarray
+            Vector of size [#timepoints]
+        """
+        total = np.zeros(self.n_timepoints)
+        for _, ts in self.iter_timeseries(voxels):
+            total += ts.sum(axis=0, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return total / len(voxels)
+
+    def create_output(self, out_file, n_timepoints=None, copy_data=False):
+        """Create a float32 4D image with the geometry of the BOLD data.
+
+        Parameters
+        ----------
+        out_file : str
+            Path to the output image (``.nii`` or ``.nii.gz``)
+
+        n_timepoints : int
+            Number of time points of the output image
+            (Default: same as the BOLD data)
+
+        copy_data : bool
+            If `True`, initialize the output with the BOLD data
+
+        Returns
+        -------
+        writer : BoldWriter
+            Writer of the output image
+        """
+        if n_timepoints is None:
+            n_timepoints = self.n_timepoints
+        writer = BoldWriter(out_file, self.header, self.shape[:3] + (n_timepoints,))
+        if copy_data:
+            for t in range(n_timepoints):
+                writer.write_volume(t, self.volume(t))
+        return writer
+
+
+class BoldWriter(object):
+    """Write a float32 4D image by blocks of voxel time-series or volumes.
+
+    The data is written to a memory map of an uncompressed scratch image,
+    which is compressed to `out_file` by :meth:`close` when the output
+    is a ``.nii.gz`` image.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output image (``.nii`` or ``.nii.gz``)
+
+    header : nibabel.Nifti1Header
+        Header (geometry, orientation and timing) from which
+        the output header is derived
+
+    shape : tuple
+        Shape [X, Y, Z, #timepoints] of the output image
+    """
+
+    def __init__(self, out_file, header, shape):
+        self.out_file = out_file
+        self.nii_file = _split_nifti_ext(out_file) + ".nii"
+        self.shape = tuple(int(s) for s in shape)
+        hdr = nib.Nifti1Header.from_header(header)
+        hdr.set_data_shape(self.shape)
+        hdr.set_data_dtype(np.float32)
+        hdr.set_slope_inter(1, 0)
+        hdr["vox_offset"] = 0
+        with open(self.nii_file, "wb") as f:
+            hdr.write_to(f)
+            offset = f.tell()
+            dtype = hdr.get_data_dtype()
+            f.truncate(offset + int(np.prod(self.shape)) * dtype.itemsize)
+        self._data = np.memmap(
+            self.nii_file,
+            dtype=dtype,
+            mode="r+",
+            offset=offset,
+            shape=self.shape,
+            order="F",
+        )
+        n_voxels = int(np.prod(self.shape[:3]))
+        self._voxels = self._data.reshape((n_voxels, self.shape[3]), order="F")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_timeseries(self, voxels, ts):
+        """Write the time-series of a set of voxels.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat voxel indices (see :meth:`BoldData.flat_index`)
+
+        ts : numpy.ndarray
+            Matrix of size [#voxels, #timepoints]
+        """
+        self._voxels[voxels] = ts
+
+    def write_volume(self, t, volume):
+        """Write the volume of size [X, Y, Z] at time point `t`."""
+        self._data[..., t] = volume
+
+    def close(self):
+        """Flush the data and compress the image to `out_file` if needed."""
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+        self._voxels = None
+        if self.nii_file != self.out_file:
+            # Same compression level as nibabel
+            with open(self.nii_file, "rb") as f_in, gzip.open(
+                self.out_file, "wb", compresslevel=1
+            ) as f_out:
+                shutil.copyfileobj(f_in, f_out, length=16 * 1024 ** 2)
+            os.remove(self.nii_file)
+
+
+def nuisance_projector(X, method="qr"):
+    """Compute an orthonormal basis of the space spanned by nuisance regressors.
+
+    The basis is computed once per run and shared by all voxels
+    (see :func:`regress_out`).
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        Design matrix of size [#timepoints, #regressors]
+
+    method : {"qr", "pinv"}
+        Use the QR factorization of `X` ("qr") or its singular value
+        decomposition ("pinv"), as done by the pseudo-inverse.
+        The singular value decomposition is always used for
+        rank-deficient design matrices.
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Matrix of size [#timepoints, rank(X)] with orthonormal columns
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    if method == "qr":
+        basis, r = np.linalg.qr(X)
+        # Rank deficiency shows as a negligible diagonal element of R,
+        # with the same tolerance as numpy.linalg.matrix_rank
+        diag = np.abs(np.diag(r))
+        if X.shape[0] >= X.shape[1] and np.all(
+            diag > diag.max(initial=0) * max(X.shape) * np.finfo(np.float64).eps
+        ):
+            return basis
+    u, s, _ = np.linalg.svd(X, full_matrices=False)
+    # Same cutoff as the pseudo-inverse used by statsmodels
+    return u[:, s > 1e-15 * s.max()]
+
+
+def regress_out(ts, basis):
+    """Return the residuals of the least-squares fit of time-series on nuisance regressors.
+
+    Equivalent to the residuals of a GLS fit with identity covariance
+    for each voxel, computed for all voxels at once.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Matrix of size [#voxels, #timepoints]
+
+    basis : numpy.ndarray
+        Orthonormal basis of the regressors returned by :func:`nuisance_projector`
+
+    Returns
+    -------
+    resid : numpy.ndarray
+        Matrix of size [#voxels, #timepoints]
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    return ts - (ts @ basis) @ basis.T
+
+
+def detrending_basis(n_timepoints, order=1, spline_knot_spacing=None):
+    """Build the basis of the trends removed from the fMRI time-series.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    order : int
+        Order of the trends, from 1 (linear) to 3 (cubic)
+
+    spline_knot_spacing : int
+        If not `None`, use a B-spline basis of degree `order` with
+        interior knots every `spline_knot_spacing` time points instead
+        of Legendre polynomials
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Matrix of size [#timepoints, #trends]. It spans the constant
+        term and all the polynomials of degree lower or equal to `order`.
+    """
+    if spline_knot_spacing is None:
+        x = np.linspace(-1, 1, n_timepoints)
+        return np.polynomial.legendre.legvander(x, order)
+
+    from scipy.interpolate import BSpline
+
+    x = np.arange(n_timepoints, dtype=np.float64)
+    interior = np.arange(spline_knot_spacing, n_timepoints - 1, spline_knot_spacing)
+    knots = np.concatenate(
+        ([x[0]] * (order + 1), interior, [x[-1]] * (order + 1))
+    ).astype(np.float64)
+    n_basis = len(knots) - order - 1
+    return BSpline(knots, np.eye(n_basis), order)(x)
+
+
+def framewise_displacement(move, head_radius=None):
+    """Compute the framewise displacement (FD) from head motion parameters.
+
+    Parameters
+    ----------
+    move : numpy.ndarray
+        Motion parameters of size [#timepoints, 6] (FSL MCFLIRT format:
+        3 rotations in radians followed by 3 translations in mm)
+
+    head_radius : float
+        If not `None`, compute the FD of Power et al. (2012): rotations
+        are converted to displacements in mm on a sphere of radius
+        `head_radius` mm. Otherwise, absolute differences of all
+        parameters are summed as they are
+
+    Returns
+    -------
+    fd : numpy.ndarray
+        Vector of size [#timepoints - 1] with the FD between
+        consecutive time points
+    """
+    delta = np.abs(np.diff(np.asarray(move, dtype=np.float64), axis=0))
+    if head_radius is not None:
+        delta[:, :3] *= head_radius
+    return delta.sum(axis=1)
+
+
+def dvars_metrics(bold, voxels):
+    """Compute DVARS, standardized DVARS and the global signal in one pass.
+
+    Standardized DVARS follows Nichols (2013): DVARS is divided by its
+    expected value, estimated from the robust standard deviation and
+    the lag-1 autocorrelation of each voxel time-series.
+
+    Parameters
+    ----------
+    bold : BoldData
+        BOLD data
+
+    voxels : numpy.ndarray
+        Flat indices of the voxels in the mask (see :meth:`BoldData.flat_index`)
+
+    Returns
+    -------
+    dvars : numpy.ndarray
+        Vector of size [#timepoints - 1] with the root mean square of the
+        temporal difference of the voxel time-series
+
+    dvars_std : numpy.ndarray
+        Vector of size [#timepoints - 1] with the standardized DVARS
+
+    global_signal : numpy.ndarray
+        Vector of size [#timepoints] with the average signal of the voxels
+    """
+    tp = bold.n_timepoints
+    sq_diff = np.zeros(tp - 1)
+    global_signal = np.zeros(tp)
+    diff_sd_sum = 0.0
+    n_diff_sd = 0
+    for _, ts in bold.iter_timeseries(voxels):
+        ts = ts.astype(np.float64)
+        sq_diff += np.square(np.diff(ts, axis=1)).sum(axis=0)
+        global_signal += ts.sum(axis=0)
+
+        # Robust standard deviation and lag-1 autocorrelation of each voxel
+        sd = np.subtract(*np.percentile(ts, [75, 25], axis=1)) / 1.349
+        ts -= ts.mean(axis=1, keepdims=True)
+        var = np.square(ts).sum(axis=1)
+        valid = (sd > 0) & (var > 0)
+        ar1 = (ts[valid, 1:] * ts[valid, :-1]).sum(axis=1) / var[valid]
+        diff_sd_sum += (np.sqrt(2 * (1 - ar1)) * sd[valid]).sum()
+        n_diff_sd += valid.sum()
+
+    dvars = np.sqrt(sq_diff / len(voxels))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dvars_std = dvars / (diff_sd_sum / n_diff_sd)
+    return dvars, dvars_std, global_signal / len(voxels)
+
+
+def _scrubbing_series(values):
+    """Return frame-to-frame differences in the layout of the scrubbing series.
+
+    Value at index i is the difference between time points i - 1 and i,
+    the first value is 0 and the last difference is not used.
+    """
+    series = np.zeros((len(values), 1))
+    series[1:, 0] = values[:-1]
+    return series
+
+
+def bandpass_basis(n_timepoints, tr, highpass=0.0, lowpass=0.0):
+    """Build the Fourier basis of the frequencies rejected by an ideal band-pass filter.
+
+    Projecting the time-series out of this basis is equivalent to
+    zeroing their Fourier coefficients outside [`highpass`, `lowpass`].
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    tr : float
+        Repetition time in seconds
+
+    highpass : float
+        Frequencies (in Hz) below `highpass` are removed
+        (no high-pass filtering if 0)
+
+    lowpass : float
+        Frequencies (in Hz) above `lowpass` are removed
+        (no low-pass filtering if 0)
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Matrix of size [#timepoints, #rejected_frequency_components]
+    """
+    freqs = np.fft.rfftfreq(n_timepoints, d=tr)
+    reject = np.zeros(len(freqs), dtype=bool)
+    if highpass > 0:
+        reject |= freqs < highpass
+    if lowpass > 0:
+        reject |= freqs > lowpass
+    k = np.flatnonzero(reject)
+    phase = 2 * np.pi * np.outer(np.arange(n_timepoints), k) / n_timepoints
+    # The sine of the constant and Nyquist frequencies is null
+    sin_k = (k > 0) & (2 * k != n_timepoints)
+    return np.hstack((np.cos(phase), np.sin(phase[:, sin_k])))
+
+
 class DiscardTPInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
 
@@ -48,25 +583,15 @@ class DiscardTP(BaseInterface):
     output_spec = DiscardTPOutputSpec
 
     def _run_interface(self, runtime):
-        dataimg = nib.load(self.inputs.in_file)
-        data = dataimg.get_data()
-
         n_discard = int(self.inputs.n_discard) - 1
 
-        new_data = data.copy()
-        new_data = new_data[:, :, :, n_discard:-1]
-
-        hd = dataimg.get_header()
-        hd.set_data_shape(
-            [
-                hd.get_data_shape()[0],
-                hd.get_data_shape()[1],
-                hd.get_data_shape()[2],
-                hd.get_data_shape()[3] - n_discard - 1,
-            ]
-        )
-        img = nib.Nifti1Image(new_data, dataimg.get_affine(), hd)
-        nib.save(img, os.path.abspath("fMRI_discard.nii.gz"))
+        with BoldData(self.inputs.in_file) as bold:
+            tp = bold.n_timepoints - n_discard - 1
+            with bold.create_output(
+                os.path.abspath("fMRI_discard.nii.gz"), n_timepoints=tp
+            ) as out:
+                for t in range(tp):
+                    out.write_volume(t, bold.volume(n_discard + t))
         return runtime
 
     def _list_outputs(self):
@@ -104,6 +629,13 @@ class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
         desc="Number of volumes discarded from the fMRI sequence during preprocessing"
     )
 
+    regression_method = Enum(
+        ["qr", "pinv"],
+        usedefault=True,
+        desc="Factorization of the design matrix used to regress out "
+        "the nuisance signals (QR or pseudo-inverse)",
+    )
+
 
 class NuisanceRegressionOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Output fMRI Volume")
@@ -156,13 +688,12 @@ class NuisanceRegression(BaseInterface):
         ref_path = self.inputs.in_file
 
         # Extract whole brain average signal
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
+        bold = BoldData(ref_path)
+        tp = bold.n_timepoints
         if self.inputs.global_nuisance:
             brainfile = self.inputs.brainfile  # load eroded whole brain mask
             brain = nib.load(brainfile).get_data().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
+            global_values = bold.mean_timeseries(bold.flat_index(brain == 1))
             global_values = global_values - np.mean(global_values)
             np.save(os.path.abspath("averageGlobal.npy"), global_values)
             sio.savemat(
@@ -173,7 +704,7 @@ class NuisanceRegression(BaseInterface):
         if self.inputs.csf_nuisance:
             csffile = self.inputs.csf_file  # load eroded CSF mask
             csf = nib.load(csffile).get_data().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
+            csf_values = bold.mean_timeseries(bold.flat_index(csf == 1))
             csf_values = csf_values - np.mean(csf_values)
             np.save(os.path.abspath("averageCSF.npy"), csf_values)
             sio.savemat(os.path.abspath("averageCSF.mat"), {"avgCSF": csf_values})
@@ -182,7 +713,7 @@ class NuisanceRegression(BaseInterface):
         if self.inputs.wm_nuisance:
             WMfile = self.inputs.wm_file  # load eroded WM mask
             WM = nib.load(WMfile).get_data().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
+            wm_values = bold.mean_timeseries(bold.flat_index(WM == 1))
             wm_values = wm_values - np.mean(wm_values)
             np.save(os.path.abspath("averageWM.npy"), wm_values)
             sio.savemat(os.path.abspath("averageWM.mat"), {"avgWM": wm_values})
@@ -222,11 +753,12 @@ class NuisanceRegression(BaseInterface):
                 move = np.hstack((move, move_der2_sq))
 
         # GLM: regress out nuisance covariates
-        new_data = data.copy()
-
         # s = gconf.parcellation.keys()[0]
 
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+        # GM mask covering the ROIs of all parcellation scales
+        gm = np.zeros(bold.shape[:3], dtype=bool)
+        for gm_file in self.inputs.gm_file:
+            gm |= nib.load(gm_file).get_data() > 0
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
@@ -285,24 +817,18 @@ class NuisanceRegression(BaseInterface):
             X = move
             print("> Detrend motion average signals")
 
-        import statsmodels.api as sm
-
-        X = sm.add_constant(X)
+        X = np.column_stack((np.ones(tp), X))
         # print('Shape X GLM')
         # print(X.shape)
+        basis = nuisance_projector(X, method=self.inputs.regression_method)
 
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[
-                index[0], index[1], index[2], :
-            ] = gls_results.resid  # + gls_results.params[8]
-
-        img = nib.Nifti1Image(new_data, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath("fMRI_nuisance.nii.gz"))
+        # Regress out the nuisance signals from all GM voxels at once,
+        # voxels outside GM are copied unchanged
+        with bold, bold.create_output(
+            os.path.abspath("fMRI_nuisance.nii.gz"), copy_data=True
+        ) as out:
+            for idx, ts in bold.iter_timeseries(bold.flat_index(gm)):
+                out.write_timeseries(idx, regress_out(ts, basis))
 
         return runtime
 
@@ -330,6 +856,13 @@ class DetrendingInputSpec(BaseInterfaceInputSpec):
 
     mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
 
+    spline_knot_spacing = Int(
+        1000,
+        usedefault=True,
+        desc="Number of time points between two knots of the B-spline basis "
+        "used by the cubic detrending",
+    )
+
 
 class DetrendingOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Detrended fMRI volume")
@@ -358,70 +891,37 @@ class Detrending(BaseInterface):
     output_spec = DetrendingOutputSpec
 
     def _run_interface(self, runtime):
-        print("Linear detrending")
-        print("=================")
-
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        # Load data
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
-
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
         gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
 
-        from scipy import signal
-
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
-
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0
-            )
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
-
-        img = nib.Nifti1Image(new_data_det, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
-
-        if self.inputs.mode == "quadratic":
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2
+        with BoldData(ref_path) as bold:
+            if self.inputs.mode == "quadratic":
+                print("Quadratic detrending")
+                print("=================")
+                trends = detrending_basis(bold.n_timepoints, order=2)
+            elif self.inputs.mode == "cubic":
+                print("Cubic-spline detrending")
+                print("=================")
+                trends = detrending_basis(
+                    bold.n_timepoints,
+                    order=3,
+                    spline_knot_spacing=self.inputs.spline_knot_spacing,
                 )
-
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header()
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
-
-        if self.inputs.mode == "cubic":
-            print("Cubic-spline detrending")
-            print("=================")
-            from obspy.signal.detrend import spline
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(new_data_det2[index[0], index[1], index[2], :], order=3)
-
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header()
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
+            else:
+                print("Linear detrending")
+                print("=================")
+                trends = detrending_basis(bold.n_timepoints, order=1)
+            basis = nuisance_projector(trends)
+
+            # Remove the trends from all GM voxels at once,
+            # voxels outside GM are copied unchanged
+            with bold.create_output(
+                os.path.abspath("fMRI_detrending.nii.gz"), copy_data=True
+            ) as out:
+                for idx, ts in bold.iter_timeseries(bold.flat_index(gm)):
+                    out.write_timeseries(idx, regress_out(ts, basis))
 
         print("[ DONE ]")
         return runtime
@@ -445,6 +945,13 @@ class ScrubbingInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="Motion parameters from preprocessing stage"
     )
 
+    head_radius = Float(
+        50.0,
+        usedefault=True,
+        desc="Head radius in mm used to convert rotations to displacements "
+        "in the FD of Power et al. (2012)",
+    )
+
 
 class ScrubbingOutputSpec(TraitedSpec):
     fd_mat = File(exists=True, desc="FD matrix for scrubbing")
@@ -455,10 +962,25 @@ class ScrubbingOutputSpec(TraitedSpec):
 
     dvars_npy = File(exists=True, desc="DVARS in .npy format")
 
+    fd_power_mat = File(exists=True, desc="FD of Power et al. (2012) matrix")
+
+    fd_power_npy = File(exists=True, desc="FD of Power et al. (2012) in .npy format")
+
+    dvars_std_mat = File(exists=True, desc="Standardized DVARS matrix")
+
+    dvars_std_npy = File(exists=True, desc="Standardized DVARS in .npy format")
+
+    global_signal_mat = File(exists=True, desc="Global signal matrix")
+
+    global_signal_npy = File(exists=True, desc="Global signal in .npy format")
+
 
 class Scrubbing(BaseInterface):
     """Computes scrubbing parameters: `FD` and `DVARS`.
 
+    The FD of Power et al. (2012), the standardized DVARS and the
+    global signal of the WM and GM mask are saved as well.
+
     Examples
     --------
     >>> from cmtklib.functionalMRI import Scrubbing
@@ -488,43 +1010,31 @@ class Scrubbing(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_data().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         mask = WM + GM
         move = np.genfromtxt(self.inputs.motion_parameters)
 
-        # initialize motion measures
-        FD = np.zeros((tp - 1, 1))
-        DVARS = np.zeros((tp - 1, 1))
-
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in range(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
-
-        np.save(os.path.abspath("FD.npy"), FD)
-        np.save(os.path.abspath("DVARS.npy"), DVARS)
-        sio.savemat(os.path.abspath("FD.mat"), {"FD": FD})
-        sio.savemat(os.path.abspath("DVARS.mat"), {"DVARS": DVARS})
+        with BoldData(ref_path) as bold:
+            tp = bold.n_timepoints
+            dvars, dvars_std, global_signal = dvars_metrics(
+                bold, bold.flat_index(mask > 0)
+            )
+        fd = framewise_displacement(move[:tp])
+        fd_power = framewise_displacement(move[:tp], head_radius=self.inputs.head_radius)
+
+        metrics = {
+            "FD": _scrubbing_series(fd),
+            "DVARS": _scrubbing_series(dvars),
+            "FD_power": _scrubbing_series(fd_power),
+            "DVARS_std": _scrubbing_series(dvars_std),
+            "global_signal": global_signal,
+        }
+
+        for name, values in metrics.items():
+            np.save(os.path.abspath("%s.npy" % name), values)
+            sio.savemat(os.path.abspath("%s.mat" % name), {name: values})
 
         print("[ DONE ]")
         return runtime
@@ -535,4 +1045,275 @@ class Scrubbing(BaseInterface):
         outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        outputs["fd_power_mat"] = os.path.abspath("FD_power.mat")
+        outputs["fd_power_npy"] = os.path.abspath("FD_power.npy")
+        outputs["dvars_std_mat"] = os.path.abspath("DVARS_std.mat")
+        outputs["dvars_std_npy"] = os.path.abspath("DVARS_std.npy")
+        outputs["global_signal_mat"] = os.path.abspath("global_signal.mat")
+        outputs["global_signal_npy"] = os.path.abspath("global_signal.npy")
+        return outputs
+
+
+class DenoiseBOLDInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume to denoise")
+
+    gm_file = InputMultiPath(
+        File(exists=True), mandatory=True, desc="ROI volumes registered to fMRI space"
+    )
+
+    brainfile = File(desc="Eroded brain mask registered to fMRI space")
+
+    csf_file = File(desc="Eroded CSF mask registered to fMRI space")
+
+    wm_file = File(desc="WM mask registered to fMRI space")
+
+    motion_file = File(desc="Motion parameters from preprocessing stage")
+
+    detrending = Bool(True, usedefault=True, desc="If `True` perform detrending")
+
+    detrending_mode = Enum(
+        ["linear", "quadratic", "cubic"], usedefault=True, desc="Detrending order"
+    )
+
+    spline_knot_spacing = Int(
+        1000,
+        usedefault=True,
+        desc="Number of time points between two knots of the B-spline basis "
+        "used by the cubic detrending",
+    )
+
+    global_nuisance = Bool(desc="If `True` perform global nuisance regression")
+
+    csf_nuisance = Bool(desc="If `True` perform CSF nuisance regression")
+
+    wm_nuisance = Bool(desc="If `True` perform WM nuisance regression")
+
+    motion_nuisance = Bool(desc="If `True` perform motion nuisance regression")
+
+    bandpass_filtering = Bool(desc="If `True` perform bandpass filtering")
+
+    highpass = Float(0.01, usedefault=True, desc="High-pass cutoff frequency in Hz")
+
+    lowpass = Float(0.1, usedefault=True, desc="Low-pass cutoff frequency in Hz")
+
+    filter_type = Enum(
+        ["fft", "butterworth"],
+        usedefault=True,
+        desc="Ideal FFT filter, removed with the other confounds in a single "
+        "projection, or zero-phase Butterworth filter applied afterwards",
+    )
+
+    butterworth_order = Int(2, usedefault=True, desc="Order of the Butterworth filter")
+
+    scrubbing = Bool(desc="If `True` compute FD and DVARS for scrubbing")
+
+    save_intermediates = Bool(
+        False,
+        usedefault=True,
+        desc="If `True` also save the detrended and the nuisance regressed volumes",
+    )
+
+
+class DenoiseBOLDOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Denoised fMRI volume")
+
+    detrending_file = File(desc="Detrended fMRI volume")
+
+    nuisance_file = File(desc="Detrended and nuisance regressed fMRI volume")
+
+    fd_mat = File(desc="FD matrix for scrubbing")
+
+    dvars_mat = File(desc="DVARS matrix for scrubbing")
+
+    fd_npy = File(desc="FD in .npy format")
+
+    dvars_npy = File(desc="DVARS in .npy format")
+
+
+class DenoiseBOLD(BaseInterface):
+    """Detrend, regress out nuisance signals and band-pass filter the Functional MRI signal in one pass.
+
+    The BOLD data is decompressed and memory-mapped once. The trends,
+    the nuisance signals and (for the FFT filter) the rejected frequencies
+    are removed from all GM voxels with a single least-squares projection,
+    and only the final volume is written.
+
+    Only the GM voxels, covered by the ROI volumes of `gm_file`, are denoised.
+    Unlike ``3dBandpass``, which filtered the whole volume, the voxels outside
+    GM are copied through unchanged, without detrending or filtering.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import DenoiseBOLD
+    >>> denoise = DenoiseBOLD()
+    >>> denoise.inputs.base_dir = '/my_directory'
+    >>> denoise.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> denoise.inputs.gm_file = ['/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale1_dseg.nii.gz',
+    >>>                           '/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale2_dseg.nii.gz',
+    >>>                           '/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale3_dseg.nii.gz',
+    >>>                           '/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale4_dseg.nii.gz',
+    >>>                           '/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale5_dseg.nii.gz']
+    >>> denoise.inputs.csf_file = '/path/to/sub-01_space-meanBOLD_desc-eroded_label-CSF_dseg.nii.gz'
+    >>> denoise.inputs.wm_file = '/path/to/sub-01_space-meanBOLD_label-WM_dseg.nii.gz'
+    >>> denoise.inputs.motion_file = '/path/to/sub-01_motions.par'
+    >>> denoise.inputs.detrending_mode = 'linear'
+    >>> denoise.inputs.csf_nuisance = True
+    >>> denoise.inputs.wm_nuisance = True
+    >>> denoise.inputs.motion_nuisance = True
+    >>> denoise.inputs.bandpass_filtering = True
+    >>> denoise.inputs.scrubbing = True
+    >>> denoise.run()  # doctest: +SKIP
+
+    """
+
+    input_spec = DenoiseBOLDInputSpec
+    output_spec = DenoiseBOLDOutputSpec
+
+    def _tr(self, header):
+        tr = float(header.get_zooms()[3])
+        if header.get_xyzt_units()[1] == "msec":
+            tr /= 1000.0
+        return tr
+
+    def _run_interface(self, runtime):
+        print("Denoise fMRI signal")
+        print("===================")
+
+        bold = BoldData(self.inputs.in_file)
+        tp = bold.n_timepoints
+
+        # GM mask covering the ROIs of all parcellation scales
+        gm = np.zeros(bold.shape[:3], dtype=bool)
+        for gm_file in self.inputs.gm_file:
+            gm |= nib.load(gm_file).get_data() > 0
+
+        if self.inputs.motion_nuisance or self.inputs.scrubbing:
+            move = np.genfromtxt(self.inputs.motion_file)[:tp]
+
+        if self.inputs.scrubbing:
+            print("> Compute FD and DVARS")
+            wm = nib.load(self.inputs.wm_file).get_data() > 0
+            dvars, _, _ = dvars_metrics(bold, bold.flat_index(wm | gm))
+            metrics = {
+                "FD": _scrubbing_series(framewise_displacement(move)),
+                "DVARS": _scrubbing_series(dvars),
+            }
+            for name, values in metrics.items():
+                np.save(os.path.abspath("%s.npy" % name), values)
+                sio.savemat(os.path.abspath("%s.mat" % name), {name: values})
+
+        # Trends
+        if self.inputs.detrending:
+            print("> Detrend (%s)" % self.inputs.detrending_mode)
+            order = {"linear": 1, "quadratic": 2, "cubic": 3}[self.inputs.detrending_mode]
+            trends = detrending_basis(
+                tp,
+                order=order,
+                spline_knot_spacing=(
+                    self.inputs.spline_knot_spacing if order == 3 else None
+                ),
+            )
+        else:
+            trends = np.ones((tp, 1))
+
+        # Nuisance signals
+        nuisance = []
+        for name, enabled, mask_file in [
+            ("global", self.inputs.global_nuisance, self.inputs.brainfile),
+            ("CSF", self.inputs.csf_nuisance, self.inputs.csf_file),
+            ("WM", self.inputs.wm_nuisance, self.inputs.wm_file),
+        ]:
+            if enabled:
+                print("> Regress out %s average signal" % name)
+                mask = nib.load(mask_file).get_data().astype(np.uint32) == 1
+                nuisance.append(bold.mean_timeseries(bold.flat_index(mask))[:, np.newaxis])
+        if self.inputs.motion_nuisance:
+            print("> Regress out motion signals")
+            nuisance.append(move)
+        confounds = np.hstack([trends] + nuisance)
+
+        # Band-pass filter
+        filtering = self.inputs.bandpass_filtering and (
+            self.inputs.highpass > 0 or self.inputs.lowpass > 0
+        )
+        sos = None
+        if filtering and self.inputs.filter_type == "fft":
+            print("> Band-pass filter (FFT)")
+            confounds = np.hstack(
+                (
+                    confounds,
+                    bandpass_basis(
+                        tp,
+                        self._tr(bold.header),
+                        self.inputs.highpass,
+                        self.inputs.lowpass,
+                    ),
+                )
+            )
+        elif filtering:
+            print("> Band-pass filter (Butterworth)")
+            from scipy import signal
+
+            nyquist = 0.5 / self._tr(bold.header)
+            band = [
+                f / nyquist if 0 < f < nyquist else None
+                for f in (self.inputs.highpass, self.inputs.lowpass)
+            ]
+            if band[0] is not None and band[1] is not None:
+                sos = signal.butter(self.inputs.butterworth_order, band, btype="bandpass", output="sos")
+            elif band[0] is not None:
+                sos = signal.butter(self.inputs.butterworth_order, band[0], btype="highpass", output="sos")
+            elif band[1] is not None:
+                sos = signal.butter(self.inputs.butterworth_order, band[1], btype="lowpass", output="sos")
+
+        basis = nuisance_projector(confounds)
+
+        # Optional intermediate volumes
+        intermediates = []
+        if self.inputs.save_intermediates:
+            intermediates.append(
+                (
+                    nuisance_projector(trends),
+                    bold.create_output(
+                        os.path.abspath("fMRI_detrending.nii.gz"), copy_data=True
+                    ),
+                )
+            )
+            intermediates.append(
+                (
+                    nuisance_projector(np.hstack([trends] + nuisance)),
+                    bold.create_output(
+                        os.path.abspath("fMRI_nuisance.nii.gz"), copy_data=True
+                    ),
+                )
+            )
+
+        # Voxels outside GM are copied unchanged (not detrended nor filtered)
+        with bold, bold.create_output(
+            os.path.abspath("fMRI_denoised.nii.gz"), copy_data=True
+        ) as out:
+            for idx, ts in bold.iter_timeseries(bold.flat_index(gm)):
+                resid = regress_out(ts, basis)
+                if sos is not None:
+                    resid = signal.sosfiltfilt(sos, resid, axis=1)
+                out.write_timeseries(idx, resid)
+                for step_basis, step_out in intermediates:
+                    step_out.write_timeseries(idx, regress_out(ts, step_basis))
+            for _, step_out in intermediates:
+                step_out.close()
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath("fMRI_denoised.nii.gz")
+        if self.inputs.save_intermediates:
+            outputs["detrending_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+            outputs["nuisance_file"] = os.path.abspath("fMRI_nuisance.nii.gz")
+        if self.inputs.scrubbing:
+            outputs["fd_mat"] = os.path.abspath("FD.mat")
+            outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
+            outputs["fd_npy"] = os.path.abspath("FD.npy")
+            outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
         return outputs
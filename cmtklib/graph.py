@@ -0,0 +1,387 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that defines the array-based container of CMTK connectomes."""
+
+import csv
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import networkx as nx
+import scipy.io as sio
+import scipy.sparse as sparse
+
+
+GRAPHML_NAMESPACE = "http://graphml.graphdrawing.org/xmlns"
+
+# Conversion of the GraphML attribute types
+GRAPHML_TYPES = {
+    "string": str,
+    "int": int,
+    "integer": int,
+    "long": int,
+    "float": float,
+    "double": float,
+    "boolean": lambda value: value.lower() in ["true", "1"],
+}
+
+
+def _graphml_type(dtype):
+    """Return the GraphML attribute type of a NumPy dtype."""
+    if dtype.kind == "b":
+        return "boolean"
+    if dtype.kind in "iu":
+        return "int"
+    if dtype.kind == "f":
+        return "double"
+    return "string"
+
+
+def _graphml_value(value):
+    """Return the GraphML text of an attribute value."""
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value)).lower()
+    return str(value)
+
+
+def read_graphml_nodes(fname):
+    """Read the nodes and their attributes from a GraphML file.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the GraphML file describing the nodes of a parcellation
+
+    Returns
+    -------
+    nodes : numpy.ndarray
+        Structured array with the integer ``id`` of each node and one field
+        of Python objects per node attribute, in the order of the file
+    """
+    ns = {"g": GRAPHML_NAMESPACE}
+    root = ET.parse(fname).getroot()
+
+    keys = {}
+    for key in root.findall("g:key", ns):
+        if key.get("for") in ["node", "all"]:
+            keys[key.get("id")] = (
+                key.get("attr.name"),
+                GRAPHML_TYPES.get(key.get("attr.type"), str),
+            )
+
+    ids = []
+    attributes = dict((name, []) for name, _ in keys.values())
+    for node in root.findall("g:graph/g:node", ns):
+        ids.append(int(node.get("id")))
+        data = dict((d.get("key"), d.text) for d in node.findall("g:data", ns))
+        for key_id, (name, convert) in keys.items():
+            value = data.get(key_id)
+            attributes[name].append(convert(value) if value is not None else None)
+
+    nodes = np.zeros(
+        len(ids), dtype=[("id", np.int64)] + [(name, object) for name in attributes]
+    )
+    nodes["id"] = ids
+    for name, values in attributes.items():
+        nodes[name] = values
+    return nodes
+
+
+class ConnectomeData:
+    """Array-based container of a connectome.
+
+    Nodes are stored in a structured array with one record per node and edges
+    in coordinate (COO) format, with the indices of the ``src`` and ``dst`` nodes
+    of each edge and one array per edge metric.
+
+    NaN metric values mark the edges for which a metric is not defined. They
+    are kept in the matrices and TSV files but are omitted from the networkx
+    and GraphML outputs.
+
+    Attributes
+    ----------
+    nodes : numpy.ndarray
+        Structured array with the integer ``id`` and the attributes of each node
+
+    src : numpy.ndarray
+        Index in `nodes` of the source node of each edge
+
+    dst : numpy.ndarray
+        Index in `nodes` of the target node of each edge
+
+    edge_metrics : dict
+        Dictionary of arrays of size [#edges] indexed by metric name
+
+    Examples
+    --------
+    >>> from cmtklib.graph import ConnectomeData
+    >>> connectome = ConnectomeData.from_graphml('/path/to/sub-01_atlas-L2018_desc-scale1_dseg.graphml')
+    >>> connectome.set_edges(src, dst, {"number_of_fibers": counts})  # doctest: +SKIP
+    >>> connectome.write_tsv('connectome_scale1.tsv')  # doctest: +SKIP
+    """
+
+    def __init__(self, nodes, src=None, dst=None, edge_metrics=None):
+        """Constructor of a :class:`~cmtklib.graph.ConnectomeData` instance."""
+        self.nodes = nodes
+        self.src = np.zeros(0, dtype=np.int64)
+        self.dst = np.zeros(0, dtype=np.int64)
+        self.edge_metrics = {}
+        if src is not None:
+            self.set_edges(src, dst, edge_metrics)
+
+    @classmethod
+    def from_graphml(cls, fname):
+        """Create a connectome without edges from the nodes described in a GraphML file."""
+        return cls(read_graphml_nodes(fname))
+
+    @property
+    def n_nodes(self):
+        """Number of nodes."""
+        return len(self.nodes)
+
+    @property
+    def n_edges(self):
+        """Number of edges."""
+        return len(self.src)
+
+    def node_index(self, ids):
+        """Return the index in `nodes` of each node ID in `ids`.
+
+        Raises
+        ------
+        ValueError
+            If a node ID is not in the connectome
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(self.nodes["id"], kind="stable")
+        sorted_ids = self.nodes["id"][order]
+        pos = np.clip(np.searchsorted(sorted_ids, ids), 0, max(len(sorted_ids) - 1, 0))
+        if len(sorted_ids) > 0:
+            known = sorted_ids[pos] == ids
+        else:
+            known = np.zeros(ids.shape, dtype=bool)
+        if not np.all(known):
+            raise ValueError(
+                "Node IDs %s are not in the connectome" % np.unique(ids[~known]).tolist()
+            )
+        return order[pos]
+
+    def set_node_attribute(self, name, values):
+        """Add or replace a node attribute.
+
+        Parameters
+        ----------
+        name : string
+            Name of the attribute
+
+        values : array_like
+            Array of size [#nodes, ...] with the value of the attribute for each node
+        """
+        values = np.asarray(values)
+        dtype = [
+            (field, self.nodes.dtype.fields[field][0])
+            if field != name
+            else (name, values.dtype, values.shape[1:])
+            for field in self.nodes.dtype.names
+        ]
+        if name not in self.nodes.dtype.names:
+            dtype.append((name, values.dtype, values.shape[1:]))
+
+        nodes = np.zeros(self.n_nodes, dtype=dtype)
+        for field in self.nodes.dtype.names:
+            if field != name:
+                nodes[field] = self.nodes[field]
+        nodes[name] = values
+        self.nodes = nodes
+
+    def set_edges(self, src, dst, edge_metrics):
+        """Set the edges of the connectome.
+
+        Parameters
+        ----------
+        src : numpy.ndarray
+            Index in `nodes` of the source node of each edge
+
+        dst : numpy.ndarray
+            Index in `nodes` of the target node of each edge
+
+        edge_metrics : dict
+            Dictionary of arrays of size [#edges] indexed by metric name
+        """
+        self.src = np.asarray(src, dtype=np.int64)
+        self.dst = np.asarray(dst, dtype=np.int64)
+        self.edge_metrics = dict(
+            (key, np.asarray(values)) for key, values in edge_metrics.items()
+        )
+        for key, values in self.edge_metrics.items():
+            if values.shape != self.src.shape:
+                raise ValueError(
+                    "Edge metric %s has %i values for %i edges" % (key, len(values), self.n_edges)
+                )
+
+    def to_sparse(self, metric):
+        """Return a metric as a scipy sparse matrix in COO format.
+
+        Each edge is stored once, with the metric arrays used as data.
+        """
+        return sparse.coo_matrix(
+            (self.edge_metrics[metric], (self.src, self.dst)),
+            shape=(self.n_nodes, self.n_nodes),
+        )
+
+    def to_dense(self, metric):
+        """Return a metric as a symmetric dense matrix (0 for the missing edges)."""
+        mat = np.zeros((self.n_nodes, self.n_nodes))
+        values = self.edge_metrics[metric]
+        mat[self.src, self.dst] = values
+        mat[self.dst, self.src] = values
+        return mat
+
+    def _node_values(self, field):
+        """Return the values of a node attribute as a list of Python objects."""
+        values = self.nodes[field]
+        if values.ndim > 1:
+            return [tuple(value) for value in values.tolist()]
+        return values.tolist()
+
+    def _edge_values(self, metric):
+        """Return the values of an edge metric as a list of Python scalars or None for NaN."""
+        values = self.edge_metrics[metric]
+        if values.dtype.kind == "f":
+            return [None if np.isnan(value) else value for value in values.tolist()]
+        return values.tolist()
+
+    def to_networkx(self):
+        """Return the connectome as a ``networkx.Graph``.
+
+        Nodes are labelled by their ID and carry all node attributes.
+        """
+        G = nx.Graph()
+        node_ids = self.nodes["id"].tolist()
+        attributes = [name for name in self.nodes.dtype.names if name != "id"]
+        node_values = [self._node_values(name) for name in attributes]
+        for i, u in enumerate(node_ids):
+            G.add_node(u, **dict((name, values[i]) for name, values in zip(attributes, node_values)))
+
+        metrics = list(self.edge_metrics.keys())
+        edge_values = [self._edge_values(metric) for metric in metrics]
+        for i, (s, d) in enumerate(zip(self.src.tolist(), self.dst.tolist())):
+            G.add_edge(
+                node_ids[s],
+                node_ids[d],
+                **dict(
+                    (metric, values[i])
+                    for metric, values in zip(metrics, edge_values)
+                    if values[i] is not None
+                ),
+            )
+        return G
+
+    def write_tsv(self, fname):
+        """Save the edges as a TSV edge list with one column per metric."""
+        node_ids = self.nodes["id"].tolist()
+        metrics = list(self.edge_metrics.keys())
+        with open(fname, "w") as out_file:
+            tsv_writer = csv.writer(out_file, delimiter="\t", lineterminator="\n")
+            tsv_writer.writerow(["source", "target"] + metrics)
+            tsv_writer.writerows(
+                zip(
+                    [node_ids[s] for s in self.src.tolist()],
+                    [node_ids[d] for d in self.dst.tolist()],
+                    *[self.edge_metrics[metric].tolist() for metric in metrics],
+                )
+            )
+
+    def write_mat(self, fname, **kwargs):
+        """Save the connectome in a MATLAB file.
+
+        The ``sc`` structure contains the dense matrix of each edge metric and
+        the ``nodes`` structure contains the node attributes, as matrices for
+        the vector attributes and as cell arrays otherwise.
+        Additional keyword arguments are passed to ``scipy.io.savemat``.
+        """
+        edge_struct = dict((metric, self.to_dense(metric)) for metric in self.edge_metrics)
+
+        node_struct = {}
+        for name in self.nodes.dtype.names:
+            if name == "id":
+                continue
+            values = self.nodes[name]
+            if values.ndim > 1:
+                node_struct[name] = values.astype(np.float64)
+            else:
+                node_arr = np.zeros(self.n_nodes, dtype=np.object_)
+                node_arr[:] = list(values)
+                node_struct[name] = node_arr
+
+        sio.savemat(fname, mdict={"sc": edge_struct, "nodes": node_struct}, **kwargs)
+
+    def write_graphml(self, fname, node_attributes=None):
+        """Save the connectome in GraphML format.
+
+        Parameters
+        ----------
+        fname : string
+            Output GraphML file
+
+        node_attributes : list
+            Node attributes to save (Default: all). Attributes with
+            3 components (such as ``dn_position``) are saved as 3
+            attributes suffixed by ``_x``, ``_y`` and ``_z``.
+        """
+        if node_attributes is None:
+            node_attributes = [name for name in self.nodes.dtype.names if name != "id"]
+
+        # Flatten the node attributes to the list of (name, type, values)
+        node_columns = []
+        for name in node_attributes:
+            values = self.nodes[name]
+            if values.ndim > 1:
+                for i, axis in enumerate(["x", "y", "z"]):
+                    node_columns.append(
+                        ("%s_%s" % (name, axis), _graphml_type(values.dtype), values[:, i].tolist())
+                    )
+            elif values.dtype == object:
+                node_columns.append(
+                    (name, _graphml_type(np.asarray(values.tolist()).dtype), values.tolist())
+                )
+            else:
+                node_columns.append((name, _graphml_type(values.dtype), values.tolist()))
+        edge_columns = [
+            (metric, _graphml_type(values.dtype), self._edge_values(metric))
+            for metric, values in self.edge_metrics.items()
+        ]
+
+        root = ET.Element("graphml", xmlns=GRAPHML_NAMESPACE)
+        key_ids = {}
+        for domain, columns in [("node", node_columns), ("edge", edge_columns)]:
+            for name, attr_type, _ in columns:
+                key_ids[domain, name] = "d%i" % len(key_ids)
+                ET.SubElement(
+                    root,
+                    "key",
+                    {
+                        "id": key_ids[domain, name],
+                        "for": domain,
+                        "attr.name": name,
+                        "attr.type": attr_type,
+                    },
+                )
+
+        graph = ET.SubElement(root, "graph", edgedefault="undirected")
+        node_ids = [str(u) for u in self.nodes["id"].tolist()]
+        for i, u in enumerate(node_ids):
+            node = ET.SubElement(graph, "node", id=u)
+            for name, _, values in node_columns:
+                if values[i] is not None:
+                    ET.SubElement(node, "data", key=key_ids["node", name]).text = _graphml_value(values[i])
+        for i, (s, d) in enumerate(zip(self.src.tolist(), self.dst.tolist())):
+            edge = ET.SubElement(graph, "edge", source=node_ids[s], target=node_ids[d])
+            for name, _, values in edge_columns:
+                if values[i] is not None:
+                    ET.SubElement(edge, "data", key=key_ids["edge", name]).text = _graphml_value(values[i])
+
+        ET.ElementTree(root).write(fname, encoding="utf-8", xml_declaration=True)
@@ -5,9 +5,6 @@
 #  This software is distributed under the open-source license Modified BSD.
 
 """The ANTs module provides Nipype interfaces for the ANTs registration toolbox missing in nipype or modified."""
-import os
-import glob
-
 from traits.api import *
 
 from nipype.interfaces.base import traits, \
@@ -16,6 +13,9 @@ from nipype.interfaces.base import traits, \
 
 from nipype.interfaces.ants.resampling import ApplyTransforms
 
+# Own imports
+from cmtklib.util import run_interfaces
+
 
 class MultipleANTsApplyTransformsInputSpec(BaseInterfaceInputSpec):
     input_images = InputMultiPath(
@@ -42,6 +42,8 @@ class MultipleANTsApplyTransformsInputSpec(BaseInterfaceInputSpec):
 
     out_postfix = traits.Str("_transformed", usedefault=True)
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of images transformed in parallel')
+
 
 class MultipleANTsApplyTransformsOutputSpec(TraitedSpec):
     output_images = OutputMultiPath(File())
@@ -73,15 +75,21 @@ class MultipleANTsApplyTransforms(BaseInterface):
     input_spec = MultipleANTsApplyTransformsInputSpec
     output_spec = MultipleANTsApplyTransformsOutputSpec
 
+    def _interfaces(self):
+        return [
+            ApplyTransforms(input_image=input_image, reference_image=self.inputs.reference_image,
+                            interpolation=self.inputs.interpolation, transforms=self.inputs.transforms,
+                            out_postfix=self.inputs.out_postfix, default_value=self.inputs.default_value)
+            for input_image in self.inputs.input_images
+        ]
+
     def _run_interface(self, runtime):
-        for input_image in self.inputs.input_images:
-            ax = ApplyTransforms(input_image=input_image, reference_image=self.inputs.reference_image,
-                                 interpolation=self.inputs.interpolation, transforms=self.inputs.transforms,
-                                 out_postfix=self.inputs.out_postfix, default_value=self.inputs.default_value)
-            ax.run()
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(input_image, res.runtime.duration)
+                                  for input_image, res in zip(self.inputs.input_images, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['output_images'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['output_images'] = [ax._list_outputs()['output_image'] for ax in self._interfaces()]
         return outputs
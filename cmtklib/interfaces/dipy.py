@@ -6,10 +6,15 @@
 #  This software is distributed under the open-source license Modified BSD.
 """The Dipy module provides Nipype interfaces to the algorithms in dipy."""
 
+import os
 import os.path as op
 from future import standard_library
+import collections
+import json
+import shutil
+import tempfile
 import time
-import gzip
+from concurrent.futures import ProcessPoolExecutor
 import nibabel as nib
 import numpy as np
 
@@ -17,11 +22,653 @@ from nipype.interfaces.dipy.base import DipyDiffusionInterface, DipyBaseInterfac
 from nipype.interfaces.base import TraitedSpec, File, traits, isdefined, BaseInterfaceInputSpec, InputMultiPath
 from nipype import logging
 
+from cmtklib.diffusion import generate_seeds
+
 
 standard_library.install_aliases()
 IFLOGGER = logging.getLogger('nipype.interface')
 
 
+def iter_row_chunks(array, chunk_size):
+    """Split rows given as an array or as consecutive batches of rows into chunks.
+
+    Parameters
+    ----------
+    array : numpy.ndarray or iterable of numpy.ndarray
+        Array of size [#rows, ...], or batches of rows generated lazily
+
+    chunk_size : int
+        Number of rows per chunk. Only the last chunk can be smaller,
+        such that the chunks do not depend on the size of the batches
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the chunk
+
+    chunk : numpy.ndarray
+        Rows of the chunk
+    """
+    chunk_size = max(1, chunk_size)
+    if isinstance(array, np.ndarray):
+        for start in range(0, len(array), chunk_size):
+            yield start, array[start:start + chunk_size]
+        return
+
+    start = 0
+    rest = None
+    for batch in array:
+        if rest is not None and len(rest):
+            batch = np.concatenate([rest, batch])
+        n_full = len(batch) - len(batch) % chunk_size
+        for i in range(0, n_full, chunk_size):
+            yield start, batch[i:i + chunk_size]
+            start += chunk_size
+        rest = batch[n_full:]
+    if rest is not None and len(rest):
+        yield start, rest
+
+
+def map_chunks(func, array, chunk_size, n_jobs=1, initializer=None, initargs=()):
+    """Apply a function to consecutive chunks of the rows of an array.
+
+    Parameters
+    ----------
+    func : callable
+        Function called with an array of size [#rows in the chunk, ...]
+
+    array : numpy.ndarray or iterable of numpy.ndarray
+        Array of size [#rows, ...] such as the diffusion signal of
+        the voxels inside the brain mask or the tractography seeds,
+        or batches of rows generated lazily (See :func:`iter_row_chunks`)
+
+    chunk_size : int
+        Maximal number of rows per chunk
+
+    n_jobs : int
+        Number of worker processes in which the chunks are processed.
+        At most ``2 * n_jobs`` chunks are in flight at any time
+
+    initializer : callable
+        Function called with `initargs` once in each worker process
+        (or once in the current process if `n_jobs` is 1)
+
+    initargs : tuple
+        Arguments passed to `initializer`
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the chunk
+
+    result : object
+        Result of `func` for the chunk
+    """
+    chunks = iter_row_chunks(array, chunk_size)
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as executor:
+            pending = collections.deque()
+            for start, chunk in chunks:
+                pending.append((start, executor.submit(func, chunk)))
+                if len(pending) >= 2 * n_jobs:
+                    start, future = pending.popleft()
+                    yield start, future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield start, future.result()
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        for start, chunk in chunks:
+            yield start, func(chunk)
+
+
+def save_recon_manifest(out_file, model, files, parameters):
+    """Write the JSON manifest describing the outputs of a reconstruction model.
+
+    Parameters
+    ----------
+    out_file : str
+        Output JSON file
+
+    model : str
+        Name of the reconstruction model (``DTI``, ``CSD``, ``SHORE``, ``MAPMRI``)
+
+    files : dict
+        Output files of the model indexed by name. They are stored
+        relative to the directory of the manifest
+
+    parameters : dict
+        Parameters of the model and of the peak extraction
+
+    Returns
+    -------
+    out_file : str
+        Output JSON file
+    """
+    manifest = {
+        "model": model,
+        "files": dict((name, op.relpath(fname, op.dirname(op.abspath(out_file)))) for name, fname in files.items()),
+        "parameters": parameters,
+    }
+    with open(out_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return out_file
+
+
+def load_recon_manifest(manifest_file):
+    """Read a manifest written by :func:`save_recon_manifest`, with absolute file names."""
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    manifest_dir = op.dirname(op.abspath(manifest_file))
+    manifest["files"] = dict((name, op.join(manifest_dir, fname)) for name, fname in manifest["files"].items())
+    return manifest
+
+
+PEAKS_ARRAYS = [("peak_dirs", np.float32), ("peak_values", np.float32),
+                ("peak_indices", np.int32), ("shm_coeff", np.float32)]
+
+
+def save_peaks(peaks, affine, out_file, model, parameters):
+    """Save the peaks and the spherical harmonics coefficients extracted from a model.
+
+    The arrays are stored in uncompressed NIfTI files (``<out_file>_<array>.nii``),
+    which can be memory-mapped by :func:`load_peaks`, and are described by
+    a JSON manifest (See :func:`save_recon_manifest`).
+
+    Parameters
+    ----------
+    peaks : dipy.direction.peaks.PeaksAndMetrics
+        Output of ``peaks_from_model``
+
+    affine : numpy.ndarray
+        Affine of the diffusion image
+
+    out_file : str
+        Output JSON manifest
+
+    model : str
+        Name of the reconstruction model
+
+    parameters : dict
+        Parameters of the model and of the peak extraction
+
+    Returns
+    -------
+    out_file : str
+        Output JSON manifest
+    """
+    files = {}
+    for name, dtype in PEAKS_ARRAYS:
+        data = getattr(peaks, name, None)
+        if data is None:
+            continue
+        files[name] = op.splitext(out_file)[0] + f"_{name}.nii"
+        nib.Nifti1Image(np.asarray(data, dtype=dtype), affine).to_filename(files[name])
+    return save_recon_manifest(out_file, model, files, parameters)
+
+
+def load_peaks(manifest_file):
+    """Load the peaks saved by :func:`save_peaks` as memory-mapped arrays.
+
+    Parameters
+    ----------
+    manifest_file : str
+        JSON manifest written by :func:`save_peaks`
+
+    Returns
+    -------
+    peaks : dipy.direction.peaks.PeaksAndMetrics
+        Peaks with the ``peak_dirs``, ``peak_values``, ``peak_indices``
+        and ``shm_coeff`` arrays (None if not saved) and the ``parameters``
+        of the manifest
+    """
+    from dipy.data import get_sphere
+    from dipy.direction.peaks import PeaksAndMetrics
+
+    manifest = load_recon_manifest(manifest_file)
+    peaks = PeaksAndMetrics()
+    peaks.parameters = manifest["parameters"]
+    peaks.sphere = get_sphere(peaks.parameters.get("sphere", "symmetric724"))
+    for name, _ in PEAKS_ARRAYS:
+        data = None
+        if name in manifest["files"]:
+            data = np.asanyarray(nib.load(manifest["files"][name], mmap="c").dataobj)
+        setattr(peaks, name, data)
+    return peaks
+
+
+def fit_shore_voxels(voxels, shore_model, sphere, sh_order, basis):
+    """Fit the SHORE model to a set of voxels and compute its derived maps.
+
+    Parameters
+    ----------
+    voxels : numpy.ndarray
+        Diffusion signal of the voxels in an array of size [#voxels, #gradients]
+
+    shore_model : dipy.reconst.shore.ShoreModel
+        SHORE model
+
+    sphere : dipy.core.sphere.Sphere
+        Sphere on which the ODFs are sampled
+
+    sh_order : int
+        Maximal spherical harmonics order of the ODFs
+
+    basis : {'tournier07', 'descoteaux07'}
+        Spherical harmonics basis of the ODFs
+
+    Returns
+    -------
+    maps : dict
+        Dictionary with the spherical harmonics coefficients of the
+        diffusion (``dodf``) and sharpened fiber (``fodf``) ODFs
+        and the ``GFA``, ``MSD`` and ``RTOP`` of the voxels
+    """
+    from dipy.reconst.odf import gfa
+    from dipy.reconst.csdeconv import odf_sh_to_sharp
+    from dipy.reconst.shm import sf_to_sh
+
+    shorefit = shore_model.fit(voxels)
+    odf = shorefit.odf(sphere)
+    odf_sh = sf_to_sh(odf, sphere, sh_order=sh_order, basis_type=basis)
+    return {
+        "dodf": odf_sh,
+        "fodf": odf_sh_to_sharp(odf_sh, sphere, basis=basis, ratio=0.2, sh_order=sh_order, lambda_=1.0, tau=0.1,
+                                r2_term=True),
+        "GFA": np.nan_to_num(gfa(odf)),
+        "MSD": np.nan_to_num(shorefit.msd()),
+        "RTOP": np.nan_to_num(shorefit.rtop_signal()),
+    }
+
+
+# Arguments shared by all the voxel chunks fitted in a worker process
+_shore_worker_args = None
+
+
+def _init_shore_worker(shore_model, sphere, sh_order, basis):
+    global _shore_worker_args
+    _shore_worker_args = (shore_model, sphere, sh_order, basis)
+
+
+def _fit_shore_voxels_worker(voxels):
+    return fit_shore_voxels(voxels, *_shore_worker_args)
+
+
+MAPMRI_METRICS = ["rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"]
+
+
+def fit_mapmri_voxels(voxels, mapmri_model):
+    """Fit the MAP-MRI model to a set of voxels and compute its scalar maps.
+
+    The fitted coefficients are dropped once the maps are computed.
+
+    Parameters
+    ----------
+    voxels : numpy.ndarray
+        Diffusion signal of the voxels in an array of size [#voxels, #gradients]
+
+    mapmri_model : dipy.reconst.mapmri.MapmriModel
+        MAP-MRI model
+
+    Returns
+    -------
+    maps : dict
+        Dictionary of ``float32`` arrays of size [#voxels] indexed
+        by the metrics in ``MAPMRI_METRICS``
+    """
+    mapfit = mapmri_model.fit(voxels)
+    maps = {
+        "rtop": mapfit.rtop(),
+        "rtap": mapfit.rtap(),
+        "rtpp": mapfit.rtpp(),
+        "msd": mapfit.msd(),
+        "qiv": mapfit.qiv(),
+        "ng": mapfit.ng(),
+        "ng_perp": mapfit.ng_perpendicular(),
+        "ng_para": mapfit.ng_parallel()
+    }
+    return dict((metric, np.asarray(data, dtype=np.float32)) for metric, data in maps.items())
+
+
+# Model shared by all the voxel blocks fitted in a worker process
+_mapmri_worker_model = None
+
+
+def _init_mapmri_worker(mapmri_model):
+    global _mapmri_worker_model
+    _mapmri_worker_model = mapmri_model
+
+
+def _fit_mapmri_voxels_worker(voxels):
+    return fit_mapmri_voxels(voxels, _mapmri_worker_model)
+
+
+def _open_tracking_array(ref):
+    """Return the array referenced in the tracking parameters.
+
+    Arrays shared with the worker processes are stored in ``.npy`` files
+    and memory-mapped in copy-on-write mode, as the dipy tracking objects
+    expect writable buffers.
+    """
+    if isinstance(ref, str):
+        return np.load(ref, mmap_mode="c")
+    return ref
+
+
+# Arrays of the direction getters, with the dtype and the fill value outside the mask
+DIRECTION_GETTER_ARRAYS = {
+    "peaks": [("peak_dirs", np.float64, 0), ("peak_values", np.float64, 0), ("peak_indices", np.int32, -1)],
+    "sh": [("shcoeff", np.float64, 0)],
+}
+
+
+def prepare_direction_getter(params):
+    """Load, convert and mask the arrays of a direction getter once.
+
+    Parameters
+    ----------
+    params : dict
+        Dictionary with the ``type`` of direction getter:
+
+        * ``"peaks"``: peaks extracted from a reconstruction model (EuDX)
+        * ``"deterministic"`` / ``"probabilistic"``: spherical harmonics
+          coefficients of the fODFs and ``max_angle``
+
+        The peaks and coefficients are read from the ``manifest`` written by
+        :func:`save_peaks` or given as arrays in ``peak_dirs``, ``peak_values``,
+        ``peak_indices`` and ``shcoeff``. If a ``mask`` is given, they are
+        discarded outside the mask.
+
+    Returns
+    -------
+    params : dict
+        Parameters of :func:`build_direction_getter`, with the arrays in the
+        dtypes used by dipy, the ``sphere`` name and the ``basis_type`` of
+        the spherical harmonics
+    """
+    peaks = load_peaks(params["manifest"]) if "manifest" in params else None
+    mask = _open_tracking_array(params["mask"]) > 0 if "mask" in params else None
+
+    prepared = dict((key, value) for key, value in params.items() if key not in ["manifest", "mask"])
+    prepared["sphere"] = peaks.parameters.get("sphere", "symmetric724") if peaks is not None else "symmetric724"
+    prepared["basis_type"] = peaks.parameters.get("sh_basis_type") if peaks is not None else None
+
+    arrays = DIRECTION_GETTER_ARRAYS["peaks" if params["type"] == "peaks" else "sh"]
+    for name, dtype, fill_value in arrays:
+        if peaks is not None:
+            data = getattr(peaks, "shm_coeff" if name == "shcoeff" else name)
+        else:
+            data = _open_tracking_array(params[name])
+        data = np.array(data, dtype=dtype)
+        if mask is not None:
+            data[~mask] = fill_value
+        prepared[name] = data
+    return prepared
+
+
+def build_direction_getter(params):
+    """Build the direction getter described by the tracking parameters.
+
+    Parameters
+    ----------
+    params : dict
+        Dictionary returned by :func:`prepare_direction_getter`. Its arrays
+        (or the ``.npy`` files in which they are stored) are used as is,
+        such that memory-mapped arrays are not copied
+
+    Returns
+    -------
+    direction_getter : dipy.direction.DirectionGetter
+        Direction getter
+    """
+    from dipy.data import get_sphere
+    from dipy.direction import DeterministicMaximumDirectionGetter, ProbabilisticDirectionGetter
+    from dipy.direction.peaks import PeaksAndMetrics
+
+    sphere = get_sphere(params["sphere"])
+
+    if params["type"] == "peaks":
+        direction_getter = PeaksAndMetrics()
+        direction_getter.sphere = sphere
+        for name, _, _ in DIRECTION_GETTER_ARRAYS["peaks"]:
+            setattr(direction_getter, name, _open_tracking_array(params[name]))
+        return direction_getter
+
+    if params["type"] == "deterministic":
+        klass = DeterministicMaximumDirectionGetter
+    else:
+        klass = ProbabilisticDirectionGetter
+    return klass.from_shcoeff(_open_tracking_array(params["shcoeff"]),
+                              max_angle=params["max_angle"],
+                              sphere=sphere,
+                              basis_type=params["basis_type"])
+
+
+def build_stopping_criterion(params):
+    """Build the stopping criterion described by the tracking parameters.
+
+    Parameters
+    ----------
+    params : dict
+        Dictionary with the ``type`` of stopping criterion and its arrays
+        (or the ``.npy`` files in which they are stored):
+
+        * ``"binary"``: tracking ``mask``
+        * ``"threshold"``: ``metric_map`` (FA) and its ``threshold``
+        * ``"cmc"``: ``wm``, ``gm`` and ``csf`` partial volume maps,
+          ``step_size`` and ``average_voxel_size``
+
+    Returns
+    -------
+    stopping_criterion : dipy.tracking.stopping_criterion.StoppingCriterion
+        Stopping criterion
+    """
+    from dipy.tracking.stopping_criterion import (
+        BinaryStoppingCriterion, ThresholdStoppingCriterion, CmcStoppingCriterion
+    )
+
+    if params["type"] == "binary":
+        return BinaryStoppingCriterion(_open_tracking_array(params["mask"]))
+    if params["type"] == "threshold":
+        return ThresholdStoppingCriterion(_open_tracking_array(params["metric_map"]), params["threshold"])
+    return CmcStoppingCriterion.from_pve(_open_tracking_array(params["wm"]),
+                                         _open_tracking_array(params["gm"]),
+                                         _open_tracking_array(params["csf"]),
+                                         step_size=params["step_size"],
+                                         average_voxel_size=params["average_voxel_size"])
+
+
+def track_seeds(seeds, direction_getter, stopping_criterion, params):
+    """Track streamlines from a set of seeds.
+
+    Parameters
+    ----------
+    seeds : numpy.ndarray
+        Seed coordinates in an array of size [#seeds, 3]
+
+    direction_getter : dipy.direction.DirectionGetter
+        Direction getter (See :func:`build_direction_getter`)
+
+    stopping_criterion : dipy.tracking.stopping_criterion.StoppingCriterion
+        Stopping criterion (See :func:`build_stopping_criterion`)
+
+    params : dict
+        Dictionary with the ``type`` of tracking (``"local"`` or ``"pft"``
+        for Particle Filtering Tractography), the ``affine`` of the seeds,
+        the ``step_size`` and the ``random_seed``
+
+    Returns
+    -------
+    streamlines : generator
+        Generator of the streamlines in RAS+mm space
+    """
+    from dipy.tracking.local_tracking import LocalTracking, ParticleFilteringTracking
+
+    # When random_seed is set, dipy seeds the random number generator with
+    # a hash of each seed, such that the streamlines do not depend on the
+    # way the seeds are split between the jobs (See _get_tracking_random_seed)
+    if params["type"] == "pft":
+        return ParticleFilteringTracking(direction_getter,
+                                         stopping_criterion,
+                                         seeds,
+                                         params["affine"],
+                                         max_cross=1,
+                                         step_size=params["step_size"],
+                                         maxlen=200,
+                                         pft_back_tracking_dist=2,
+                                         pft_front_tracking_dist=1,
+                                         particle_count=15,
+                                         return_all=False,
+                                         random_seed=params["random_seed"])
+    return LocalTracking(direction_getter,
+                         stopping_criterion,
+                         seeds,
+                         params["affine"],
+                         step_size=params["step_size"],
+                         max_cross=1,
+                         random_seed=params["random_seed"])
+
+
+# Direction getter, stopping criterion and tracking parameters of a worker process
+_tracking_worker_args = None
+
+
+def _init_tracking_worker(params):
+    global _tracking_worker_args
+    _tracking_worker_args = (
+        build_direction_getter(params["direction_getter"]),
+        build_stopping_criterion(params["stopping_criterion"]),
+        params["tracking"],
+    )
+
+
+def _track_seeds_worker(seeds):
+    return list(track_seeds(seeds, *_tracking_worker_args))
+
+
+def run_tracking(seeds, params, n_jobs=1, chunk_size=10000):
+    """Track streamlines from the seeds split in chunks tracked in a process pool.
+
+    Parameters
+    ----------
+    seeds : numpy.ndarray or iterable of numpy.ndarray
+        Seed coordinates in an array of size [#seeds, 3], or batches
+        of seeds generated lazily (See :func:`cmtklib.diffusion.generate_seeds`)
+
+    params : dict
+        Dictionary with the ``direction_getter`` (See :func:`prepare_direction_getter`),
+        ``stopping_criterion`` (See :func:`build_stopping_criterion`) and
+        ``tracking`` (See :func:`track_seeds`) parameters
+
+    n_jobs : int
+        Number of worker processes in which the chunks of seeds are tracked.
+        The arrays of the direction getter and the stopping criterion are shared
+        with the workers as memory-mapped scratch files (``<key>_<name>.npy``) of a
+        temporary ``tracking_*`` directory, and each worker builds them once.
+
+    chunk_size : int
+        Number of seeds per chunk. The chunks do not depend on `n_jobs`
+
+    Yields
+    ------
+    streamline : numpy.ndarray
+        Streamlines in RAS+mm space, in the order of the seeds
+    """
+    # The arrays of the direction getter are converted and masked once
+    params = dict(params, direction_getter=prepare_direction_getter(params["direction_getter"]))
+
+    if n_jobs <= 1:
+        direction_getter = build_direction_getter(params["direction_getter"])
+        stopping_criterion = build_stopping_criterion(params["stopping_criterion"])
+        for _, chunk in iter_row_chunks(seeds, chunk_size):
+            yield from track_seeds(chunk, direction_getter, stopping_criterion, params["tracking"])
+        return
+
+    scratch_dir = tempfile.mkdtemp(prefix="tracking_", dir=os.getcwd())
+    try:
+        shared_params = dict(params)
+        for key in ["direction_getter", "stopping_criterion"]:
+            shared_params[key] = dict(params[key])
+            for name, value in params[key].items():
+                if isinstance(value, np.ndarray) and value.ndim >= 3:
+                    fname = op.join(scratch_dir, f"{key}_{name}.npy")
+                    np.save(fname, value)
+                    shared_params[key][name] = fname
+
+        for _, streamlines in map_chunks(_track_seeds_worker, seeds, chunk_size, n_jobs,
+                                         initializer=_init_tracking_worker,
+                                         initargs=(shared_params,)):
+            yield from streamlines
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def save_trk_streaming(streamlines, reference, out_file):
+    """Write streamlines to a TrackVis file while they are generated.
+
+    Parameters
+    ----------
+    streamlines : iterable
+        Streamlines in RAS+mm space
+
+    reference : nibabel.Nifti1Image
+        Image defining the space of the streamlines
+
+    out_file : str
+        Output TrackVis file
+
+    Returns
+    -------
+    nb_streamlines : int
+        Number of streamlines written
+    """
+    from nibabel.orientations import aff2axcodes
+    from nibabel.streamlines import Field, LazyTractogram
+
+    header = {
+        Field.VOXEL_TO_RASMM: reference.affine.copy(),
+        Field.VOXEL_SIZES: reference.header.get_zooms()[:3],
+        Field.DIMENSIONS: reference.shape[:3],
+        Field.VOXEL_ORDER: "".join(aff2axcodes(reference.affine)),
+    }
+    nb_streamlines = [0]
+
+    def counted_streamlines():
+        for streamline in streamlines:
+            nb_streamlines[0] += 1
+            yield streamline
+
+    tractogram = LazyTractogram(counted_streamlines, affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(tractogram, out_file, header=header)
+    return nb_streamlines[0]
+
+
+def _save_seed_batches(seed_batches, out_file):
+    """Write the batches of seeds to a text file while they are consumed."""
+    with open(out_file, 'w') as f:
+        for seeds in seed_batches:
+            np.savetxt(f, seeds)
+            yield seeds
+
+
+def _get_tracking_random_seed(random_seed):
+    """Return the `random_seed` input if defined, else the value of ``DIPY_RNG_SEED`` if set.
+
+    Otherwise a random seed is drawn and logged, such that the worker processes,
+    which inherit the state of the global random number generator, do not track
+    their chunks of seeds with the same random streams, and the run can be reproduced.
+    """
+    if isdefined(random_seed):
+        return random_seed
+    if os.environ.get('DIPY_RNG_SEED'):
+        return int(os.environ['DIPY_RNG_SEED'])
+    random_seed = int(np.random.SeedSequence().entropy % 2 ** 32)
+    IFLOGGER.info(f'Random seed used for tracking: {random_seed} '
+                  f'(set it with the random_seed input or DIPY_RNG_SEED to reproduce the run)')
+    return random_seed
+
+
 class DTIEstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     in_mask = File(
         exists=True, desc='input mask in which we find single fibers')
@@ -36,11 +683,15 @@ class DTIEstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     response = File(
         'response.txt', usedefault=True, desc='the output response file')
     out_mask = File('wm_mask.nii.gz', usedefault=True, desc='computed wm mask')
+    extract_peaks = traits.Bool(
+        True, usedefault=True, desc='extract the peaks of the tensors used for tracking')
+    peaks_mask = File(
+        exists=True, desc='mask in which the peaks are extracted')
 
 
 class DTIEstimateResponseSHOutputSpec(TraitedSpec):
     response = File(exists=True, desc='the response file')
-    dti_model = File(exists=True, desc='DTI model object')
+    dti_model = File(exists=True, desc='JSON manifest of the peaks extracted from the tensors')
     out_mask = File(exists=True, desc='output wm mask')
     fa_file = File(exists=True)
     md_file = File(exists=True)
@@ -73,8 +724,6 @@ class DTIEstimateResponseSH(DipyDiffusionInterface):
         from dipy.reconst.dti import fractional_anisotropy, mean_diffusivity, TensorModel
         from dipy.reconst.csdeconv import recursive_response, auto_response
 
-        import pickle as pickle
-
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
         affine = img.affine
@@ -93,9 +742,33 @@ class DTIEstimateResponseSH(DipyDiffusionInterface):
         tenmodel = TensorModel(gtab, fit_method='WLS')
         ten_fit = tenmodel.fit(data, msk)
 
-        f = gzip.open(self._gen_filename('tenmodel', ext='.pklz'), 'wb')
-        pickle.dump(tenmodel, f, -1)
-        f.close()
+        if self.inputs.extract_peaks:
+            from dipy.data import get_sphere
+            from dipy.direction import peaks_from_model
+
+            if isdefined(self.inputs.peaks_mask):
+                peaks_msk = nib.load(self.inputs.peaks_mask).get_data() > 0
+            else:
+                peaks_msk = None
+
+            IFLOGGER.info('Generating peaks from tensor model')
+            peak_params = {
+                "sphere": "symmetric724",
+                "relative_peak_threshold": .2,
+                "min_separation_angle": 25,
+                "normalize_peaks": False,
+            }
+            dti_peaks = peaks_from_model(model=tenmodel,
+                                         data=data,
+                                         sphere=get_sphere(peak_params["sphere"]),
+                                         relative_peak_threshold=peak_params["relative_peak_threshold"],
+                                         min_separation_angle=peak_params["min_separation_angle"],
+                                         mask=peaks_msk,
+                                         normalize_peaks=peak_params["normalize_peaks"],
+                                         parallel=True)
+            save_peaks(dti_peaks, affine, self._gen_filename('tenmodel', ext='.json'), 'DTI',
+                       dict(peak_params, fit_method='WLS'))
+            del dti_peaks
 
         FA = np.nan_to_num(fractional_anisotropy(ten_fit.evals)) * msk
         indices = np.where(FA > self.inputs.fa_thresh)
@@ -166,7 +839,8 @@ class DTIEstimateResponseSH(DipyDiffusionInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['response'] = op.abspath(self.inputs.response)
-        outputs['dti_model'] = self._gen_filename('tenmodel', ext='.pklz')
+        if self.inputs.extract_peaks:
+            outputs['dti_model'] = self._gen_filename('tenmodel', ext='.json')
         outputs['out_mask'] = op.abspath(self.inputs.out_mask)
 
         for metric in ["fa", "md", "rd", "ad"]:
@@ -192,7 +866,7 @@ class CSDInputSpec(DipyBaseInterfaceInputSpec):
 
 
 class CSDOutputSpec(TraitedSpec):
-    model = File(desc='Python pickled object of the CSD model fitted.')
+    model = File(desc='JSON manifest of the peaks and spherical harmonics coefficients of the CSD model fitted.')
     out_fods = File(desc='fODFs output file name')
     out_shm_coeff = File(
         desc='Spherical Harmonics Coefficients output file name')
@@ -227,9 +901,7 @@ class CSD(DipyDiffusionInterface):
     def _run_interface(self, runtime):
         from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel, auto_response_ssst
         from dipy.data import get_sphere
-        # import marshal as pickle
-        import pickle as pickle
-        # import gzip
+        from dipy.direction import peaks_from_model
 
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
@@ -293,26 +965,34 @@ class CSD(DipyDiffusionInterface):
         elif self.inputs.tracking_processing_tool == 'dipy':
             sh_basis_type = 'descoteaux07'
 
-        with gzip.open(self._gen_filename('csdmodel', ext='.pklz'), 'wb') as f:
-            pickle.dump(csd_model, f, -1)
+        peak_params = {
+            "sphere": "symmetric724",
+            "sh_order": self.inputs.sh_order,
+            "sh_basis_type": sh_basis_type,
+            "relative_peak_threshold": .5,
+            "min_separation_angle": 25,
+            "npeaks": 3,
+            "normalize_peaks": True,
+        }
+        IFLOGGER.info('Fitting CSD model')
+        csd_peaks = peaks_from_model(model=csd_model,
+                                     data=data,
+                                     sphere=sphere,
+                                     relative_peak_threshold=peak_params["relative_peak_threshold"],
+                                     min_separation_angle=peak_params["min_separation_angle"],
+                                     mask=msk,
+                                     sh_order=peak_params["sh_order"],
+                                     sh_basis_type=sh_basis_type,
+                                     return_sh=True,
+                                     return_odf=False,
+                                     normalize_peaks=peak_params["normalize_peaks"],
+                                     npeaks=peak_params["npeaks"],
+                                     parallel=True,
+                                     nbr_processes=None)
+        save_peaks(csd_peaks, img.affine, self._gen_filename('csdmodel', ext='.json'), 'CSD',
+                   dict(peak_params, response=np.asarray(response[0]).tolist() + [float(response[1])]))
 
         if self.inputs.save_shm_coeff:
-            # isphere = get_sphere('symmetric724')
-            from dipy.direction import peaks_from_model
-            IFLOGGER.info('Fitting CSD model')
-            csd_peaks = peaks_from_model(model=csd_model,
-                                         data=data,
-                                         sphere=sphere,
-                                         relative_peak_threshold=.5,
-                                         min_separation_angle=25,
-                                         mask=msk,
-                                         sh_basis_type=sh_basis_type,
-                                         return_sh=True,
-                                         return_odf=False,
-                                         normalize_peaks=True,
-                                         npeaks=3,
-                                         parallel=True,
-                                         nbr_processes=None)
             # fods = csd_fit.odf(sphere)
             # IFLOGGER.info(fods)
             # IFLOGGER.info(fods.shape)
@@ -337,7 +1017,7 @@ class CSD(DipyDiffusionInterface):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['model'] = self._gen_filename('csdmodel', ext='.pklz')
+        outputs['model'] = self._gen_filename('csdmodel', ext='.json')
         if self.inputs.save_fods:
             outputs['out_shm_coeff'] = self._gen_filename('shm_coeff')
         # if self.inputs.save_fods:
@@ -365,9 +1045,15 @@ class SHOREInputSpec(DipyBaseInterfaceInputSpec):
     positive_constraint = traits.Bool(False, usedefault=True, desc=(
         'Constrain the optimization such that E(0) = 1.'))
 
+    n_jobs = traits.Int(1, usedefault=True, desc=(
+        'Number of processes in which the voxels are fitted'))
+
+    chunk_size = traits.Int(5000, usedefault=True, desc=(
+        'Maximal number of voxels fitted at once by a process'))
+
 
 class SHOREOutputSpec(TraitedSpec):
-    model = File(desc='Python pickled object of the SHORE model fitted.')
+    model = File(desc='JSON manifest of the SHORE model fitted and of its output files.')
     fodf = File(
         desc='Fiber Orientation Distribution Function output file name')
     dodf = File(
@@ -405,16 +1091,10 @@ class SHORE(DipyDiffusionInterface):
     def _run_interface(self, runtime):
         # import nibabel as nib
 
-        import pickle as pickle
-
         from dipy.data import get_sphere
         from dipy.io import read_bvals_bvecs
         from dipy.core.gradients import gradient_table
         from dipy.reconst.shore import ShoreModel
-        from dipy.reconst.odf import gfa
-        from dipy.reconst.csdeconv import odf_sh_to_sharp
-        from dipy.reconst.shm import sf_to_sh
-        from dipy.core.ndindex import ndindex
 
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
@@ -436,8 +1116,10 @@ class SHORE(DipyDiffusionInterface):
         else:
             msk = clipMask(np.ones(imref.shape).astype('float32'))
 
-        data = img.get_data().astype(np.float32)
-        data[msk == 0] *= 0
+        # Only the voxels inside the mask are fitted, the others are left to zero
+        mask = msk != 0
+        voxels = img.get_data()[mask].astype(np.float32)
+        nvoxels = voxels.shape[0]
 
         # hdr = imref.header.copy()
 
@@ -450,15 +1132,10 @@ class SHORE(DipyDiffusionInterface):
         shore_model = ShoreModel(gtab, radial_order=self.inputs.radial_order, zeta=self.inputs.zeta,
                                  lambdaN=self.inputs.lambda_n, lambdaL=self.inputs.lambda_l)
 
-        f = gzip.open(op.abspath('shoremodel.pklz'), 'wb')
-        pickle.dump(shore_model, f, -1)
-        f.close()
-
         lmax = self.inputs.radial_order
-        datashape = data.shape
-        dimsODF = list(datashape)
-        dimsODF[3] = int((lmax + 1) * (lmax + 2) / 2)
+        dimsODF = list(mask.shape) + [int((lmax + 1) * (lmax + 2) / 2)]
         shODF = np.zeros(dimsODF)
+        shFODF = np.zeros(dimsODF)
         GFA = np.zeros(dimsODF[:3])
         RTOP = np.zeros(dimsODF[:3])
         MSD = np.zeros(dimsODF[:3])
@@ -469,26 +1146,28 @@ class SHORE(DipyDiffusionInterface):
         else:
             basis = 'descoteaux07'
 
-        # calculate odf per slice
-        IFLOGGER.info('Fitting SHORE model')
-        for i in ndindex(data.shape[:1]):
-            print("Processing slice #%i " % i)
-            start_time = time.time()
-            shorefit = shore_model.fit(data[i])
-            sliceODF = shorefit.odf(sphere)
-            sliceGMSD = shorefit.msd()
-            sliceRTOP = shorefit.rtop_signal()
-            sliceGFA = gfa(sliceODF)
-            shODF[i] = sf_to_sh(
-                sliceODF, sphere, sh_order=lmax, basis_type=basis)
-            GFA[i] = np.nan_to_num(sliceGFA)
-            MSD[i] = np.nan_to_num(sliceGMSD)
-            RTOP[i] = np.nan_to_num(sliceRTOP)
-            print("Computation Time (slice %s): " %
-                  str(i) + str(time.time() - start_time) + " seconds")
-
-        shFODF = odf_sh_to_sharp(shODF, sphere, basis=basis, ratio=0.2, sh_order=lmax, lambda_=1.0, tau=0.1,
-                                 r2_term=True)
+        # Each job gets at least one chunk of voxels
+        n_jobs = max(1, self.inputs.n_jobs)
+        chunk_size = min(self.inputs.chunk_size, -(-nvoxels // n_jobs))
+
+        IFLOGGER.info(f'Fitting SHORE model in {nvoxels} voxels ({n_jobs} jobs)')
+        start_time = time.time()
+        mask_index = np.flatnonzero(mask)
+        out_maps = {
+            "dodf": shODF.reshape(-1, dimsODF[3]),
+            "fodf": shFODF.reshape(-1, dimsODF[3]),
+            "GFA": GFA.reshape(-1),
+            "MSD": MSD.reshape(-1),
+            "RTOP": RTOP.reshape(-1),
+        }
+        for start, chunk_maps in map_chunks(_fit_shore_voxels_worker, voxels, chunk_size, n_jobs,
+                                            initializer=_init_shore_worker,
+                                            initargs=(shore_model, sphere, lmax, basis)):
+            index = mask_index[start:start + chunk_size]
+            for name, out_map in out_maps.items():
+                out_map[index] = chunk_maps[name]
+            IFLOGGER.info(f'  ... {start + len(index)}/{nvoxels} voxels fitted')
+        IFLOGGER.info(f'Computation Time: {time.time() - start_time} seconds')
 
         IFLOGGER.info('Save Spherical Harmonics / MSD / GFA images')
 
@@ -503,11 +1182,25 @@ class SHORE(DipyDiffusionInterface):
         nib.Nifti1Image(shFODF, affine).to_filename(
             op.abspath('shore_fodf.nii.gz'))
 
+        save_recon_manifest(
+            op.abspath('shore_model.json'), 'SHORE',
+            files=dict((name, fname) for name, fname in self._list_outputs().items() if name != 'model'),
+            parameters={
+                "sphere": "symmetric724",
+                "radial_order": self.inputs.radial_order,
+                "zeta": self.inputs.zeta,
+                "lambda_n": self.inputs.lambda_n,
+                "lambda_l": self.inputs.lambda_l,
+                "sh_order": lmax,
+                "sh_basis_type": basis,
+            }
+        )
+
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['model'] = op.abspath('shoremodel.pklz')
+        outputs['model'] = op.abspath('shore_model.json')
         outputs['fodf'] = op.abspath('shore_fodf.nii.gz')
         outputs['dodf'] = op.abspath('shore_dodf.nii.gz')
         outputs['GFA'] = op.abspath('shore_gfa.nii.gz')
@@ -520,7 +1213,7 @@ class TensorInformedEudXTractographyInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc='input diffusion data')
     in_fa = File(exists=True, mandatory=True, desc='input FA')
     in_model = File(exists=True, mandatory=True, desc=(
-        'input Tensor model extracted from.'))
+        'input JSON manifest of the peaks extracted from the tensors.'))
     tracking_mask = File(exists=True, mandatory=True,
                          desc='input mask within which perform tracking')
     seed_mask = InputMultiPath(File(
@@ -537,13 +1230,27 @@ class TensorInformedEudXTractographyInputSpec(BaseInterfaceInputSpec):
                              desc='save seeding voxels coordinates')
     num_seeds = traits.Int(10000, mandatory=True, usedefault=True,
                            desc='desired number of tracks in tractography')
+    seeding = traits.Enum(["density", "stratified", "uniform"], usedefault=True,
+                          desc='Place the seeds on a regular grid with a density of num_seeds / #voxels + 1 '
+                               'seeds per voxel along each direction (density, default), or place exactly '
+                               'num_seeds seeds split between the voxels of the seed mask (stratified) '
+                               'or in voxels drawn independently (uniform)')
+    seed_weights = File(exists=True,
+                        desc='Probability map weighting the density of seeds in the voxels of the seed mask')
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc='Number of processes in which the seeds are tracked')
+    seeds_per_chunk = traits.Int(10000, usedefault=True,
+                                 desc='Number of seeds tracked at once by a process')
+    random_seed = traits.Int(desc='Seed of the random number generator used for tracking '
+                                  '(Default: value of the DIPY_RNG_SEED environment variable if set, '
+                                  'else a random seed that is logged)')
     out_prefix = traits.Str(desc='output prefix for file names')
 
 
 class TensorInformedEudXTractographyOutputSpec(TraitedSpec):
     tracks = File(desc='TrackVis file containing extracted streamlines')
-    out_seeds = File(desc=('file containing the (N,3) *voxel* coordinates used'
-                           ' in seeding.'))
+    out_seeds = File(desc=('file containing the (N,3) RAS+mm coordinates of the'
+                           ' seeds.'))
 
 
 class TensorInformedEudXTractography(DipyBaseInterface):
@@ -554,7 +1261,7 @@ class TensorInformedEudXTractography(DipyBaseInterface):
     >>> from cmtklib.interfaces import dipy as ndp
     >>> track = ndp.TensorInformedEudXTractography()
     >>> track.inputs.in_file = '4d_dwi.nii'
-    >>> track.inputs.in_model = 'model.pklz'
+    >>> track.inputs.in_model = '4d_dwi_tenmodel.json'
     >>> track.inputs.tracking_mask = 'dilated_wm_mask.nii'
     >>> res = track.run()  # doctest: +SKIP
 
@@ -565,24 +1272,17 @@ class TensorInformedEudXTractography(DipyBaseInterface):
 
     def _run_interface(self, runtime):
         from dipy.tracking import utils
-        from dipy.direction import peaks_from_model
-        # from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
-        from dipy.tracking.stopping_criterion import ThresholdStoppingCriterion
-        from dipy.tracking.local_tracking import LocalTracking
-        from dipy.data import get_sphere
-        from dipy.io.stateful_tractogram import Space, StatefulTractogram
-        from dipy.io.streamline import save_trk
-        # import marshal as pickle
-        import pickle as pickle
 
         if not (isdefined(self.inputs.in_model)):
             raise RuntimeError("in_model should be supplied")
 
+        # Shared by the seeding and the tracking of all the chunks of seeds
+        random_seed = _get_tracking_random_seed(self.inputs.random_seed)
+
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
         hdr = imref.header.copy()
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
@@ -593,8 +1293,6 @@ class TensorInformedEudXTractography(DipyBaseInterface):
         trkhdr['voxel_order'] = 'ras'
         # trackvis_affine = utils.affine_for_trackvis(trkhdr['voxel_size'])
 
-        sphere = get_sphere('symmetric724')
-
         def clipMask(mask):
             """This is a hack until we fix the behaviour of the tracking objects around the edge of the image."""
             out = mask.copy()
@@ -613,37 +1311,36 @@ class TensorInformedEudXTractography(DipyBaseInterface):
         else:
             tmsk = np.ones(imref.shape)
 
-        seeds = self.inputs.num_seeds
-
         if isdefined(self.inputs.seed_mask[0]):
             IFLOGGER.info('Loading Seed Mask')
             seedmsk = nib.load(self.inputs.seed_mask[0]).get_data()
             IFLOGGER.info(f'  - Loaded Seed Mask Shape: {seedmsk.shape}')
             # seedmsk = clipMask(nib.load(self.inputs.seed_mask[0]).get_data())
             # assert (seedmsk.shape == data.shape[:3])
-            seedmsk[seedmsk > 0] = 1
-            seedmsk[seedmsk < 1] = 0
-            seedps = np.array(np.where(seedmsk == 1), dtype=np.float32).T
-            vseeds = seedps.shape[0]
-            nsperv = (seeds // vseeds) + 1
-            IFLOGGER.info(f'Seed mask is provided ({vseeds} voxels inside '
-                          f'mask), computing seeds ({nsperv} seeds/voxel).')
-            if nsperv > 1:
-                IFLOGGER.info(f'Needed {nsperv} seeds per selected voxel (total {vseeds}).')
-                seedps = np.vstack(np.array([seedps] * nsperv))
-                voxcoord = seedps + np.random.uniform(-1, 1, size=seedps.shape)
-                nseeds = voxcoord.shape[0]
-                seeds = affine.dot(np.vstack((voxcoord.T, np.ones((1, nseeds)))))[:3, :].T
-
-                if self.inputs.save_seeds:
-                    np.savetxt(self._gen_filename('seeds', ext='.txt'), seeds)
-
-            IFLOGGER.info(f'Create seeds for fiber tracking from the binary seed mask (density: {nsperv})')
-
-            tseeds = utils.seeds_from_mask(seedmsk,
-                                           affine=affine,
-                                           density=[nsperv, nsperv, nsperv]  # FIXME: density should be customizable
-                                           )
+            seed_weights = None
+            if isdefined(self.inputs.seed_weights):
+                seed_weights = np.squeeze(nib.load(self.inputs.seed_weights).get_data())
+
+            if self.inputs.seeding == 'density':
+                seedmsk[seedmsk > 0] = 1
+                seedmsk[seedmsk < 1] = 0
+                nsperv = (self.inputs.num_seeds // np.count_nonzero(seedmsk)) + 1
+                IFLOGGER.info(f'Create seeds for fiber tracking from the binary seed mask (density: {nsperv})')
+                tseeds = utils.seeds_from_mask(seedmsk,
+                                               affine=affine,
+                                               density=[nsperv, nsperv, nsperv])
+            else:
+                IFLOGGER.info(f'Create {self.inputs.num_seeds} seeds for fiber tracking '
+                              f'from the seed mask ({self.inputs.seeding} seeding)')
+                tseeds = generate_seeds(seedmsk, affine, self.inputs.num_seeds,
+                                        strategy=self.inputs.seeding,
+                                        weights=seed_weights,
+                                        random_seed=random_seed,
+                                        batch_size=self.inputs.seeds_per_chunk)
+            if self.inputs.save_seeds:
+                tseeds = _save_seed_batches(
+                    [tseeds] if isinstance(tseeds, np.ndarray) else tseeds,
+                    self._gen_filename('seeds', ext='.txt'))
 
         IFLOGGER.info('Loading and masking FA')
         img_fa = nib.load(self.inputs.in_fa)
@@ -656,35 +1353,27 @@ class TensorInformedEudXTractography(DipyBaseInterface):
             self._gen_filename('fa_masked'))
 
         IFLOGGER.info('Building Tissue Classifier')
-        classifier = ThresholdStoppingCriterion(fa, self.inputs.fa_thresh)
-        # classifier = BinaryStoppingCriterion(tmsk)
-
-        IFLOGGER.info('Loading tensor model')
-        f = gzip.open(self.inputs.in_model, 'rb')
-        tensor_model = pickle.load(f)
-        f.close()
-
-        IFLOGGER.info('Generating peaks from tensor model')
-        dti_peaks = peaks_from_model(model=tensor_model,
-                                     data=data,
-                                     sphere=sphere,
-                                     relative_peak_threshold=.2,
-                                     min_separation_angle=25,
-                                     mask=tmsk,
-                                     normalize_peaks=False,  # changed
-                                     parallel=True)
+        classifier = {"type": "threshold", "metric_map": fa, "threshold": self.inputs.fa_thresh}
+        # classifier = {"type": "binary", "mask": tmsk}
 
         IFLOGGER.info('Performing tensor-informed EuDX tractography')
-        streamlines = LocalTracking(dti_peaks,
-                                    classifier,
-                                    tseeds,
-                                    affine,
-                                    step_size=self.inputs.step_size,
-                                    max_cross=1)
+        # The peaks extracted from the tensors are read from the reconstruction outputs
+        tracking_params = {
+            "direction_getter": {"type": "peaks",
+                                 "manifest": self.inputs.in_model,
+                                 "mask": tmsk},
+            "stopping_criterion": classifier,
+            "tracking": {"type": "local",
+                         "affine": affine,
+                         "step_size": self.inputs.step_size,
+                         "random_seed": random_seed},
+        }
+        streamlines = run_tracking(tseeds, tracking_params,
+                                   n_jobs=self.inputs.n_jobs, chunk_size=self.inputs.seeds_per_chunk)
 
         IFLOGGER.info('Saving tracks')
-        sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-        save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+        nb_streamlines = save_trk_streaming(streamlines, imref, self._gen_filename('tracked', ext='.trk'))
+        IFLOGGER.info(f'  ... {nb_streamlines} streamlines saved')
 
         return runtime
 
@@ -740,14 +1429,26 @@ class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
                                              desc='Partial volume estimation result files (required if performing ACT)')
     # in_t1 = File(exists=True, desc=('input T1w (required if performing ACT)'))
     in_model = File(exists=True, mandatory=True,
-                    desc='input f/d-ODF model extracted from.')
+                    desc='input JSON manifest of the f/d-ODF model (peaks and spherical harmonics coefficients)')
     tracking_mask = File(exists=True, mandatory=True,
                          desc='input mask within which perform tracking')
     seed_mask = InputMultiPath(File(exists=True), mandatory=True,
                                desc='ROI files registered to diffusion space')
+    seeding = traits.Enum(["density", "stratified", "uniform"],
+                          usedefault=True,
+                          desc='Place the seeds on a regular grid of seed_density seeds per voxel '
+                               'along each direction (density, default), or place exactly num_seeds seeds '
+                               'split between the voxels of the seed mask (stratified) '
+                               'or in voxels drawn independently (uniform)')
     seed_density = traits.Float(1,
                                 usedefault=True,
-                                desc='Density of seeds')
+                                desc='Density of seeds (if seeding is density)')
+    seed_weights = File(exists=True,
+                        desc='Probability map weighting the density of seeds in the voxels of the seed mask')
+    weight_seeds_by_gmwmi = traits.Bool(False,
+                                        usedefault=True,
+                                        desc='Weight the density of seeds by the values of the '
+                                             'Gray Matter / White Matter interface image (if seed_from_gmwmi)')
     fa_thresh = traits.Float(0.2,
                              mandatory=True, usedefault=True,
                              desc='FA threshold to build the tissue classifier')
@@ -766,6 +1467,13 @@ class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
     num_seeds = traits.Int(10000,
                            mandatory=True, usedefault=True,
                            desc='desired number of tracks in tractography')
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc='Number of processes in which the seeds are tracked')
+    seeds_per_chunk = traits.Int(10000, usedefault=True,
+                                 desc='Number of seeds tracked at once by a process')
+    random_seed = traits.Int(desc='Seed of the random number generator used for tracking '
+                                  '(Default: value of the DIPY_RNG_SEED environment variable if set, '
+                                  'else a random seed that is logged)')
     out_prefix = traits.Str(desc='output prefix for file names')
 
 
@@ -773,8 +1481,8 @@ class DirectionGetterTractographyOutputSpec(TraitedSpec):
     tracks = File(desc='TrackVis file containing extracted streamlines')
     tracks2 = File(desc='TrackVis file containing extracted streamlines')
     tracks3 = File(desc='TrackVis file containing extracted streamlines')
-    out_seeds = File(desc=('file containing the (N,3) *voxel* coordinates used'
-                           ' in seeding.'))
+    out_seeds = File(desc=('file containing the (N,3) RAS+mm coordinates of the'
+                           ' seeds.'))
     streamlines = File(desc='Numpy array of streamlines')
 
 
@@ -786,7 +1494,7 @@ class DirectionGetterTractography(DipyBaseInterface):
     >>> from cmtklib.interfaces import dipy as ndp
     >>> track = ndp.DirectionGetterTractography()
     >>> track.inputs.in_file = '4d_dwi.nii'
-    >>> track.inputs.in_model = 'model.pklz'
+    >>> track.inputs.in_model = '4d_dwi_csdmodel.json'
     >>> track.inputs.tracking_mask = 'dilated_wm_mask.nii'
     >>> res = track.run()  # doctest: +SKIP
 
@@ -797,31 +1505,21 @@ class DirectionGetterTractography(DipyBaseInterface):
 
     def _run_interface(self, runtime):
         from dipy.tracking import utils
-        from dipy.direction import DeterministicMaximumDirectionGetter, ProbabilisticDirectionGetter
-        from dipy.tracking.stopping_criterion import BinaryStoppingCriterion, CmcStoppingCriterion
-        from dipy.tracking.local_tracking import LocalTracking, ParticleFilteringTracking
-        from dipy.direction.peaks import peaks_from_model
-        from dipy.data import get_sphere
-        from dipy.tracking.streamline import Streamlines
-        from dipy.io.stateful_tractogram import Space, StatefulTractogram
-        from dipy.io.streamline import save_trk
-        import pickle
-        import gzip
 
         if not (isdefined(self.inputs.in_model)):
             raise RuntimeError('in_model should be supplied')
 
+        # Shared by the seeding and the tracking of all the chunks of seeds
+        random_seed = _get_tracking_random_seed(self.inputs.random_seed)
+
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
         hdr = imref.header.copy()
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
 
-        sphere = get_sphere('symmetric724')
-
         def clipMask(mask):
             """This is a hack until Dipy fixes the behaviour of the tracking objects
             around the edge of the image"""
@@ -856,11 +1554,12 @@ class DirectionGetterTractography(DipyBaseInterface):
 
             IFLOGGER.info('Building CMC Tissue Classifier')
 
-            cmc_classifier = CmcStoppingCriterion.from_pve(img_pve_wm.get_data(),
-                                                           img_pve_gm.get_data(),
-                                                           img_pve_csf.get_data(),
-                                                           step_size=step_size,
-                                                           average_voxel_size=voxel_size)
+            cmc_classifier = {"type": "cmc",
+                              "wm": img_pve_wm.get_data(),
+                              "gm": img_pve_gm.get_data(),
+                              "csf": img_pve_csf.get_data(),
+                              "step_size": step_size,
+                              "average_voxel_size": voxel_size}
 
             if self.inputs.recon_model == 'CSD':
                 IFLOGGER.info('Creating mask used by CSD model from partial volume maps of GM and WM')
@@ -911,21 +1610,24 @@ class DirectionGetterTractography(DipyBaseInterface):
                 self._gen_filename('fa_masked'))
 
             IFLOGGER.info('Building Binary Tissue Classifier')
-            # classifier = ThresholdStoppingCriterion(fa,self.inputs.fa_thresh)
-            classifier = BinaryStoppingCriterion(tmsk)
-
-        seeds = self.inputs.num_seeds
+            # classifier = {"type": "threshold", "metric_map": fa, "threshold": self.inputs.fa_thresh}
+            classifier = {"type": "binary", "mask": tmsk}
 
         if isdefined(self.inputs.seed_mask[0]) or (self.inputs.seed_from_gmwmi and isdefined(self.inputs.gmwmi_file)):
 
             # Handle GMWM interface or seed mask
+            seed_weights = None
             if self.inputs.seed_from_gmwmi and isdefined(self.inputs.gmwmi_file):
                 IFLOGGER.info(f'Loading Seed Mask from {self.inputs.gmwmi_file}')
                 seedmsk = nib.load(self.inputs.gmwmi_file).get_data()
                 seedmsk = np.squeeze(seedmsk)
+                if self.inputs.weight_seeds_by_gmwmi:
+                    seed_weights = seedmsk.copy()
             else:
                 IFLOGGER.info(f'Loading Seed Mask from {self.inputs.seed_mask[0]}')
                 seedmsk = nib.load(self.inputs.seed_mask[0]).get_data()
+            if isdefined(self.inputs.seed_weights):
+                seed_weights = np.squeeze(nib.load(self.inputs.seed_weights).get_data())
 
             # assert (seedmsk.shape == data.shape[:3])
             # seedmsk = clipMask(seedmsk)
@@ -942,117 +1644,63 @@ class DirectionGetterTractography(DipyBaseInterface):
                             affine,
                             hdr).to_filename(self._gen_filename('desc-seed_mask'))
 
-            seedps = np.array(np.where(seedmsk == 1), dtype=np.float32).T
-            vseeds = seedps.shape[0]
-            nsperv = (seeds // vseeds) + 1
-            IFLOGGER.info(f'Seed mask is provided ({vseeds} voxels inside '
-                          f'mask), computing seeds ({nsperv} seeds/voxel).')
-            if nsperv > 1:
-                IFLOGGER.info(f'Needed {nsperv} seeds per selected voxel '
-                              f'(total {vseeds}).')
-                seedps = np.vstack(np.array([seedps] * nsperv))
-                voxcoord = seedps + np.random.uniform(-1, 1, size=seedps.shape)
-                nseeds = voxcoord.shape[0]
-                seeds = affine.dot(np.vstack((voxcoord.T, np.ones((1, nseeds)))))[:3, :].T
-
-                if self.inputs.save_seeds:
-                    np.savetxt(self._gen_filename('seeds', ext='.txt'), seeds)
-
-            IFLOGGER.info(f'Create seeds for fiber tracking from the binary seed mask (density: {self.inputs.seed_density})')
-            tseeds = utils.seeds_from_mask(seedmsk,
-                                           affine=affine,
-                                           density=[self.inputs.seed_density,
-                                                    self.inputs.seed_density,
-                                                    self.inputs.seed_density]  # FIXME: density should be customizable
-                                           )
+            if self.inputs.seeding == 'density':
+                IFLOGGER.info(f'Create seeds for fiber tracking from the binary seed mask (density: {self.inputs.seed_density})')
+                tseeds = utils.seeds_from_mask(seedmsk,
+                                               affine=affine,
+                                               density=[self.inputs.seed_density,
+                                                        self.inputs.seed_density,
+                                                        self.inputs.seed_density])
+            else:
+                IFLOGGER.info(f'Create {self.inputs.num_seeds} seeds for fiber tracking '
+                              f'from the seed mask ({self.inputs.seeding} seeding)')
+                tseeds = generate_seeds(seedmsk, affine, self.inputs.num_seeds,
+                                        strategy=self.inputs.seeding,
+                                        weights=seed_weights,
+                                        random_seed=random_seed,
+                                        batch_size=self.inputs.seeds_per_chunk)
+            if self.inputs.save_seeds:
+                tseeds = _save_seed_batches(
+                    [tseeds] if isinstance(tseeds, np.ndarray) else tseeds,
+                    self._gen_filename('seeds', ext='.txt'))
 
         if self.inputs.recon_model == 'CSD':
+            # The spherical harmonics coefficients are read from the reconstruction outputs
             IFLOGGER.info('Loading CSD model')
-            f = gzip.open(self.inputs.in_model, 'rb')
-            csd_model = pickle.load(f)
-            f.close()
-
-            IFLOGGER.info('Generating peaks from CSD model')
-            pfm = peaks_from_model(model=csd_model,
-                                   data=data,
-                                   sphere=sphere,
-                                   relative_peak_threshold=.2,
-                                   min_separation_angle=self.inputs.max_angle,
-                                   mask=tmsk,
-                                   return_sh=True,
-                                   # sh_basis_type=args.basis,
-                                   sh_order=self.inputs.recon_order,
-                                   normalize_peaks=False,  # changed
-                                   parallel=True)
-
-            if self.inputs.algo == 'deterministic':
-                dg = DeterministicMaximumDirectionGetter.from_shcoeff(pfm.shm_coeff,
-                                                                      max_angle=self.inputs.max_angle,
-                                                                      sphere=sphere)
-            else:
-                dg = ProbabilisticDirectionGetter.from_shcoeff(pfm.shm_coeff,
-                                                               max_angle=self.inputs.max_angle,
-                                                               sphere=sphere)
+            dg = {"type": self.inputs.algo,
+                  "manifest": self.inputs.in_model,
+                  "mask": tmsk,
+                  "max_angle": self.inputs.max_angle}
         else:
             IFLOGGER.info('Loading SHORE FOD')
             sh = nib.load(self.inputs.fod_file).get_data()
             sh = np.nan_to_num(sh)
             IFLOGGER.info('Generating peaks from SHORE model')
-            if self.inputs.algo == 'deterministic':
-                dg = DeterministicMaximumDirectionGetter.from_shcoeff(sh,
-                                                                      max_angle=self.inputs.max_angle,
-                                                                      sphere=sphere)
-            else:
-                dg = ProbabilisticDirectionGetter.from_shcoeff(sh,
-                                                               max_angle=self.inputs.max_angle,
-                                                               sphere=sphere)
+            dg = {"type": self.inputs.algo, "shcoeff": sh, "max_angle": self.inputs.max_angle}
 
+        tracking_params = {
+            "direction_getter": dg,
+            "tracking": {"affine": affine,
+                         "step_size": self.inputs.step_size,
+                         "random_seed": random_seed},
+        }
         if not self.inputs.use_act:
             IFLOGGER.info('Performing %s tractography' % self.inputs.algo)
-
-            streamlines = LocalTracking(dg,
-                                        classifier,
-                                        tseeds,
-                                        affine,
-                                        step_size=self.inputs.step_size,
-                                        max_cross=1)
-
-            IFLOGGER.info('Saving tracks')
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+            tracking_params["stopping_criterion"] = classifier
+            tracking_params["tracking"]["type"] = "local"
         else:
             IFLOGGER.info('Performing PFT tractography')
             # Particle Filtering Tractography
-            pft_streamline_generator = ParticleFilteringTracking(dg,
-                                                                 cmc_classifier,
-                                                                 tseeds,
-                                                                 affine,
-                                                                 max_cross=1,
-                                                                 step_size=step_size,
-                                                                 maxlen=200,
-                                                                 pft_back_tracking_dist=2,
-                                                                 pft_front_tracking_dist=1,
-                                                                 particle_count=15,
-                                                                 return_all=False)
-            IFLOGGER.info('Saving tracks')
-            # streamlines = list(pft_streamline_generator)
-            streamlines = Streamlines(pft_streamline_generator)
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
-
-            # from nibabel.streamlines import Field, Tractogram
-            # from nibabel.orientations import aff2axcodes
-
-            # print('-> Load nifti and copy header 1')
-
-            # trkhdr = nib.trackvis.empty_header()
-            # trkhdr['dim'] = imref.shape[:3]
-            # trkhdr['voxel_size'] = imref.header.get_zooms()[:3]
-            # trkhdr['voxel_order'] = "".join(aff2axcodes(imref.affine))
-            # # utils.affine_for_trackvis(trkhdr['voxel_size'])
-            # trkhdr['vox_to_ras'] = imref.affine.copy()
-
-            # np.save(self._gen_filename('streamlines', ext='.npy'), streamlines)
+            tracking_params["stopping_criterion"] = cmc_classifier
+            tracking_params["tracking"]["type"] = "pft"
+            tracking_params["tracking"]["step_size"] = step_size
+
+        streamlines = run_tracking(tseeds, tracking_params,
+                                   n_jobs=self.inputs.n_jobs, chunk_size=self.inputs.seeds_per_chunk)
+
+        IFLOGGER.info('Saving tracks')
+        nb_streamlines = save_trk_streaming(streamlines, imref, self._gen_filename('tracked', ext='.trk'))
+        IFLOGGER.info(f'  ... {nb_streamlines} streamlines saved')
 
         return runtime
 
@@ -1085,6 +1733,9 @@ class DirectionGetterTractography(DipyBaseInterface):
 
 
 class MAPMRIInputSpec(DipyBaseInterfaceInputSpec):
+    in_mask = File(exists=True, desc=(
+        'input mask in which compute MAP-MRI solution'))
+
     laplacian_regularization = traits.Bool(
         True, usedefault=True, desc='Apply laplacian regularization')
 
@@ -1103,9 +1754,17 @@ class MAPMRIInputSpec(DipyBaseInterfaceInputSpec):
     big_delta = traits.Float(0.5, mandatory=True,
                              desc='Small data for gradient table')
 
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc='Number of processes in which the voxels are fitted')
+
+    block_size = traits.Int(
+        2000, usedefault=True,
+        desc='Maximal number of voxels fitted at once by a process, which bounds '
+             'the memory used by the coefficients of the model')
+
 
 class MAPMRIOutputSpec(TraitedSpec):
-    model = File(desc='Python pickled object of the MAP-MRI model fitted.')
+    model = File(desc='JSON manifest of the MAP-MRI model fitted and of its output maps.')
     rtop_file = File(desc='rtop output file name')
     rtap_file = File(desc='rtap output file name')
     rtpp_file = File(desc='rtpp output file name')
@@ -1138,13 +1797,19 @@ class MAPMRI(DipyDiffusionInterface):
     def _run_interface(self, runtime):
         from dipy.reconst import mapmri
         from dipy.core.gradients import gradient_table
-        import pickle as pickle
-        import gzip
 
         img = nib.load(self.inputs.in_file)
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
+        if isdefined(self.inputs.in_mask):
+            mask = nib.load(self.inputs.in_mask).get_data() > 0
+        else:
+            mask = np.ones(img.shape[:3], dtype=bool)
+
+        # Only the voxels inside the mask are fitted, the others are left to zero
+        voxels = img.get_data()[mask].astype(np.float32)
+        nvoxels = voxels.shape[0]
+
         gtab = self._get_gradient_table()
         gtab = gradient_table(
             bvals=gtab.bvals, bvecs=gtab.bvecs,
@@ -1161,20 +1826,23 @@ class MAPMRI(DipyDiffusionInterface):
             positivity_constraint=self.inputs.positivity_constraint
         )
 
-        IFLOGGER.info('Fitting MAP-MRI model')
-        mapfit_both_aniso = map_model_both_aniso.fit(data)
-
-        '''maps'''
-        maps = {
-            "rtop": mapfit_both_aniso.rtop(),
-            "rtap": mapfit_both_aniso.rtap(),
-            "rtpp": mapfit_both_aniso.rtpp(),
-            "msd": mapfit_both_aniso.msd(),
-            "qiv": mapfit_both_aniso.qiv(),
-            "ng": mapfit_both_aniso.ng(),
-            "ng_perp": mapfit_both_aniso.ng_perpendicular(),
-            "ng_para": mapfit_both_aniso.ng_parallel()
-        }
+        maps = dict((metric, np.zeros(mask.shape, dtype=np.float32)) for metric in MAPMRI_METRICS)
+
+        # Each job gets at least one block of voxels
+        n_jobs = max(1, self.inputs.n_jobs)
+        block_size = min(self.inputs.block_size, -(-nvoxels // n_jobs))
+
+        IFLOGGER.info(f'Fitting MAP-MRI model in {nvoxels} voxels ({n_jobs} jobs)')
+        start_time = time.time()
+        mask_index = np.flatnonzero(mask)
+        for start, block_maps in map_chunks(_fit_mapmri_voxels_worker, voxels, block_size, n_jobs,
+                                            initializer=_init_mapmri_worker,
+                                            initargs=(map_model_both_aniso,)):
+            index = mask_index[start:start + block_size]
+            for metric, data in block_maps.items():
+                maps[metric].reshape(-1)[index] = data
+            IFLOGGER.info(f'  ... {start + len(index)}/{nvoxels} voxels fitted')
+        IFLOGGER.info(f'Computation Time: {time.time() - start_time} seconds')
 
         ''' The most related to white matter anisotropy are:
             rtpp, for anisotropy
@@ -1183,10 +1851,6 @@ class MAPMRI(DipyDiffusionInterface):
             length/VOLUME = RTOP/RTPP
         '''
 
-        f = gzip.open(self._gen_filename('mapmri', ext='.pklz'), 'wb')
-        pickle.dump(map_model_both_aniso, f, -1)
-        f.close()
-
         # "rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"
         for metric, data in list(maps.items()):
             out_name = self._gen_filename(metric)
@@ -1196,11 +1860,25 @@ class MAPMRI(DipyDiffusionInterface):
             IFLOGGER.info('Shape :')
             IFLOGGER.info(data.shape)
 
+        save_recon_manifest(
+            self._gen_filename('mapmri', ext='.json'), 'MAPMRI',
+            files=dict((metric, self._gen_filename(metric)) for metric in MAPMRI_METRICS),
+            parameters={
+                "radial_order": self.inputs.radial_order,
+                "anisotropic_scaling": True,
+                "laplacian_regularization": self.inputs.laplacian_regularization,
+                "laplacian_weighting": self.inputs.laplacian_weighting,
+                "positivity_constraint": self.inputs.positivity_constraint,
+                "small_delta": self.inputs.small_delta,
+                "big_delta": self.inputs.big_delta,
+            }
+        )
+
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['model'] = self._gen_filename('mapmri', ext='.pklz')
-        for metric in ["rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"]:
+        outputs['model'] = self._gen_filename('mapmri', ext='.json')
+        for metric in MAPMRI_METRICS:
             outputs["{}_file".format(metric)] = self._gen_filename(metric)
         return outputs
@@ -7,7 +7,6 @@
 """The FSL module provides Nipype interfaces for FSL functions missing in Nipype or modified."""
 
 import os
-from glob import glob
 import warnings
 
 from nipype.interfaces.fsl.base import FSLCommand, FSLCommandInputSpec
@@ -18,6 +17,9 @@ from nipype.interfaces.base import (traits, BaseInterface, BaseInterfaceInputSpe
 import nipype.interfaces.fsl as fsl
 from traits.trait_types import Float, Enum
 
+# Own imports
+from cmtklib.util import run_interfaces
+
 warn = warnings.warn
 warnings.filterwarnings('always', category=UserWarning)
 
@@ -444,6 +446,8 @@ class ApplymultipleXfmInputSpec(BaseInterfaceInputSpec):
     interp = Enum('nearestneighbour', 'spline',
                   desc='Interpolation used')
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of files transformed in parallel')
+
 
 class ApplymultipleXfmOutputSpec(TraitedSpec):
     out_files = OutputMultiPath(File(), desc="Transformed files")
@@ -470,20 +474,26 @@ class ApplymultipleXfm(BaseInterface):
     input_spec = ApplymultipleXfmInputSpec
     output_spec = ApplymultipleXfmOutputSpec
 
-    def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = fsl.ApplyXFM(
+    def _interfaces(self):
+        return [
+            fsl.ApplyXFM(
                 in_file=in_file,
                 in_matrix_file=self.inputs.xfm_file,
                 apply_xfm=True,
                 interp=self.inputs.interp,
                 reference=self.inputs.reference)
-            ax.run()
+            for in_file in self.inputs.in_files
+        ]
+
+    def _run_interface(self, runtime):
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(in_file, res.runtime.duration)
+                                  for in_file, res in zip(self.inputs.in_files, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [ax._list_outputs()['out_file'] for ax in self._interfaces()]
         return outputs
 
 
@@ -499,6 +509,8 @@ class ApplymultipleWarpInputSpec(BaseInterfaceInputSpec):
         'nn', 'trilinear', 'sinc', 'spline', argstr='--interp=%s', position=-2,
         desc="Interpolation method")
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of files warped in parallel')
+
 
 class ApplymultipleWarpOutputSpec(TraitedSpec):
     out_files = OutputMultiPath(File(), desc="Warped files")
@@ -525,20 +537,26 @@ class ApplymultipleWarp(BaseInterface):
     input_spec = ApplymultipleWarpInputSpec
     output_spec = ApplymultipleWarpOutputSpec
 
-    def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = fsl.ApplyWarp(
+    def _interfaces(self):
+        return [
+            fsl.ApplyWarp(
                 in_file=in_file,
                 interp=self.inputs.interp,
                 field_file=self.inputs.field_file,
                 ref_file=self.inputs.ref_file
             )
-            ax.run()
+            for in_file in self.inputs.in_files
+        ]
+
+    def _run_interface(self, runtime):
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(in_file, res.runtime.duration)
+                                  for in_file, res in zip(self.inputs.in_files, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [ax._list_outputs()['out_file'] for ax in self._interfaces()]
         return outputs
 
 
@@ -8,7 +8,6 @@
 
 import os
 import os.path as op
-import glob
 
 import nipype.interfaces.base as nibase
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, CommandLineInputSpec, \
@@ -16,6 +15,9 @@ from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, Comman
 from nipype.utils import logger
 from nipype.utils.filemanip import split_filename, fname_presuffix
 
+# Own imports
+from cmtklib.util import run_interfaces
+
 
 class MRtrix_mul_InputSpec(CommandLineInputSpec):
     input1 = nibase.File(desc='Input1 file', position=1,
@@ -512,6 +514,8 @@ class ApplymultipleMRConvertInputSpec(BaseInterfaceInputSpec):
                             desc='"i.e. Bfloat". Can be "char", "short", "int", "long", "float" or "double"',
                             usedefault=True)
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of files converted in parallel')
+
 
 class ApplymultipleMRConvertOutputSpec(TraitedSpec):
     converted_files = OutputMultiPath(File(), desc='Output files')
@@ -533,18 +537,23 @@ class ApplymultipleMRConvert(BaseInterface):
     input_spec = ApplymultipleMRConvertInputSpec
     output_spec = ApplymultipleMRConvertOutputSpec
 
+    def _interfaces(self):
+        # Extract image filename (only) and create output image filename (no renaming)
+        return [
+            MRConvert(in_file=in_file, stride=self.inputs.stride, out_filename=in_file.split('/')[-1],
+                      output_datatype=self.inputs.output_datatype, extension=self.inputs.extension)
+            for in_file in self.inputs.in_files
+        ]
+
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            # Extract image filename (only) and create output image filename (no renaming)
-            out_filename = in_file.split('/')[-1]
-            ax = MRConvert(in_file=in_file, stride=self.inputs.stride, out_filename=out_filename,
-                           output_datatype=self.inputs.output_datatype, extension=self.inputs.extension)
-            ax.run()
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(in_file, res.runtime.duration)
+                                  for in_file, res in zip(self.inputs.in_files, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['converted_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['converted_files'] = [ax._list_outputs()['converted'] for ax in self._interfaces()]
         return outputs
 
 
@@ -735,6 +744,8 @@ class ApplymultipleMRCropInputSpec(BaseInterfaceInputSpec):
 
     template_image = File(mandatory=True, exists=True, desc='Template image')
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of files cropped in parallel')
+
 
 class ApplymultipleMRCropOutputSpec(TraitedSpec):
     out_files = OutputMultiPath(File(), desc='Cropped files')
@@ -764,16 +775,22 @@ class ApplymultipleMRCrop(BaseInterface):
     input_spec = ApplymultipleMRCropInputSpec
     output_spec = ApplymultipleMRCropOutputSpec
 
+    def _interfaces(self):
+        return [
+            MRCrop(in_file=in_file,
+                   template_image=self.inputs.template_image)
+            for in_file in self.inputs.in_files
+        ]
+
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = MRCrop(in_file=in_file,
-                        template_image=self.inputs.template_image)
-            ax.run()
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(in_file, res.runtime.duration)
+                                  for in_file, res in zip(self.inputs.in_files, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [ax._list_outputs()['cropped'] for ax in self._interfaces()]
         return outputs
 
 
@@ -783,6 +800,8 @@ class ApplymultipleMRTransformsInputSpec(BaseInterfaceInputSpec):
 
     template_image = File(mandatory=True, exists=True, desc='Template image')
 
+    n_procs = traits.Int(1, usedefault=True, desc='Number of files transformed in parallel')
+
 
 class ApplymultipleMRTransformsOutputSpec(TraitedSpec):
     out_files = OutputMultiPath(File(), desc='Transformed files')
@@ -812,16 +831,22 @@ class ApplymultipleMRTransforms(BaseInterface):
     input_spec = ApplymultipleMRTransformsInputSpec
     output_spec = ApplymultipleMRTransformsOutputSpec
 
+    def _interfaces(self):
+        return [
+            MRTransform(in_files=in_file,
+                        template_image=self.inputs.template_image)
+            for in_file in self.inputs.in_files
+        ]
+
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            mt = MRTransform(in_files=in_file,
-                             template_image=self.inputs.template_image)
-            mt.run()
+        results = run_interfaces(self._interfaces(), self.inputs.n_procs)
+        runtime.file_durations = [(in_file, res.runtime.duration)
+                                  for in_file, res in zip(self.inputs.in_files, results)]
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [mt._list_outputs()['out_file'] for mt in self._interfaces()]
         return outputs
 
 
@@ -14,7 +14,6 @@ from pathlib import Path
 import pkg_resources
 import subprocess
 import shutil
-import math
 
 import nibabel as ni
 import networkx as nx
@@ -32,6 +31,9 @@ from nipype.interfaces.base import traits, BaseInterfaceInputSpec, TraitedSpec,
     InputMultiPath, OutputMultiPath
 from nipype.utils.logger import logging
 
+# Own imports
+from cmtklib.util import roi_stats
+
 iflogger = logging.getLogger('nipype.interface')
 
 
@@ -136,7 +138,6 @@ class ComputeParcellationRoiVolumes(BaseInterface):
     def _compute_and_save_volumetry(self, roi_fname, roi_info_graphml, parkey):
         iflogger.info("  > Load {}...".format(roi_fname))
         roiImg = ni.load(roi_fname)
-        roiData = roiImg.get_data()
 
         # Compute the volume of the voxel
         voxel_dimX, voxel_dimY, voxel_dimZ = roiImg.header.get_zooms()
@@ -164,6 +165,16 @@ class ComputeParcellationRoiVolumes(BaseInterface):
         gp = nx.read_graphml(roi_info_graphml)
         n_nodes = len(gp)
 
+        # Get the label number of each parcel
+        if self.inputs.parcellation_scheme in ["Custom", "Lausanne2018"]:
+            label_key = "dn_multiscaleID"
+        else:
+            label_key = "dn_correspondence_id"
+        parcel_labels = [d[label_key] for _, d in gp.nodes(data=True)]
+
+        # Count the voxels of all parcels in a single pass over the volume
+        parcel_counts = roi_stats(roi_fname, labels=[int(label) for label in parcel_labels])["count"]
+
         iflogger.info("  > Processing parcels...")
         # variables used by the percent counter
         pc = -1
@@ -178,10 +189,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 iflogger.info('%4.0f%%' % pc)
 
             # Get the label number
-            if self.inputs.parcellation_scheme in ["Custom", "Lausanne2018"]:
-                parcel_label = d["dn_multiscaleID"]
-            else:
-                parcel_label = d["dn_correspondence_id"]
+            parcel_label = parcel_labels[cnt]
 
             # Get if the parcel is cortical or subcortical
             parcel_type = d["dn_region"]
@@ -190,8 +198,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             parcel_name = d["dn_name"]
 
             # Compute the parcel/ROI volume
-            parcel_volumetry = np.sum(roiData == int(
-                    parcel_label)) * voxel_volume
+            parcel_volumetry = parcel_counts[cnt] * voxel_volume
 
             f_volumetry.write(
                     '{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label, parcel_name, parcel_type, parcel_volumetry))
@@ -435,6 +442,177 @@ class ParcellateBrainstemStructures(BaseInterface):
         return outputs
 
 
+def _lookup_labels(lut, volume):
+    """Look up the labels of a volume in a table.
+
+    Negative, non-integer and too large labels get the last entry of the table.
+    """
+    volume = np.asarray(volume)
+    if np.issubdtype(volume.dtype, np.unsignedinteger):
+        return np.take(lut, volume, mode='clip')
+    labels = volume.astype(np.intp)
+    outside = labels < 0
+    if not np.issubdtype(volume.dtype, np.integer):
+        outside |= labels != volume
+    labels[outside] = len(lut) - 1
+    return np.take(lut, labels, mode='clip')
+
+
+def label_set_mask(volume, label_set):
+    """Return the mask of the voxels of a label volume with a label in a set.
+
+    The mask is obtained with a single pass over the volume through a boolean
+    lookup table indexed by label, whatever the number of labels in the set.
+
+    Parameters
+    ----------
+    volume : numpy.ndarray
+        Label volume
+
+    label_set : list of int
+        Labels to include in the mask
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        Boolean mask of the same shape as `volume`
+
+    Examples
+    --------
+    >>> from cmtklib.parcellation import label_set_mask
+    >>> label_set_mask(np.array([0, 4, 10, 43]), [4, 43])
+    array([False,  True, False,  True])
+    """
+    label_set = np.asarray(label_set, dtype=np.intp).ravel()
+    label_set = label_set[label_set >= 0]
+    if label_set.size == 0:
+        return np.zeros(np.shape(volume), dtype=bool)
+    lut = np.zeros(label_set.max() + 2, dtype=bool)
+    lut[label_set] = True
+    return _lookup_labels(lut, volume)
+
+
+def label_source(volume):
+    """Prepare a label volume for :class:`LabelMerger`.
+
+    Parameters
+    ----------
+    volume : numpy.ndarray
+        Label volume. Non-integer and negative values are ignored
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Volume of integer labels that can index a lookup table
+
+    counts : numpy.ndarray
+        Number of voxels of each label
+    """
+    volume = np.asarray(volume)
+    labels = volume.astype(np.intp)
+    invalid = labels < 0
+    if not np.issubdtype(volume.dtype, np.integer):
+        invalid |= labels != volume
+    labels[invalid] = 0
+    counts = np.bincount(labels.ravel())
+    counts[0] -= invalid.sum()
+    return labels, counts
+
+
+class LabelMerger(object):
+    """Merge relabelled label volumes, later relabellings taking precedence.
+
+    Relabellings are only recorded and the maximal label of the merged
+    volume is tracked from the voxel counts of the labels. The merged
+    volume is built at once by :meth:`merge` with one lookup table
+    gather per source volume.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the volumes
+
+    sources : dict
+        Source volumes prepared by :func:`label_source`, indexed by name
+    """
+
+    def __init__(self, shape, sources=None):
+        self.shape = shape
+        self.sources = dict(sources) if sources is not None else {}
+        self._luts = {}
+        self._masks = []
+        self._rank = 0
+        self._max_label = 0
+
+    def add_source(self, name, volume):
+        """Add a source label volume."""
+        self.sources[name] = label_source(volume)
+
+    def _lut(self, name):
+        if name not in self._luts:
+            size = len(self.sources[name][1])
+            self._luts[name] = (np.zeros(size, dtype=np.int32), np.full(size, -1, dtype=np.int32))
+        return self._luts[name]
+
+    def relabel(self, name, old_labels, new_labels):
+        """Relabel voxels of the source volume `name` from `old_labels` to `new_labels`."""
+        counts = self.sources[name][1]
+        old_labels = np.asarray(old_labels, dtype=np.intp)
+        new_labels = np.asarray(new_labels)
+        keep = (old_labels >= 0) & (old_labels < len(counts))
+        old_labels, new_labels = old_labels[keep], new_labels[keep]
+        lut, rank = self._lut(name)
+        lut[old_labels] = new_labels
+        rank[old_labels] = self._rank
+        self._rank += 1
+        present = counts[old_labels] > 0
+        if present.any():
+            self._max_label = max(self._max_label, int(new_labels[present].max()))
+
+    def relabel_range(self, name, low, high, offset):
+        """Relabel voxels of the source volume `name` with labels in [`low`, `high`) to label + `offset`."""
+        old_labels = np.arange(max(low, 0), min(high, len(self.sources[name][1])))
+        self.relabel(name, old_labels, old_labels + offset)
+
+    def assign(self, mask, label):
+        """Assign `label` to the voxels of a boolean `mask`."""
+        self._masks.append((np.asarray(mask, dtype=bool), label, self._rank))
+        self._rank += 1
+        if self._masks[-1][0].any():
+            self._max_label = max(self._max_label, int(label))
+
+    def max_label(self):
+        """Return the maximal label of the merged volume."""
+        return self._max_label
+
+    def merge(self, dtype=np.int16):
+        """Build the merged label volume.
+
+        Parameters
+        ----------
+        dtype : numpy.dtype
+            Data type of the merged volume
+
+        Returns
+        -------
+        merged : numpy.ndarray
+            Merged label volume
+        """
+        merged = np.zeros(self.shape, dtype=np.int32)
+        merged_rank = np.full(self.shape, -1, dtype=np.int32)
+        for name, (lut, rank) in self._luts.items():
+            labels = self.sources[name][0]
+            source_rank = rank[labels]
+            update = source_rank > merged_rank
+            merged[update] = lut[labels[update]]
+            merged_rank[update] = source_rank[update]
+        for mask, label, rank in self._masks:
+            update = mask & (rank > merged_rank)
+            merged[update] = label
+            merged_rank[update] = rank
+        return merged.astype(dtype)
+
+
 class CombineParcellationsInputSpec(BaseInterfaceInputSpec):
     input_rois = InputMultiPath(File(exists=True), desc="Input parcellation files")
 
@@ -706,8 +884,8 @@ class CombineParcellations(BaseInterface):
             print(proc_stdout)
 
         tmp = ni.load(third_vent_dil)
-        indrhypothal = np.where((tmp == 1) & (img_data == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (img_data == left_ventral))
+        indrhypothal = (tmp == 1) & (img_data == right_ventral)
+        indlhypothal = (tmp == 1) & (img_data == left_ventral)
         del tmp
 
         f_color_lut = None
@@ -715,57 +893,16 @@ class CombineParcellations(BaseInterface):
 
         print("create color look up table : ", self.inputs.create_colorLUT)
 
-        for _, roi in enumerate(self.inputs.input_rois):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefix_name = Path(roi).name.split(".")[0]
-                color_lut_file = op.abspath(
-                    '{}_FreeSurferColorLUT.txt'.format(outprefix_name))
-                print("Create colorLUT file as %s" % color_lut_file)
-                f_color_lut = open(color_lut_file, 'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefix_name, time_now),
-                             '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
-                                                                              "A")]
-                f_color_lut.writelines(hdr_lines)
-                del hdr_lines
-
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefix_name = Path(roi).name.split(".")[0]
-                graphml_file = op.abspath('{}.graphml'.format(outprefix_name))
-                print("Create graphml_file as %s" % graphml_file)
-                f_graphml = open(graphml_file, 'w+')
-
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format(
-                                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                                 'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
-                f_graphml.writelines(hdr_lines)
-                del hdr_lines
-
-            # Reading Cortical Parcellation
-            img_v = ni.load(roi)
-            img_data = img_v.get_data()
-
-            # Replacing the brain stem (Stem is replaced by its own parcellation.
-            # Mismatch between both global volumes, mainly due to partial volume
-            # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
-            img_data[indrep] = 0
+        # Label volumes shared by all the scales
+        shared_sources = {}
+        if thalamus_nuclei_defined:
+            shared_sources['thal'] = label_source(img_data_thal)
+        if rh_subfield_defined:
+            shared_sources['subrh'] = label_source(img_data_subrh)
+        if lh_subfield_defined:
+            shared_sources['sublh'] = label_source(img_data_sublh)
+        if brainstem_defined:
+            shared_sources['stem'] = label_source(img_data_stem)
 
         for _, roi in sorted(enumerate(self.inputs.input_rois)):
             # colorLUT creation if enabled
@@ -819,16 +956,19 @@ class CombineParcellations(BaseInterface):
             # Replacing the brain stem (Stem is replaced by its own parcellation.
             # Mismatch between both global volumes, mainly due to partial volume
             # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
+            indrep = img_data == 16
             img_data[indrep] = 0
 
+            # Relabellings are recorded in lookup tables and merged at once,
+            # the later ones taking precedence
+            merger = LabelMerger(img_data.shape, shared_sources)
+            merger.add_source('roi', img_data)
+
             # Processing Right Hemisphere
 
             # Relabelling Right hemisphere
-            img_data_out = np.zeros(img_data.shape, dtype=np.int16)
-            ind = np.where((img_data >= 2000) & (img_data < 3000))
-            img_data_out[ind] = (img_data[ind] - 2000)
-            nlabel = img_data_out.max()
+            merger.relabel_range('roi', 2000, 3000, -2000)
+            nlabel = merger.max_label()
 
             # ColorLUT (cortical)
             if self.inputs.create_colorLUT or self.inputs.create_graphml:
@@ -920,10 +1060,9 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
-                nlabel = img_data_out.max()
+                merger.relabel('thal', right_thalNuclei, new_labels)
+                nlabel = merger.max_label()
 
                 if self.inputs.create_colorLUT:
                     f_color_lut.write("\n")
@@ -966,10 +1105,9 @@ class CombineParcellations(BaseInterface):
                                   '{} \n'.format('    </node>')]
                     f_graphml.writelines(node_lines)
 
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
                 i += 1
-            nlabel = img_data_out.max()
+            merger.relabel('roi', right_subc_labels, new_labels)
+            nlabel = merger.max_label()
 
             if self.inputs.create_colorLUT:
                 f_color_lut.write("\n")
@@ -1014,10 +1152,9 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_subrh == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
-                nlabel = img_data_out.max()
+                merger.relabel('subrh', hippo_subf, new_labels)
+                nlabel = merger.max_label()
 
                 if self.inputs.create_colorLUT:
                     f_color_lut.write("\n")
@@ -1028,9 +1165,8 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update right ventral DC label ({} -> {})".format(right_ventral, new_labels[0]))
-                ind = np.where(img_data == right_ventral)
-                img_data_out[ind] = new_labels[0]
-                nlabel = img_data_out.max()
+                merger.relabel('roi', [right_ventral], new_labels)
+                nlabel = merger.max_label()
 
                 # ColorLUT (right ventral DC)
                 if self.inputs.create_colorLUT:
@@ -1067,8 +1203,8 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update right hypothalamus label ({} -> {})".format(right_ventral, new_labels[0]))
-                img_data_out[indrhypothal] = new_labels[0]
-                nlabel = img_data_out.max()
+                merger.assign(indrhypothal, new_labels[0])
+                nlabel = merger.max_label()
 
                 # ColorLUT (right hypothalamus)
                 if self.inputs.create_colorLUT:
@@ -1100,10 +1236,9 @@ class CombineParcellations(BaseInterface):
 
             # Processing Left Hemisphere
             # Relabelling Left hemisphere
-            ind = np.where((img_data > 1000) & (img_data < 2000))
-            img_data_out[ind] = (img_data[ind] - 1000 + nlabel)
+            merger.relabel_range('roi', 1001, 2000, nlabel - 1000)
             old_nlabel = nlabel
-            nlabel = img_data_out.max()
+            nlabel = merger.max_label()
 
             # ColorLUT (cortical)
             if self.inputs.create_colorLUT or self.inputs.create_graphml:
@@ -1194,10 +1329,9 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
-                nlabel = img_data_out.max()
+                merger.relabel('thal', left_thalNuclei, new_labels)
+                nlabel = merger.max_label()
 
                 if self.inputs.create_colorLUT:
                     f_color_lut.write("\n")
@@ -1239,10 +1373,9 @@ class CombineParcellations(BaseInterface):
                                   '{} \n'.format('    </node>')]
                     f_graphml.writelines(node_lines)
 
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
                 i += 1
-            nlabel = img_data_out.max()
+            merger.relabel('roi', left_subc_labels, new_labels)
+            nlabel = merger.max_label()
 
             if self.inputs.create_colorLUT:
                 f_color_lut.write("\n")
@@ -1286,10 +1419,9 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_sublh == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
-                nlabel = img_data_out.max()
+                merger.relabel('sublh', hippo_subf, new_labels)
+                nlabel = merger.max_label()
                 # newIds_LH_subFields = new_labels
 
                 if self.inputs.create_colorLUT:
@@ -1301,9 +1433,8 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update left ventral DC label ({} -> {})".format(left_ventral, new_labels[0]))
-                ind = np.where(img_data == left_ventral)
-                img_data_out[ind] = new_labels[0]
-                nlabel = img_data_out.max()
+                merger.relabel('roi', [left_ventral], new_labels)
+                nlabel = merger.max_label()
                 # newIds_LH_ventralDC = new_labels
 
                 # ColorLUT (left ventral DC)
@@ -1340,8 +1471,8 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update left hypothalamus label ({} -> {})".format(-1, new_labels[0]))
-                img_data_out[indlhypothal] = new_labels[0]
-                nlabel = img_data_out.max()
+                merger.assign(indlhypothal, new_labels[0])
+                nlabel = merger.max_label()
 
                 # ColorLUT (right hypothalamus)
                 if self.inputs.create_colorLUT:
@@ -1409,9 +1540,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_stem == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                merger.relabel('stem', brainstem, new_labels)
                 # nlabel = img_data_out.max()
 
                 if self.inputs.create_colorLUT:
@@ -1421,7 +1551,7 @@ class CombineParcellations(BaseInterface):
                     f_color_lut.write("# Brain Stem \n")
 
                 new_labels = np.arange(nlabel + 1, nlabel + 2)
-                img_data_out[indrep] = new_labels[0]
+                merger.assign(indrep, new_labels[0])
 
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
@@ -1456,6 +1586,8 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.create_colorLUT:
                     f_color_lut.write("\n")
 
+            img_data_out = merger.merge(np.int16)
+
             # Fix negative values
             img_data_out[img_data_out < 0] = 0
 
@@ -1516,28 +1648,17 @@ class CombineParcellations(BaseInterface):
             # Thalamus (aparc+aseg labels: 10 and 49)
             if thalamus_nuclei_defined:
 
-                ind = np.where(img_data_aparcaseg == 10)
-                mask_aparc_lh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_lh[ind] = 1
+                mask_aparc_lh = img_data_aparcaseg == 10
+                mask_aparc_rh = img_data_aparcaseg == 49
 
-                ind = np.where(img_data_aparcaseg == 49)
-                mask_aparc_rh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_rh[ind] = 1
-
-                mask_thal_lh = np.zeros(img_data_aparcaseg.shape)
-                for lab in left_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_lh[ind] = 1
+                mask_thal_lh = label_set_mask(img_data_thal, left_thalNuclei)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 2 (Gm) or 0
-                tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp > 0)
-                img_data_aparcaseg_new[ind] = 2
+                img_data_aparcaseg_new[mask_aparc_lh & ~mask_thal_lh] = 2
 
                 # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp < 0)
-                img_data_aparcaseg_new[ind] = 10
+                img_data_aparcaseg_new[mask_thal_lh & ~mask_aparc_lh] = 10
+                tmp = mask_aparc_lh.astype(np.float64) - mask_thal_lh
 
                 out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.lh.native.nii.gz')
                 iflogger.info("    ... Save tmp image to {}".format(out_tmp))
@@ -1545,20 +1666,14 @@ class CombineParcellations(BaseInterface):
                     tmp, img_aparcaseg.get_affine(), img_aparcaseg.get_header())
                 ni.save(img_tmp, out_tmp)
 
-                mask_thal_rh = np.zeros(img_data_aparcaseg.shape)
-                for lab in right_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_rh[ind] = 1
+                mask_thal_rh = label_set_mask(img_data_thal, right_thalNuclei)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 41 (Gm) or 0
-                tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp > 0)
-                img_data_aparcaseg_new[ind] = 41
+                img_data_aparcaseg_new[mask_aparc_rh & ~mask_thal_rh] = 41
 
                 # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp < 0)
-                img_data_aparcaseg_new[ind] = 49
+                img_data_aparcaseg_new[mask_thal_rh & ~mask_aparc_rh] = 49
+                tmp = mask_aparc_rh.astype(np.float64) - mask_thal_rh
 
                 out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.rh.native.nii.gz')
                 iflogger.info("    ... Save tmp image to {}".format(out_tmp))
@@ -1568,8 +1683,7 @@ class CombineParcellations(BaseInterface):
 
             # Brainstem (aparc+aseg labels: 16)
             if brainstem_defined:
-                ind = np.where(img_data_aparcaseg == 16)
-                img_data_aparcaseg_new[ind] = 0
+                img_data_aparcaseg_new[img_data_aparcaseg == 16] = 0
                 img_data_aparcaseg_new[indstem] = 16
 
             # new_aparcaseg_native = op.join(fs_dir, 'tmp', 'aparc+aseg.Lausanne2018.native.nii.gz')
@@ -2269,6 +2383,168 @@ def extract(Z, shape, position, fill):
     return R
 
 
+def neighbourhood_distances(shape):
+    """Return the distances of the voxels of a neighbourhood from its center.
+
+    Parameters
+    ----------
+    shape : tuple
+        Tuple containing neighbourhood dimensions (odd dimensions)
+
+    Returns
+    -------
+    dist : numpy.ndarray
+        Float32 array of size `shape` with the distance of each voxel from the center
+    """
+    offsets = np.indices(shape) - (np.array(shape) // 2).reshape((-1, 1, 1, 1))
+    return np.sqrt(np.sum(offsets * offsets, axis=0)).astype('float32')
+
+
+def modal_neighbour_label(vol, shape, position, dist=None):
+    """Return the most frequent label among the nearest labelled neighbours of a voxel.
+
+    The labelled voxels (``vol > 0``) of the neighbourhood of `position`
+    at the smallest distance from it vote for the label. The center voxel
+    does not vote and ties are resolved with the smallest label.
+
+    Parameters
+    ----------
+    vol : numpy.ndarray
+        Label volume
+
+    shape : tuple
+        Tuple containing neighbourhood dimensions (odd dimensions)
+
+    position : tuple
+        Tuple containing the indexes of the voxel
+
+    dist : numpy.ndarray
+        Distances from the center of the neighbourhood
+        computed by :func:`neighbourhood_distances` (optional)
+
+    Returns
+    -------
+    value : int
+        Label of the voxel
+    """
+    if dist is None:
+        dist = neighbourhood_distances(shape)
+    local = extract(vol, shape, position=position, fill=0)
+    mask = local.copy()
+    mask[np.nonzero(local > 0)] = 1
+    thisdist = np.multiply(dist, mask)
+    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
+    value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
+    if value.size > 1:
+        counts = np.bincount(value)
+        value = np.argmax(counts)
+    return int(value)
+
+
+def _box_counts(mask, positions, half):
+    """Count the voxels of `mask` in the boxes of half-size `half` centered at `positions`."""
+    sums = np.zeros(tuple(np.array(mask.shape) + 1), dtype=np.int64)
+    sums[1:, 1:, 1:] = mask.cumsum(0).cumsum(1).cumsum(2)
+    start = [np.clip(positions[k] - half[k], 0, mask.shape[k]) for k in range(3)]
+    stop = [np.clip(positions[k] + half[k] + 1, 0, mask.shape[k]) for k in range(3)]
+    counts = np.zeros(positions.shape[1], dtype=np.int64)
+    for corner in np.ndindex(2, 2, 2):
+        idx = tuple(stop[k] if corner[k] else start[k] for k in range(3))
+        sign = (-1) ** (3 - sum(corner))
+        counts += sign * sums[idx]
+    return counts
+
+
+def nearest_label_dilation(vol, positions, shape=(25, 25, 25)):
+    """Assign to voxels the most frequent label among their nearest labelled neighbours.
+
+    Vectorized equivalent of calling :func:`modal_neighbour_label` for each
+    voxel. The distance to the nearest labelled voxel is given by
+    ``scipy.ndimage.distance_transform_edt`` and the labelled voxels at this
+    distance are gathered shell by shell to vote for the label. Voxels for which
+    the vote differs from a nearest neighbour vote (the voxel itself is labelled,
+    no labelled voxel in the neighbourhood or all of them at the same distance)
+    fall back to :func:`modal_neighbour_label`.
+
+    Parameters
+    ----------
+    vol : numpy.ndarray
+        Label volume
+
+    positions : tuple
+        Tuple of index arrays of the voxels, as returned by ``np.where``
+
+    shape : tuple
+        Tuple containing neighbourhood dimensions (odd dimensions)
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Label of each voxel
+    """
+    positions = np.array(positions, dtype=np.int64).reshape((3, -1))
+    values = np.zeros(positions.shape[1], dtype=np.int_)
+    labelled = vol > 0
+    if positions.shape[1] == 0 or not labelled.any():
+        return values
+
+    half = np.array(shape) // 2
+    radius2 = int(np.min(half)) ** 2
+
+    # Nearest labelled voxel, in the bounding box of the neighbourhoods
+    box_start = np.maximum(positions.min(axis=1) - half, 0)
+    box_stop = np.minimum(positions.max(axis=1) + half + 1, vol.shape)
+    box = tuple(slice(start, stop) for start, stop in zip(box_start, box_stop))
+    fallback = labelled[tuple(positions)]
+    if labelled[box].any():
+        nearest = ndimage.distance_transform_edt(~labelled[box], return_distances=False, return_indices=True)
+        local = positions - box_start.reshape((3, 1))
+        nearest = nearest[(slice(None),) + tuple(local)] - local
+        dist2 = np.sum(nearest * nearest, axis=0)
+        fallback |= dist2 > radius2
+    else:
+        dist2 = np.zeros(positions.shape[1], dtype=np.int64)
+        fallback[:] = True
+
+    # Gather the labelled voxels at the nearest distance, one shell of offsets at a time
+    offsets = (np.indices(shape) - half.reshape((-1, 1, 1, 1))).reshape((3, -1))
+    offsets_dist2 = np.sum(offsets * offsets, axis=0)
+    ind = np.flatnonzero(~fallback)
+    shell_counts = np.zeros(positions.shape[1], dtype=np.int64)
+    voters = []
+    votes = []
+    for d2 in np.unique(dist2[ind]):
+        shell_ind = ind[dist2[ind] == d2]
+        for offset in offsets[:, offsets_dist2 == d2].T:
+            neighbours = positions[:, shell_ind] + offset.reshape((3, 1))
+            inside = np.all((neighbours >= 0) & (neighbours < np.array(vol.shape).reshape((3, 1))), axis=0)
+            neighbour_values = vol[tuple(neighbours[:, inside])]
+            hits = neighbour_values > 0
+            voters.append(shell_ind[inside][hits])
+            votes.append(np.int_(neighbour_values[hits]))
+    voters = np.concatenate(voters) if voters else np.zeros(0, dtype=np.int64)
+    votes = np.concatenate(votes) if votes else np.zeros(0, dtype=np.int_)
+    shell_counts += np.bincount(voters, minlength=positions.shape[1])
+
+    # Zeros also vote when all labelled voxels of the neighbourhood are at the same distance
+    fallback[ind] |= _box_counts(labelled, positions[:, ind], half) == shell_counts[ind]
+
+    # Most frequent label, the smallest one in case of ties
+    if voters.size > 0:
+        keys, counts = np.unique(voters * (votes.max() + 1) + votes, return_counts=True)
+        keys_voter, keys_vote = np.divmod(keys, votes.max() + 1)
+        order = np.lexsort((keys_vote, -counts, keys_voter))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = keys_voter[order][1:] != keys_voter[order][:-1]
+        values[keys_voter[order][first]] = keys_vote[order][first]
+
+    # Voxels outside the nearest neighbour vote
+    dist = neighbourhood_distances(shape)
+    for j in np.flatnonzero(fallback):
+        values[j] = modal_neighbour_label(vol, shape, tuple(positions[:, j]), dist)
+    return values
+
+
 def create_T1_and_Brain(subject_id, subjects_dir):
     """Generates T1, T1 masked and aseg+aparc Freesurfer images in NIFTI format.
 
@@ -2372,29 +2648,15 @@ def create_roi(subject_id, subjects_dir, v=True):
     asegd = aseg.get_data()  # numpy.ndarray
 
     # identify cortical voxels, right (3) and left (42) hemispheres
-    idxr = np.where(asegd == 3)
-    idxl = np.where(asegd == 42)
-    xx = np.concatenate((idxr[0], idxl[0]))
-    yy = np.concatenate((idxr[1], idxl[1]))
-    zz = np.concatenate((idxr[2], idxl[2]))
+    cortex = (asegd == 3) | (asegd == 42)
 
-    # initialize variables necessary for cortical ROIs dilation
     # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
     shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(
-                    np.sum(np.multiply(distxyz, distxyz)))
-
-        # Check existence of tmp folder in input subject folder
-        this_dir = os.path.join(subject_dir, 'tmp')
-        if not (os.path.isdir(this_dir)):
-            os.makedirs(this_dir)
+
+    # Check existence of tmp folder in input subject folder
+    this_dir = os.path.join(subject_dir, 'tmp')
+    if not (os.path.isdir(this_dir)):
+        os.makedirs(this_dir)
 
     # Loop over parcellation scales
     if v:  # pragma: no cover
@@ -2481,37 +2743,15 @@ def create_roi(subject_id, subjects_dir, v=True):
         if i == (nscales - 1):
             print("     ... storing ROIs volume maximal resolution")
             roisMax = vol.copy()
-            idxMax = np.where(roisMax > 0)
-            xxMax = idxMax[0]
-            yyMax = idxMax[1]
-            zzMax = idxMax[2]
         # correct cortical surfaces using as reference the roisMax volume (for consistency between resolutions)
         else:
             print("     > adapt cortical surfaces")
 
-            idxRois = np.where(vol > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
             # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0:
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0
+            newrois[(vol > 0) & (roisMax == 0)] = 0
             # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if newrois[xxMax[j], yyMax[j], zzMax[j]] == 0:
-                    local = extract(vol, shape, position=(
-                        xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(
-                        local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+            idx = np.where((roisMax > 0) & (newrois == 0))
+            newrois[idx] = nearest_label_dilation(vol, idx, shape)
 
         if v:  # pragma: no cover
             print('     ... save output volumes')
@@ -2523,21 +2763,9 @@ def create_roi(subject_id, subjects_dir, v=True):
         # 4. Dilate cortical regions
         if v:  # pragma: no cover
             print("     > dilating cortical regions")
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(vol, shape, position=(
-                    xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(
-                    local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
+        # assign the unlabeled voxels of the aseg GM volume to their nearest labeled neighbours
+        idx = np.where(cortex & (newrois == 0))
+        newrois[idx] = nearest_label_dilation(vol, idx, shape)
 
         # 5. Save Nifti and mgz volumes
         if v:  # pragma: no cover
@@ -2606,8 +2834,6 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     fsmask = ni.load(op.join(fs_dir, 'mri', 'ribbon.nii.gz'))
     fsmaskd = fsmask.get_data()
 
-    wmmask = np.zeros(fsmask.get_data().shape)
-
     # these data is stored and could be extracted from fs_dir/stats/aseg.txt
 
     # FIXME understand when ribbon file has default value or has "aseg" value
@@ -2616,16 +2842,10 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
         iflogger.info("    > Extract right and left wm")
     # Ribbon labels by default
     if fsmaskd.max() == 120:
-        idx_lh = np.where(fsmaskd == 120)
-        idx_rh = np.where(fsmaskd == 20)
+        wmmask = label_set_mask(fsmaskd, [120, 20])
     # Ribbon label w.r.t aseg label
     else:
-        idx_lh = np.where(fsmaskd == 41)
-        idx_rh = np.where(fsmaskd == 2)
-
-    # extract right and left
-    wmmask[idx_lh] = 1
-    wmmask[idx_rh] = 1
+        wmmask = label_set_mask(fsmaskd, [41, 2])
 
     # remove subcortical nuclei from white matter mask
     if v:  # pragma: no cover
@@ -2644,8 +2864,6 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
 
     # ventricle erosion
     iflogger.info("    > Ventricle erosion")
-    csfA = np.zeros(asegd.shape)
-    csfB = np.zeros(asegd.shape)
 
     # structuring elements for erosion
     se1 = np.zeros((3, 3, 5))
@@ -2659,19 +2877,11 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
 
     # lateral ventricles, thalamus proper and caudate
     # the latter two removed for better erosion, but put back afterwards
-    idx = np.where((asegd == 4) |
-                   (asegd == 43) |
-                   (asegd == 11) |
-                   (asegd == 50) |
-                   (asegd == 31) |
-                   (asegd == 63) |
-                   (asegd == 10) |
-                   (asegd == 49))
-    csfA[idx] = 1
+    csfA = label_set_mask(asegd, [4, 43, 11, 50, 31, 63, 10, 49])
 
     if v:  # pragma: no cover
         iflogger.info("    > Save CSF mask")
-    img = ni.Nifti1Image(csfA, aseg.get_affine(), aseg.get_header())
+    img = ni.Nifti1Image(csfA.astype(np.float64), aseg.get_affine(), aseg.get_header())
     ni.save(img, op.join(fs_dir, 'mri', 'csf_mask.nii.gz'))
     del img
 
@@ -2679,11 +2889,7 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
 
     # thalamus proper and caudate are put back because
     # they are not lateral ventricles
-    idx = np.where((asegd == 11) |
-                   (asegd == 50) |
-                   (asegd == 10) |
-                   (asegd == 49))
-    csfA[idx] = 0
+    csfA[label_set_mask(asegd, [11, 50, 10, 49])] = 0
 
     # REST CSF, IE 3RD AND 4TH VENTRICULE
     # and EXTRACEREBRAL CSF
@@ -2699,9 +2905,7 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     #                (asegd == 221))
     # 43 ??, 4??  213?, 221?
     # more to discuss.
-    for i in [5, 14, 15, 24, 44, 72, 75, 76, 213, 221]:
-        idx = np.where(asegd == i)
-        csfB[idx] = 1
+    csfB = label_set_mask(asegd, [5, 14, 15, 24, 44, 72, 75, 76, 213, 221])
 
     # do not remove the subthalamic nucleus for now from the wm mask
     # 23, 60
@@ -2710,34 +2914,20 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     # grey nuclei, either with or without erosion
     if v:  # pragma: no cover
         iflogger.info("    > Grey nuclei, either with or without erosion")
-    gr_ncl = np.zeros(asegd.shape)
+    # without erosion
+    gr_ncl = label_set_mask(asegd, [13, 17, 18, 26, 52, 53, 54, 58])
 
     # with erosion
     for i in [10, 11, 12, 49, 50, 51]:
-        idx = np.where(asegd == i)
-        # temporary volume
-        tmp = np.zeros(asegd.shape)
-        tmp[idx] = 1
-        tmp = imerode(tmp, se)
-        idx = np.where(tmp == 1)
-        gr_ncl[idx] = 1
-
-    # without erosion
-    for i in [13, 17, 18, 26, 52, 53, 54, 58]:
-        idx = np.where(asegd == i)
-        gr_ncl[idx] = 1
+        gr_ncl |= imerode(asegd == i, se)
 
     # remove remaining structure, e.g. brainstem
     if v:  # pragma: no cover
         iflogger.info("    > Remove remaining structure, e.g. brainstem")
-    remaining = np.zeros(asegd.shape)
-    idx = np.where(asegd == 16)
-    remaining[idx] = 1
+    remaining = asegd == 16
 
     # now remove all the structures from the white matter
-    idx = np.where((csfA != 0) | (csfB != 0) |
-                   (gr_ncl != 0) | (remaining != 0))
-    wmmask[idx] = 0
+    wmmask[csfA | csfB | gr_ncl | remaining] = False
     if v:  # pragma: no cover
         iflogger.info(
             "    > Removing lateral ventricles and eroded grey nuclei and brainstem from white matter mask")
@@ -2760,7 +2950,7 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
 
     # output white matter mask. crop and move it afterwards
     wm_out = op.join(fs_dir, 'mri', 'fsmask_1mm.nii.gz')
-    img = ni.Nifti1Image(wmmask, fsmask.get_affine(), fsmask.get_header())
+    img = ni.Nifti1Image(wmmask.astype(np.float64), fsmask.get_affine(), fsmask.get_header())
     if v:  # pragma: no cover
         iflogger.info("    > Save white matter mask: %s" % wm_out)
     ni.save(img, wm_out)
@@ -2941,10 +3131,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 
     print("wm_labels mask....")
     # %% create wm_labels mask
-    nii_wm = np.zeros(nii_apar_cdata.shape, dtype=np.uint8)
-
-    for i in wm_labels:
-        nii_wm[nii_apar_cdata == i] = 1
+    nii_wm = label_set_mask(nii_apar_cdata, wm_labels).astype(np.uint8)
 
     # we do not add subcortical regions
     #    for i in SUBCORTICAL[1]:
@@ -2959,14 +3146,16 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
     print("GM mask....")
     # %% create GM parcellation (CORTICAL+SUBCORTICAL)
     # %  -------------------------------------
+    # lookup table of the mapping (the last entry is used for the labels not mapped)
+    mapping_lut = np.zeros(max(ma[1] for ma in mapping) + 2, dtype=np.uint8)
+    for ma in mapping:
+        mapping_lut[ma[1]] = ma[0]
+
     for park in list(get_parcellation('NativeFreesurfer').keys()):
         print("Parcellation: " + park)
         gm_out = op.join(fs_dir, 'mri', 'ROIv_%s.nii.gz' % park)
 
-        nii_gm = np.zeros(nii_apar_cdata.shape, dtype=np.uint8)
-
-        for ma in mapping:
-            nii_gm[nii_apar_cdata == ma[1]] = ma[0]
+        nii_gm = _lookup_labels(mapping_lut, nii_apar_cdata)
 
         #        # % 33 cortical regions (stored in the order of "parcel33")
         #        for idx,i in enumerate(CORTICAL[1]):
@@ -3006,19 +3195,10 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
     subprocess.check_call(mri_cmd)
 
     asegfile = op.join(fs_dir, 'mri', 'aseg.nii.gz')
-    aseg = ni.load(asegfile).get_data().astype(np.uint32)
-    idx = np.where((aseg == 4) |
-                   (aseg == 43) |
-                   (aseg == 11) |
-                   (aseg == 50) |
-                   (aseg == 31) |
-                   (aseg == 63) |
-                   (aseg == 10) |
-                   (aseg == 49))
-    er_mask = np.zeros(aseg.shape)
-    er_mask[idx] = 1
-    img = ni.Nifti1Image(er_mask, ni.load(
-        asegfile).get_affine(), ni.load(asegfile).get_header())
+    aseg_img = ni.load(asegfile)
+    aseg = aseg_img.get_data().astype(np.uint32)
+    er_mask = label_set_mask(aseg, [4, 43, 11, 50, 31, 63, 10, 49]).astype(np.float64)
+    img = ni.Nifti1Image(er_mask, aseg_img.get_affine(), aseg_img.get_header())
     ni.save(img, op.join(fs_dir, 'mri', 'csf_mask.nii.gz'))
     del img
 
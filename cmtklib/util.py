@@ -8,10 +8,13 @@
 
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import json
 import numpy as np
+import nibabel as nib
+from scipy import ndimage
 
 warnings.simplefilter("ignore")
 
@@ -290,6 +293,119 @@ def mean_curvature(xyz):
     return np.mean(k)
 
 
+def _compute_roi_stats(data):
+    """Compute the voxel count, centroid and bounding box of all labels of a volume."""
+    data = np.asarray(data)
+    if data.dtype.kind not in "iu":
+        if not np.all(np.mod(data, 1) == 0):
+            raise ValueError("Label volume contains non-integer labels")
+    data = np.maximum(data, 0).astype(np.int64)
+    n_labels = int(data.max(initial=0)) + 1
+
+    flat = data.ravel()
+    count = np.bincount(flat, minlength=n_labels)
+
+    # Sum of the voxel coordinates of each label, one axis at a time
+    centroid = np.zeros((n_labels, 3))
+    for axis in range(3):
+        coord_shape = [1, 1, 1]
+        coord_shape[axis] = data.shape[axis]
+        coords = np.broadcast_to(
+            np.arange(data.shape[axis], dtype=np.float64).reshape(coord_shape), data.shape
+        )
+        centroid[:, axis] = np.bincount(flat, weights=coords.ravel(), minlength=n_labels)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid /= count[:, np.newaxis]
+
+    bbox = np.zeros((n_labels, 2, 3), dtype=np.int64)
+    for label, slices in enumerate(ndimage.find_objects(data), start=1):
+        if slices is not None:
+            bbox[label, 0] = [s.start for s in slices]
+            bbox[label, 1] = [s.stop for s in slices]
+
+    return {"count": count, "centroid": centroid, "bbox": bbox}
+
+
+def roi_stats(label_volume, labels=None):
+    """Compute the voxel count, centroid and bounding box of the ROIs of a label volume.
+
+    All labels are processed in a single pass over the volume. The statistics
+    are not cached: each call reads `label_volume` again if it is a file.
+
+    Parameters
+    ----------
+    label_volume : string or numpy.ndarray
+        Path to a label volume or label volume data
+
+    labels : array_like
+        Labels of the ROIs for which the statistics are returned.
+        If None, statistics are returned for all labels from 0 to the
+        maximal label of the volume, indexed by label.
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with the voxel ``count`` of each ROI, its ``centroid``
+        (mean voxel coordinates, NaN for empty ROIs) and its bounding box
+        ``bbox`` as an array of size [2, 3] with the first voxel and one
+        past the last voxel along each axis (0 for empty ROIs and label 0)
+
+    Examples
+    --------
+    >>> from cmtklib.util import roi_stats
+    >>> stats = roi_stats('/path/to/sub-01_atlas-L2018_desc-scale1_dseg.nii.gz', labels=[1, 2, 3])
+    >>> stats["count"]  # doctest: +SKIP
+    """
+    if isinstance(label_volume, (str, Path)):
+        stats = _compute_roi_stats(nib.load(str(label_volume)).get_data())
+    else:
+        stats = _compute_roi_stats(label_volume)
+
+    if labels is None:
+        return stats
+
+    labels = np.asarray(labels, dtype=np.int64)
+    known = (labels >= 0) & (labels < len(stats["count"]))
+    idx = np.where(known, labels, 0)
+    return {
+        "count": np.where(known, stats["count"][idx], 0),
+        "centroid": np.where(known[:, np.newaxis], stats["centroid"][idx], np.nan),
+        "bbox": np.where(known[:, np.newaxis, np.newaxis], stats["bbox"][idx], 0),
+    }
+
+
+def run_interfaces(interfaces, n_procs=1):
+    """Run a list of Nipype interfaces in a pool of threads.
+
+    The interfaces are run in the current working directory by at most
+    `n_procs` threads. Threads are enough as the interfaces wrap
+    command-line tools that run in their own processes.
+
+    Parameters
+    ----------
+    interfaces : list
+        Nipype interfaces to run
+
+    n_procs : int
+        Maximal number of interfaces run in parallel
+
+    Returns
+    -------
+    results : list
+        Nipype ``InterfaceResult`` of each interface,
+        in the order of `interfaces`
+    """
+    cwd = os.getcwd()
+
+    def _run(interface):
+        return interface.run(cwd=cwd)
+
+    if n_procs <= 1 or len(interfaces) <= 1:
+        return [_run(interface) for interface in interfaces]
+    with ThreadPoolExecutor(max_workers=min(n_procs, len(interfaces))) as executor:
+        return list(executor.map(_run, interfaces))
+
+
 def extract_freesurfer_subject_dir(reconall_report, local_output_dir=None, debug=False):
     """Extract Freesurfer subject directory from the report created by Nipype Freesurfer Recon-all node.
 
@@ -442,6 +442,11 @@ def main():
         os.environ['MRTRIX_RNG_SEED'] = f'{args.mrtrix_random_seed}'
         print(f'  * MRTRIX_RNG_SEED set to {os.environ["MRTRIX_RNG_SEED"]}')
 
+    # Set random generator seed of Dipy tractography if specified
+    if args.dipy_random_seed is not None:
+        os.environ['DIPY_RNG_SEED'] = f'{args.dipy_random_seed}'
+        print(f'  * DIPY_RNG_SEED set to {os.environ["DIPY_RNG_SEED"]}')
+
     # Set random generator seed of ANTs if specified
     if args.ants_random_seed is not None:
         os.environ['ANTS_RANDOM_SEED'] = f'{args.ants_random_seed}'
@@ -0,0 +1,55 @@
+import sys
+import time
+
+import numpy as np
+
+
+def synthetic_parcellation(size=96, n_labels=60, hole_fraction=0.3, seed=0):
+    """Create a cortical ribbon with Voronoi parcels, holes and a few isolated labelled voxels."""
+    rng = np.random.RandomState(seed)
+    grid = np.indices((size, size, size)) - size / 2.0
+    radius = np.sqrt(np.sum(grid * grid, axis=0))
+    ribbon = (radius > size * 0.3) & (radius < size * 0.4)
+
+    # Label each voxel of the ribbon with its nearest seed
+    seeds = np.array(np.where(ribbon)).T[rng.choice(ribbon.sum(), n_labels, replace=False)]
+    idx = np.array(np.where(ribbon)).T
+    nearest = np.argmin(((idx[:, None, :] - seeds[None, :, :]) ** 2).sum(-1), axis=1)
+    vol = np.zeros((size, size, size), dtype=np.int32)
+    vol[tuple(idx.T)] = nearest + 1001
+
+    # Unlabel a fraction of the ribbon and add isolated labelled voxels outside
+    holes = idx[rng.rand(len(idx)) < hole_fraction]
+    vol[tuple(holes.T)] = 0
+    isolated = rng.randint(0, size, (20, 3))
+    vol[tuple(isolated.T)] = rng.randint(1001, 1001 + n_labels, 20)
+
+    # Voxels to correct: the unlabelled voxels of the ribbon and a few voxels far from it
+    targets = ribbon | (radius < size * 0.1)
+    targets &= vol == 0
+    targets[tuple(isolated[:5].T)] = True
+    return vol, np.where(targets)
+
+
+def test_nearest_label_dilation(size=96, shape=(25, 25, 25)):
+    from cmtklib.parcellation import nearest_label_dilation, modal_neighbour_label, neighbourhood_distances
+
+    vol, targets = synthetic_parcellation(size)
+    print('Volume: {} / Voxels to correct: {}'.format(vol.shape, len(targets[0])))
+
+    start = time.time()
+    values = nearest_label_dilation(vol, targets, shape)
+    print('Distance transform dilation: {:.2f} s'.format(time.time() - start))
+
+    start = time.time()
+    dist = neighbourhood_distances(shape)
+    ref_values = np.array([modal_neighbour_label(vol, shape, position, dist) for position in zip(*targets)])
+    print('Voxel-wise dilation: {:.2f} s'.format(time.time() - start))
+
+    n_diff = np.sum(values != ref_values)
+    print('Voxels with different labels: {}'.format(n_diff))
+    assert n_diff == 0
+
+
+if __name__ == '__main__':
+    test_nearest_label_dilation(int(sys.argv[1]) if len(sys.argv) > 1 else 96)